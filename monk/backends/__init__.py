@@ -1,7 +1,10 @@
 """ Backends available to monk to connect to the target
 """
 
+from functools import partial
+
 from monk.backends import rsp
+from monk.backends.rsp_helpers.rsp_target import TRANSPORT_ASYNCIO
 # need to address this later, can't import gdb backend because it depends on GDBPython,
 # which only exists in a running GDB session context.
 #import monk.backends.gdb as gdb
@@ -9,6 +12,10 @@ from monk.backends import rsp
 # All available backends must be listed here so that Monk can accept them as strings in its
 # constructor and map those strings to the correct backend constructor
 backend_map = {
-    'rsp': rsp.Rsp
+    'rsp': rsp.Rsp,
+    # RSP backend driven by a shared asyncio event loop instead of two threads per connection
+    'rsp-asyncio': partial(rsp.Rsp, transport=TRANSPORT_ASYNCIO),
+    # RSP backend in non-stop mode, where hooks only stop the vCPU that hit them
+    'rsp-nonstop': partial(rsp.Rsp, non_stop=True)
     # 'gdb': gdb.Gdb
 }
@@ -42,6 +42,13 @@ class Gdb():
         be shut down.
         """
 
+    def can_set_breakpoints_while_running(self):
+        """ Whether breakpoints can be set and deleted while the target's running
+
+        :rtype: bool
+        """
+        return False
+
     def target_is_running(self):
         """ Get the target's running state
 
@@ -94,6 +101,24 @@ class Gdb():
         """
         return _exec_read_uint_cmd("x/1xg 0x%x" % addr)
 
+    def read_bytes(self, addr, size):
+        """ Read a range of memory
+
+        :param int addr: the address to read from
+        :param int size: the number of bytes to read
+        :rtype: bytes
+        """
+        return bytes(gdb.selected_inferior().read_memory(addr, size))
+
+    def read_many(self, ranges):
+        """ Read several ranges of memory
+
+        :param list ranges: (address, size) of each range to read
+        :rtype: list
+        :returns: the bytes read for each range, in order
+        """
+        return [self.read_bytes(addr, size) for addr, size in ranges]
+
     def write_reg(self, regname, val):
         """ Set a register's value
 
@@ -135,6 +160,14 @@ class Gdb():
         """
         _exec_write_uint_cmd("set {long}0x%x = 0x%x" % (addr, val))
 
+    def write_bytes(self, addr, data):
+        """ Write a range of memory
+
+        :param int addr: the address to write to
+        :param bytes data: the bytes to write
+        """
+        gdb.selected_inferior().write_memory(addr, data)
+
     def run(self):
         """ Run the target
 
@@ -188,6 +221,14 @@ class Gdb():
         """
         raise NotImplementedError("set_exec_breakpoint is not yet implemented")
 
+    def set_exec_breakpoints(self, breakpoints):
+        """ Set many execution breakpoints at once
+
+        :param dict breakpoints: address to the conditions for each breakpoint
+        :raises NotImplementedError: because this functionality is not yet implemented
+        """
+        raise NotImplementedError("set_exec_breakpoints is not yet implemented")
+
     def del_read_breakpoint(self, addr):
         """ Delete a read breakpoint
 
@@ -220,6 +261,14 @@ class Gdb():
         """
         raise NotImplementedError("del_exec_breakpoint is not yet implemented")
 
+    def del_exec_breakpoints(self, addrs):
+        """ Delete many execution breakpoints at once
+
+        :param iterable addrs: the addresses of the breakpoints
+        :raises NotImplementedError: because this functionality is not yet implemented
+        """
+        raise NotImplementedError("del_exec_breakpoints is not yet implemented")
+
 
 def _exec_read_uint_cmd(cmd):
     result = gdb.execute(cmd, to_string=True)
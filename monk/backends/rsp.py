@@ -1,6 +1,10 @@
 """ RSP backend
 """
-from monk.backends.rsp_helpers.rsp_target import RspTarget, RspTargetError
+import logging
+
+from monk.backends.rsp_helpers.rsp_target import RspTarget, RspTargetError, TRANSPORT_THREADS, \
+    DEFAULT_MAX_STEPS
+from monk.backends.rsp_helpers.page_cache import DEFAULT_CACHE_PAGES
 
 # This should be a subclass of an abstract class Backend, enforcing that all backends
 # have the same API
@@ -8,8 +12,24 @@ class Rsp():
     """ Wrapper for all functionality of the RSP backend. Basically just exposes RspTarget
     with an API consistent with the other backends.
     """
-    def __init__(self, host, port):
+    # pylint: disable=too-many-arguments
+    def __init__(self, host, port, transport=TRANSPORT_THREADS, cache_pages=DEFAULT_CACHE_PAGES,
+                 hw_breakpoints=False, non_stop=False):
+        """
+        :param str host: the address of the target to connect to
+        :param int port: the port number of the GDB server on the target
+        :param str transport: how to talk to the gdbstub, TRANSPORT_THREADS or TRANSPORT_ASYNCIO
+        :param int cache_pages: the most pages of memory to cache while stopped, 0 for none
+        :param bool hw_breakpoints: whether execution breakpoints should use the target's
+        debug registers while there are any free, rather than patching memory
+        :param bool non_stop: whether to put the stub in non-stop mode, so that a hook only
+        stops the vCPU that hit it while the others keep running
+        """
         self.connected = False
+        self._transport = transport
+        self._cache_pages = cache_pages
+        self._hw_breakpoints = hw_breakpoints
+        self._non_stop = non_stop
         self.connect(host, port)
 
     # Expose the underlying target's endianness. RspTarget has to do the endian translation,
@@ -41,7 +61,8 @@ class Rsp():
         :param str host: the address of the target to connect to
         :param int port: the port number of the GDB server on the target
         """
-        self._rsp_target = RspTarget(host, port)
+        self._rsp_target = RspTarget(host, port, self._transport, self._cache_pages,
+                                     non_stop=self._non_stop)
         self.connected = True
 
     def shutdown(self):
@@ -50,6 +71,30 @@ class Rsp():
         self._rsp_target.close()
         self.connected = False
 
+    def cpus(self):
+        """ Get the target's vCPUs, which the stub presents as threads
+
+        :rtype: list
+        :returns: the id of each vCPU
+        """
+        return self._rsp_target.threads()
+
+    def current_cpu(self):
+        """ Get the vCPU the target last stopped for
+
+        :rtype: str
+        :returns: the vCPU's id, or None if the stub doesn't say
+        """
+        return self._rsp_target.stop_thread
+
+    def can_set_breakpoints_while_running(self):
+        """ Whether breakpoints can be set and deleted while the target's running, which only a
+        stub in non-stop mode allows
+
+        :rtype: bool
+        """
+        return self._rsp_target.non_stop
+
     def target_is_running(self):
         """ Get the target's running state
 
@@ -60,12 +105,13 @@ class Rsp():
 
     # Reading memory
 
-    def get_reg(self, regname):
+    def get_reg(self, regname, cpu=None):
         """ Read a register's value
 
         :param str regname: the name of the register to read from
+        :param str cpu: the id of the vCPU to read it from, or None for the one that stopped
         """
-        return self._rsp_target.read_register(regname)
+        return self._rsp_target.read_register(regname, cpu)
 
     def read_uint8(self, addr):
         """ Read a uint8 from memory
@@ -95,15 +141,34 @@ class Rsp():
         """
         return self._rsp_target.read_memory(addr, 8)
 
+    def read_bytes(self, addr, size):
+        """ Read a range of memory
+
+        :param int addr: the address to read from
+        :param int size: the number of bytes to read
+        :rtype: bytes
+        """
+        return self._rsp_target.read_bytes(addr, size)
+
+    def read_many(self, ranges):
+        """ Read several ranges of memory at once
+
+        :param list ranges: (address, size) of each range to read
+        :rtype: list
+        :returns: the bytes read for each range, in order
+        """
+        return self._rsp_target.read_many(ranges)
+
     # Writing memory
 
-    def write_reg(self, regname, val):
+    def write_reg(self, regname, val, cpu=None):
         """ Set a register's value
         
         :param str regname: the name of the register
         :param int val: the value to set the register to
+        :param str cpu: the id of the vCPU to set it in, or None for the one that stopped
         """
-        self._rsp_target.write_register(regname, val)
+        self._rsp_target.write_register(regname, val, cpu)
 
     def write_uint8(self, addr, val):
         """ Write a uint8 to memory
@@ -138,6 +203,14 @@ class Rsp():
         """
         self._rsp_target.write_memory(addr, val, 8)
 
+    def write_bytes(self, addr, data):
+        """ Write a range of memory
+
+        :param int addr: the address to write to
+        :param bytes data: the bytes to write
+        """
+        self._rsp_target.write_bytes(addr, data)
+
     # Target control
 
     def run(self):
@@ -155,66 +228,133 @@ class Rsp():
         """
         self._rsp_target.cmd_step()
 
-    def set_read_breakpoint(self, addr):
+    def step_n(self, count):
+        """ Step the target by a number of instructions, without running hooks
+
+        :param int count: the number of instructions to step
+        :rtype: list
+        :returns: the pc after each step
+        """
+        return self._rsp_target.cmd_step_n(count)
+
+    def step_until(self, until, max_steps=None):
+        """ Step the target until a condition on the pc holds, without running hooks
+
+        :param function|tuple until: a function that takes the pc and returns True to stop,
+        or an (start, end) range of addresses to step through
+        :param int max_steps: the most instructions to single step, or None for
+        DEFAULT_MAX_STEPS
+        :rtype: list
+        :returns: the pc after each stop
+        """
+        if max_steps is None:
+            max_steps = DEFAULT_MAX_STEPS
+
+        return self._rsp_target.cmd_step_until(until, max_steps)
+
+    # Watchpoints watch a word at the address. The callback registry is keyed by address only,
+    # so there's nowhere to say how much more than that to watch.
+    @property
+    def _watch_size(self):
+        return self._rsp_target.addr_size
+
+    def set_read_breakpoint(self, addr, size=None):
         """ Set a read breakpoint
 
         :param int addr: the address to set the breakpoint at
-        :raises NotImplementedError: because this functionality is not yet implemented
+        :param int size: the number of bytes to watch, or None for the size of an address
+        :raises RspTargetError: if there's no debug register free, or the target refused
         """
-        raise NotImplementedError("set_read_breakpoint is not yet implemented")
-#        self._rsp_target.set_read_watchpoint(addr, sz)
+        self._rsp_target.set_read_watchpoint(addr, size or self._watch_size)
 
-    def set_write_breakpoint(self, addr):
+    def set_write_breakpoint(self, addr, size=None):
         """ Set a write breakpoint
 
         :param int addr: the address to set the breakpoint at
-        :raises NotImplementedError: because this functionality is not yet implemented
+        :param int size: the number of bytes to watch, or None for the size of an address
+        :raises RspTargetError: if there's no debug register free, or the target refused
         """
-        raise NotImplementedError("set_write_breakpoint is not yet implemented")
-#        self._rsp_target.set_write_watchpoint(addr, sz)
+        self._rsp_target.set_write_watchpoint(addr, size or self._watch_size)
 
-    def set_access_breakpoint(self, addr):
+    def set_access_breakpoint(self, addr, size=None):
         """ Set an access breakpoint
 
         :param int addr: the address to set the breakpoint at
-        :raises NotImplementedError: because this functionality is not yet implemented
+        :param int size: the number of bytes to watch, or None for the size of an address
+        :raises RspTargetError: if there's no debug register free, or the target refused
         """
-        raise NotImplementedError("set_access_breakpoint is not yet implemented")
-#        self._rsp_target.set_access_watchpoint(addr, sz)
+        self._rsp_target.set_access_watchpoint(addr, size or self._watch_size)
 
-    def set_exec_breakpoint(self, addr):
+    def set_exec_breakpoint(self, addr, conditions=None):
         """ Set an execution breakpoint
 
         :param int addr: the address to set the breakpoint at
+        :param list conditions: conditions from monk.conditions, one per hook at the address.
+        If the stub supports conditional breakpoints, it only stops the target when one of
+        them holds. Otherwise the target always stops and the conditions are left for the
+        caller to check.
+        """
+        self._rsp_target.set_exec_breakpoint(addr, self._hw_breakpoints,
+                                             self._compile_conditions(conditions))
+
+    def set_exec_breakpoints(self, breakpoints):
+        """ Set many execution breakpoints at once. They're always software breakpoints.
+
+        :param dict breakpoints: address to its conditions from monk.conditions, as for
+        set_exec_breakpoint, or None
+        :raises RspTargetError: if any of them couldn't be set. The rest are still set.
+        """
+        self._rsp_target.set_exec_breakpoints({addr: self._compile_conditions(conditions)
+                                               for addr, conditions in breakpoints.items()})
+
+    def _compile_conditions(self, conditions):
+        """ Compile conditions for the stub to check, if it can
+
+        :param list conditions: conditions from monk.conditions
+        :rtype: list
+        :returns: the bytecode for each condition, or None if the stub has to always stop
         """
-        self._rsp_target.set_sw_breakpoint(addr)
-    #    self._rsp_target.set_hw_breakpoint(addr)
+        if not conditions or not self._rsp_target.capabilities.conditional_breakpoints:
+            return None
 
-    def del_read_breakpoint(self, addr):
+        try:
+            return [self._rsp_target.compile_condition(cond) for cond in conditions]
+        except RspTargetError as e:
+            logging.getLogger(__name__).debug(f"{e}, checking conditions on the client instead")
+            return None
+
+    def del_read_breakpoint(self, addr, size=None):
         """ Delete a read breakpoint
 
         :param int addr: the address of the breakpoint
-        :raises NotImplementedError: because this functionality is not yet implemented
+        :param int size: the number of bytes it watches, or None for the size of an address
         """
-        raise NotImplementedError("del_read_breakpoint is not yet implemented")
-#        self._rsp_target.remove_read_watchpoint(addr, sz)
+        try:
+            self._rsp_target.remove_read_watchpoint(addr, size or self._watch_size)
+        except RspTargetError:
+            pass
 
-    def del_write_breakpoint(self, addr):
+    def del_write_breakpoint(self, addr, size=None):
         """ Delete a write breakpoint
 
         :param int addr: the address of the breakpoint
-        :raises NotImplementedError: because this functionality is not yet implemented
+        :param int size: the number of bytes it watches, or None for the size of an address
         """
-        raise NotImplementedError("del_write_breakpoint is not yet implemented")
-#        self._rsp_target.remove_write_watchpoint(addr, sz)
+        try:
+            self._rsp_target.remove_write_watchpoint(addr, size or self._watch_size)
+        except RspTargetError:
+            pass
 
-    def del_access_breakpoint(self, addr):
+    def del_access_breakpoint(self, addr, size=None):
         """ Delete an access breakpoint
 
         :param int addr: the address of the breakpoint
+        :param int size: the number of bytes it watches, or None for the size of an address
         """
-        raise NotImplementedError("del_access_breakpoint is not yet implemented")
-#        self._rsp_target.remove_access_watchpoint(addr, sz)
+        try:
+            self._rsp_target.remove_access_watchpoint(addr, size or self._watch_size)
+        except RspTargetError:
+            pass
 
     def del_exec_breakpoint(self, addr):
         """ Delete an execution breakpoint
@@ -222,12 +362,71 @@ class Rsp():
         :param int addr: the address of the breakpoint
         """
         try:
-            self._rsp_target.remove_sw_breakpoint(addr)
+            self._rsp_target.remove_exec_breakpoint(addr)
         except RspTargetError:
             # Sometimes the target returns an error even though it removed the
             # breakpoint just fine. Ignore it.
             pass
 
+    def del_exec_breakpoints(self, addrs):
+        """ Delete many execution breakpoints at once
+
+        :param iterable addrs: the addresses of the breakpoints
+        """
+        try:
+            self._rsp_target.remove_exec_breakpoints(addrs)
+        except RspTargetError:
+            # As for del_exec_breakpoint, the breakpoints were removed anyway
+            pass
+
+    # Tracepoints
+
+    def set_tracepoint(self, addr, capture, condition=None, pass_count=0):
+        """ Set a tracepoint, which collects registers and memory without stopping the target
+
+        :param int addr: the address to set the tracepoint at
+        :param Capture capture: the registers and memory to collect
+        :param Expr condition: a condition from monk.conditions that has to hold for anything
+        to be collected, or None. The stub checks it, so it has to compile to bytecode.
+        :param int pass_count: stop the trace after this many hits, or 0 to never stop
+        :rtype: int
+        :returns: the tracepoint's number
+        :raises RspTargetError: if the stub refused the tracepoint or its condition
+        """
+        bytecode = None if condition is None else self._rsp_target.compile_condition(condition)
+
+        return self._rsp_target.set_tracepoint(addr, capture, bytecode, pass_count)
+
+    def clear_tracepoints(self):
+        """ Delete every tracepoint and everything they've collected
+        """
+        self._rsp_target.trace_init()
+
+    def start_trace(self):
+        """ Start the tracepoints collecting
+        """
+        self._rsp_target.trace_start()
+
+    def stop_trace(self):
+        """ Stop the tracepoints collecting
+        """
+        self._rsp_target.trace_stop()
+
+    def trace_status(self):
+        """ Get the state of the trace
+
+        :rtype: TraceStatus
+        """
+        return self._rsp_target.trace_status()
+
+    def trace_frames(self):
+        """ Download what the tracepoints collected. The target has to be stopped.
+
+        :rtype: iterator
+        :returns: a TraceFrame for each hit, in order
+        """
+        return self._rsp_target.trace_frames()
+
     # Stop events notification
 
     def set_on_read_callback(self, callback):
@@ -261,3 +460,12 @@ class Rsp():
         :param function callback: the function to call when the event occurs
         """
         self._rsp_target.on_execute = callback
+
+    def set_on_resume_callback(self, callback):
+        """ Set what function gets called once the target has resumed from a hook's stop. It's
+        passed the seconds from the stop to the event handler being called, and from the
+        handler returning to the target running again.
+
+        :param function callback: the function to call
+        """
+        self._rsp_target.on_resume = callback
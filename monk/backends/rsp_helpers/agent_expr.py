@@ -0,0 +1,135 @@
+"""
+Compiles monk.conditions expressions into GDB agent expression bytecode, so that a gdbstub that
+supports conditional breakpoints can check a hook's condition itself and only stop the target
+when it holds.
+
+See "Agent Expressions" in the GDB manual for the bytecode.
+"""
+
+from monk.conditions import Const, Reg, Mem, BinOp, Compare, Not, In, All, Any
+
+# Opcodes
+OP_ADD = 0x02
+OP_SUB = 0x03
+OP_LOG_NOT = 0x0e
+OP_BIT_AND = 0x0f
+OP_BIT_OR = 0x10
+OP_EQUAL = 0x13
+OP_LESS_UNSIGNED = 0x15
+OP_REF8 = 0x17
+OP_REF16 = 0x18
+OP_REF32 = 0x19
+OP_REF64 = 0x1a
+OP_CONST8 = 0x22
+OP_CONST16 = 0x23
+OP_CONST32 = 0x24
+OP_CONST64 = 0x25
+OP_REG = 0x26
+OP_END = 0x27
+OP_SWAP = 0x2b
+
+_ref_ops = {1: OP_REF8, 2: OP_REF16, 4: OP_REF32, 8: OP_REF64}
+
+_binop_ops = {'+': OP_ADD, '-': OP_SUB, '&': OP_BIT_AND, '|': OP_BIT_OR}
+
+
+class AgentExprError(Exception):
+    """Error raised when a condition can't be compiled to bytecode"""
+
+
+def compile_condition(cond, reg_map):
+    """
+    Compile a condition into an agent expression that leaves 1 on the stack if it holds
+
+    :param Expr cond: the condition
+    :param dict reg_map: register name to register number, as the stub numbers them
+    :rtype: bytes
+    :raises AgentExprError: if the condition uses something the bytecode can't express
+    """
+    code = bytearray()
+    _emit(cond, reg_map, code)
+    code.append(OP_END)
+
+    return bytes(code)
+
+
+def _emit(expr, reg_map, code):
+    if isinstance(expr, Const):
+        _emit_const(expr.value, code)
+    elif isinstance(expr, Reg):
+        try:
+            regnum = reg_map[expr.name]
+        except KeyError as e:
+            raise AgentExprError(f"Unknown register '{expr.name}'") from e
+
+        code.append(OP_REG)
+        code.extend(regnum.to_bytes(2, 'big'))
+    elif isinstance(expr, Mem):
+        _emit(expr.addr, reg_map, code)
+        code.append(_ref_ops[expr.size])
+    elif isinstance(expr, BinOp):
+        _emit(expr.left, reg_map, code)
+        _emit(expr.right, reg_map, code)
+        code.append(_binop_ops[expr.op])
+    elif isinstance(expr, Compare):
+        _emit_compare(expr, reg_map, code)
+    elif isinstance(expr, Not):
+        _emit(expr.expr, reg_map, code)
+        code.append(OP_LOG_NOT)
+    elif isinstance(expr, In):
+        # Compare against each value in turn. The bytecode has no short circuit, and the
+        # value is worked out again each time, but it's all done on the target.
+        _emit_joined([expr.expr == value for value in sorted(expr.values)], OP_BIT_OR, 0,
+                     reg_map, code)
+    elif isinstance(expr, All):
+        _emit_joined([Not(Not(e)) for e in expr.exprs], OP_BIT_AND, 1, reg_map, code)
+    elif isinstance(expr, Any):
+        _emit_joined([Not(Not(e)) for e in expr.exprs], OP_BIT_OR, 0, reg_map, code)
+    else:
+        raise AgentExprError(f"Can't compile {expr!r}")
+
+
+def _emit_joined(exprs, op, empty, reg_map, code):
+    """Emit each expression, combining their values with a binary op"""
+    if not exprs:
+        _emit_const(empty, code)
+        return
+
+    _emit(exprs[0], reg_map, code)
+
+    for expr in exprs[1:]:
+        _emit(expr, reg_map, code)
+        code.append(op)
+
+
+def _emit_compare(expr, reg_map, code):
+    # There's only 'equal' and 'less', so the rest are built from those. Operands go on the
+    # stack left first; 'less' pops b then a and pushes a < b.
+    _emit(expr.left, reg_map, code)
+    _emit(expr.right, reg_map, code)
+
+    if expr.op == '==':
+        code.append(OP_EQUAL)
+    elif expr.op == '!=':
+        code.extend((OP_EQUAL, OP_LOG_NOT))
+    elif expr.op == '<':
+        code.append(OP_LESS_UNSIGNED)
+    elif expr.op == '>':
+        code.extend((OP_SWAP, OP_LESS_UNSIGNED))
+    elif expr.op == '<=':
+        code.extend((OP_SWAP, OP_LESS_UNSIGNED, OP_LOG_NOT))
+    elif expr.op == '>=':
+        code.extend((OP_LESS_UNSIGNED, OP_LOG_NOT))
+    else:
+        raise AgentExprError(f"Can't compile comparison '{expr.op}'")
+
+
+def _emit_const(value, code):
+    # Constants are zero extended, so use the smallest one the value fits in
+    for op, size in ((OP_CONST8, 1), (OP_CONST16, 2), (OP_CONST32, 4), (OP_CONST64, 8)):
+        if value < 1 << (size * 8):
+            code.append(op)
+            code.extend(value.to_bytes(size, 'big'))
+            return
+
+    raise AgentExprError(f"Constant {hex(value)} doesn't fit in 64 bits")
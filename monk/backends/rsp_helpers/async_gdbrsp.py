@@ -0,0 +1,228 @@
+"""
+asyncio GDB RSP client. Does the same job as GdbRsp, but on asyncio streams instead of a
+read thread and a write thread per connection, so one event loop can drive many targets.
+"""
+
+import asyncio
+import threading
+from queue import Queue
+import logging
+
+from monk.backends.rsp_helpers.gdbrsp import GdbRspError, PacketFramer, RECV_SIZE, \
+    _make_packet, _is_stop_packet, _queue_notification
+
+
+class AsyncGdbRsp():
+    """ Sends and receives packets on a RSP connection using asyncio streams
+
+    Create one with the connect() coroutine rather than the constructor. Replies are read
+    with the awaitable recv(), and stop packets go to a separate stream read with recv_stop().
+    """
+    def __init__(self):
+        # Same split as GdbRsp: stop packets never get confused with replies to requests
+        self.read_queue = asyncio.Queue()
+        self.stop_queue = asyncio.Queue()
+
+        # Set once the stub has agreed to QStartNoAckMode
+        self.no_ack_mode = False
+        # Set once the stub has agreed to QNonStop:1, after which stops only arrive as
+        # notifications
+        self.non_stop = False
+
+        self._reader = None
+        self._writer = None
+        self._recv_task = None
+
+    @classmethod
+    async def connect(cls, host, port):
+        """ Connect to a gdbstub
+
+        :param str host: the host the gdbstub is on
+        :param int port: the port the gdbstub is listening on
+        :rtype: AsyncGdbRsp
+        :returns: the connected client
+        :raises GdbRspError: if unable to connect
+        """
+        rsp = cls()
+
+        try:
+            rsp._reader, rsp._writer = await asyncio.open_connection(host, port)
+        except OSError as e:
+            raise GdbRspError(f"Unable to connect to gdbstub at {':'.join([host, str(port)])}") \
+                from e
+
+        rsp._recv_task = asyncio.ensure_future(rsp._do_recv())
+
+        return rsp
+
+    async def send(self, data):
+        """ Send a packet to the remote target
+
+        :param bytes data: the packet to send
+        """
+        logging.getLogger(__name__).debug(f"send() {data}")
+
+        try:
+            packet = _make_packet(data)
+        except TypeError:
+            # Turn a regular string into bytes
+            packet = _make_packet(data.encode('utf-8'))
+
+        self._writer.write(packet)
+        await self._writer.drain()
+
+    async def recv(self, timeout=None):
+        """ Get a reply packet from the target
+
+        :param float timeout: amount of time to wait for the incoming packet
+        :returns: the packet, or None if the timeout expired
+        """
+        return await _get_with_timeout(self.read_queue, timeout)
+
+    async def recv_stop(self, timeout=None):
+        """ Get a stop packet from the target
+
+        :param float timeout: amount of time to wait for the stop packet
+        :returns: the packet, or None if the timeout expired
+        """
+        return await _get_with_timeout(self.stop_queue, timeout)
+
+    async def _do_recv(self):
+        """ Read from the connection until it closes, queueing the packets received """
+        framer = PacketFramer()
+
+        while True:
+            try:
+                data = await self._reader.read(RECV_SIZE)
+            except ConnectionResetError:
+                data = b''
+
+            if not data:
+                logging.getLogger(__name__).debug("connection closed by remote")
+                return
+
+            for packet, checksum_ok, notification in framer.feed(data):
+                if notification:
+                    _queue_notification(packet, checksum_ok, self.stop_queue.put_nowait)
+                    continue
+
+                if not checksum_ok:
+                    logging.getLogger(__name__).debug(f"bad checksum on packet {packet}")
+
+                    if not self.no_ack_mode:
+                        self._writer.write(b'-')
+                        continue
+
+                    logging.getLogger(__name__).warning("bad checksum in no-ack mode, "
+                                                        f"using packet anyway: {packet}")
+
+                if not self.no_ack_mode:
+                    self._writer.write(b'+')
+
+                logging.getLogger(__name__).debug(f"received packet {packet}")
+
+                if _is_stop_packet(packet) and not self.non_stop:
+                    self.stop_queue.put_nowait(packet)
+                else:
+                    self.read_queue.put_nowait(packet)
+
+    async def close(self):
+        """ Close the connection to the gdbstub """
+        if self._recv_task:
+            self._recv_task.cancel()
+
+        if self._writer:
+            self._writer.close()
+
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                # This can happen if the remote connection has closed - ignore
+                pass
+
+
+class LoopGdbRsp():
+    """ Blocking, GdbRsp-compatible wrapper around an AsyncGdbRsp
+
+    This lets RspTarget use the asyncio transport without changing how it talks to the
+    connection. The AsyncGdbRsp runs on an event loop in another thread, shared by default
+    between every LoopGdbRsp, so any number of targets costs one thread instead of two each.
+    """
+    def __init__(self, host, port, loop=None):
+        self._loop = loop or get_shared_loop()
+
+        # RspTarget reads stop packets from a thread-safe queue, so they're forwarded into one
+        self.stop_queue = Queue()
+
+        self._async_rsp = self._run(AsyncGdbRsp.connect(host, port))
+        self._forward_task = asyncio.run_coroutine_threadsafe(self._forward_stops(), self._loop)
+
+    @property
+    def no_ack_mode(self):
+        """ Whether the connection is in no-ack mode """
+        return self._async_rsp.no_ack_mode
+
+    @no_ack_mode.setter
+    def no_ack_mode(self, val):
+        self._async_rsp.no_ack_mode = val
+
+    @property
+    def non_stop(self):
+        """ Whether the stub is in non-stop mode """
+        return self._async_rsp.non_stop
+
+    @non_stop.setter
+    def non_stop(self, val):
+        self._async_rsp.non_stop = val
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _forward_stops(self):
+        while True:
+            self.stop_queue.put(await self._async_rsp.recv_stop())
+
+    def send(self, data):
+        """ Send a packet to the remote target
+
+        :param bytes data: the packet to send
+        """
+        self._run(self._async_rsp.send(data))
+
+    def recv(self, timeout=None):
+        """ Get a packet from the target
+
+        :param float timeout: amount of time to wait for the incoming packet
+        """
+        return self._run(self._async_rsp.recv(timeout))
+
+    def close(self):
+        """ Close the connection to the gdbstub """
+        self._forward_task.cancel()
+        self._run(self._async_rsp.close())
+
+
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+def get_shared_loop():
+    """ Get the event loop shared by all LoopGdbRsp connections, starting it if necessary
+
+    :rtype: asyncio.AbstractEventLoop
+    :returns: the event loop, running in a daemon thread
+    """
+    global _shared_loop  # pylint:disable=global-statement
+
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = asyncio.new_event_loop()
+            threading.Thread(target=_shared_loop.run_forever, name="monk-rsp-loop",
+                             daemon=True).start()
+
+    return _shared_loop
+
+async def _get_with_timeout(queue, timeout):
+    try:
+        return await asyncio.wait_for(queue.get(), timeout)
+    except asyncio.TimeoutError:
+        return None
@@ -0,0 +1,118 @@
+"""
+Tracks which breakpoints and watchpoints the gdbstub currently has inserted, so that RspTarget
+only sends Z and z packets for the ones that actually change, and which of the target's
+hardware debug registers they're using.
+"""
+
+import threading
+
+# Z packet types
+BP_SW = 0
+BP_HW = 1
+WP_WRITE = 2
+WP_READ = 3
+WP_ACCESS = 4
+
+# The hardware debug registers to assume the target has, unless told otherwise. x86 has four
+# debug registers in all; ARM cores usually have between two and sixteen of each kind.
+DEFAULT_HW_BREAKPOINT_SLOTS = 4
+DEFAULT_WATCHPOINT_SLOTS = 4
+
+
+class BreakpointTable():
+    """ The set of breakpoints and watchpoints inserted in the stub
+
+    Each one is identified by its Z packet type, address and kind (the length for
+    breakpoints, or the number of bytes watched for watchpoints).
+    """
+    def __init__(self):
+        self._inserted = set()
+        self._lock = threading.Lock()
+
+    def is_inserted(self, z_type, addr, kind):
+        """ Whether a breakpoint is inserted
+
+        :param int z_type: the Z packet type, e.g. BP_SW
+        :param int addr: the address of the breakpoint
+        :param int kind: the breakpoint's length, or the watchpoint's size
+        :rtype: bool
+        """
+        with self._lock:
+            return (z_type, addr, kind) in self._inserted
+
+    def insert(self, z_type, addr, kind):
+        """ Record that a breakpoint has been inserted
+
+        :param int z_type: the Z packet type, e.g. BP_SW
+        :param int addr: the address of the breakpoint
+        :param int kind: the breakpoint's length, or the watchpoint's size
+        """
+        with self._lock:
+            self._inserted.add((z_type, addr, kind))
+
+    def remove(self, z_type, addr, kind):
+        """ Record that a breakpoint has been removed
+
+        :param int z_type: the Z packet type, e.g. BP_SW
+        :param int addr: the address of the breakpoint
+        :param int kind: the breakpoint's length, or the watchpoint's size
+        """
+        with self._lock:
+            self._inserted.discard((z_type, addr, kind))
+
+    def inserted(self, z_type=None):
+        """ Get the breakpoints that are inserted
+
+        :param int z_type: only get breakpoints of this Z packet type, or None for all of them
+        :rtype: list
+        :returns: (Z packet type, address, kind) of each breakpoint
+        """
+        with self._lock:
+            return sorted(bp for bp in self._inserted if z_type is None or bp[0] == z_type)
+
+
+class SlotAllocator():
+    """ Hands out a limited number of hardware debug registers
+
+    The stub can't tell us how many debug registers the target has, and when it runs out it
+    usually just replies with an error. Keeping count ourselves means we know a hardware
+    breakpoint or watchpoint won't fit before asking for it.
+    """
+    def __init__(self, slots):
+        """
+        :param int slots: the number of debug registers
+        """
+        self.slots = slots
+        self._holders = set()
+        self._lock = threading.Lock()
+
+    @property
+    def free(self):
+        """ The number of debug registers not in use """
+        with self._lock:
+            return self.slots - len(self._holders)
+
+    def allocate(self, holder):
+        """ Take a debug register
+
+        :param tuple holder: what the register is for, e.g. (Z packet type, address, kind)
+        :rtype: bool
+        :returns: True if the holder has a register, False if they're all in use
+        """
+        with self._lock:
+            if holder in self._holders:
+                return True
+
+            if len(self._holders) >= self.slots:
+                return False
+
+            self._holders.add(holder)
+            return True
+
+    def release(self, holder):
+        """ Give back a debug register. Releasing one that isn't held does nothing.
+
+        :param tuple holder: what the register was allocated for
+        """
+        with self._lock:
+            self._holders.discard(holder)
@@ -3,8 +3,8 @@ Basic asynchronous GDB RSP client. Sends packets with correct checksums, receive
 packets and strips checksums.
 """
 
-import socket
 import re
+import socket
 from queue import Queue, Empty
 import threading
 import selectors
@@ -12,16 +12,86 @@ import logging
 
 from ...utils.helpers import hexbyte
 
+# Number of bytes to pull off of the socket per read. Bulk memory reads and qXfer transfers
+# can be several KB, so this is sized to get most replies in one or two reads.
+RECV_SIZE = 4096
+
+# Stop packets that could be mistaken for replies to trace packets
+_T_STOP_PACKET = re.compile(rb'T[0-9a-fA-F]{2}')
+_FILE_IO_REQUEST = re.compile(rb'F[a-z]+(,|$)')
+
+# Characters with special meaning in the RSP framing
+PACKET_START = ord('$')
+NOTIFICATION_START = ord('%')
+PACKET_END = ord('#')
+ESCAPE_CHAR = ord('}')
+RLE_CHAR = ord('*')
+
 
 class GdbRspError(Exception):
     """ Error raised by GdbRsp """
 
 
+class PacketFramer():
+    """ Incrementally splits a stream of bytes from the gdbstub into packets.
+
+    Data is accumulated in a bytearray, and each call to feed() only scans the bytes that
+    haven't been looked at yet, so receiving a large packet over many reads costs time
+    proportional to its length rather than to the square of it. Anything outside of a
+    $...#xx packet or %...#xx notification frame (e.g. '+' acks) is discarded.
+    """
+    def __init__(self):
+        self._buf = bytearray()
+        # Offset into _buf where the search for the end of the current packet resumes
+        self._scan_pos = 0
+
+    def feed(self, data):
+        """ Add data read from the connection, and get all of the packets it completed
+
+        :param bytes data: the data read from the connection
+        :rtype: list
+        :returns: a list of (packet data, checksum ok, is notification) tuples, where packet
+        data has had run-length encoding and escapes decoded
+        """
+        self._buf += data
+        packets = []
+
+        while True:
+            start = _frame_start(self._buf)
+
+            # Nothing that looks like a packet, so nothing here is worth keeping
+            if start == -1:
+                self._buf.clear()
+                self._scan_pos = 0
+                break
+
+            # Drop everything before the packet start marker, e.g. acks or corrupt data
+            if start > 0:
+                del self._buf[:start]
+                self._scan_pos = max(self._scan_pos - start, 0)
+
+            end = self._buf.find(PACKET_END, max(self._scan_pos, 1))
+
+            # Packet isn't complete yet; remember how far we got so we don't scan it again
+            if end == -1 or len(self._buf) < end + 3:
+                self._scan_pos = len(self._buf) if end == -1 else end
+                break
+
+            notification = self._buf[0] == NOTIFICATION_START
+            raw = bytes(self._buf[1:end])
+            checksum = bytes(self._buf[end + 1:end + 3])
+            del self._buf[:end + 3]
+            self._scan_pos = 0
+
+            checksum_ok = _make_checksum(raw) == checksum.lower()
+            packets.append((_decode_packet_data(raw), checksum_ok, notification))
+
+        return packets
+
+
 class GdbRsp():
     """ Asynchronously sends and receives packets on a RSP connection """
 
-    _checksum_pattern = re.compile(b'#..')
-
     def __init__(self, host, port):
         # Stop packets, encountered on breakpoints or exceptions, are put in this public queue
         # instead of GdbRsp's read_queue. This makes it so that they are never confused with data,
@@ -33,6 +103,13 @@ class GdbRsp():
         self.read_queue = Queue()
         self._shutdown_flag = False
 
+        # Set once the stub has agreed to QStartNoAckMode. After that, neither side sends '+'/'-'
+        # acknowledgements, which saves a socket write and a send queue hop on every packet.
+        self.no_ack_mode = False
+        # Set once the stub has agreed to QNonStop:1. Stops then only ever arrive as
+        # notifications, so a stop reply in a packet is the reply to a request, e.g. vStopped.
+        self.non_stop = False
+
         # Connect to gdbstub
         self._sock = socket.socket()
 
@@ -121,7 +198,7 @@ class GdbRsp():
         Receives packets from the target and queues packet data. If the read packet is a 
         stop packet, it goes into stop_queue. Otherwise, it goes in the read queue.
         """
-        recv_buf = b''
+        framer = PacketFramer()
 
         while True:
             if self._shutdown_flag:
@@ -134,59 +211,49 @@ class GdbRsp():
             if not events:
                 continue
 
-            self._sock_lock.acquire()  # pylint:disable=consider-using-with
-
-            # Read until we've read a checksum
-            while not re.search(self._checksum_pattern, recv_buf):
-                # It's possible to get stuck here if there is no checksum, e.g. if the remote
-                # side sends part of a packet and hangs. This is probably unlikely to happen
-                # and also not result in the remote closing the socket, in which case this
-                # stops blocking due to an exception.
+            with self._sock_lock:
                 try:
-                    recv_buf += self._sock.recv(1024)
+                    data = self._sock.recv(RECV_SIZE)
                 except ConnectionResetError:
-                    # If the other side closed the connection, it's time to shut down.
-                    self._shutdown_flag = True
-
-                # Ignore bare acknowledgements
-                if recv_buf == b'+':
-                    break
+                    data = b''
 
-                # Check periodically to see if close() was called. If it was, abort the
-                # current read and close this thread.
-                if self._shutdown_flag:
-                    self._sock_lock.release()
-                    return
+            # An empty read means the other side closed the connection, so it's time to shut down.
+            if not data:
+                self._shutdown_flag = True
+                return
 
-            self._sock_lock.release()
+            # The framer only scans the bytes it hasn't seen yet, and hands back every packet
+            # that was completed by this read - there can be several, or none.
+            for packet, checksum_ok, notification in framer.feed(data):
+                # Notifications are never acked, and the only one stubs send is a stop
+                if notification:
+                    _queue_notification(packet, checksum_ok, self.stop_queue.put)
+                    continue
 
-            try:
-                start, end = _get_first_packet_indices(recv_buf)
-            except GdbRspError:
-                # If _get_first_packet_indices threw this error, then either start or end
-                # could not be found. This means the data is a bare '+' ack, or it's corrupt.
-                # In either case, ignore it.
-                recv_buf = b''
-                continue
+                if not checksum_ok:
+                    logging.getLogger(__name__).debug(f"bad checksum on packet {packet}")
 
-            # Get the packet, then remove it from the buffer
-            packet = recv_buf[start:end]
-            recv_buf = recv_buf[end:]
+                    # Ask the stub to retransmit. Directly append to send queue, because the
+                    # nak doesn't need a checksum.
+                    if not self.no_ack_mode:
+                        self._send_queue.put(b'-')
+                        continue
 
-            # TODO: Check that the packet is one that we actually handle. Unrecognized packets
-            # should be ignored.
+                    # In no-ack mode there is no retransmit. Like GDB, pass the packet on anyway;
+                    # dropping it would leave whoever is waiting for the reply blocked forever.
+                    logging.getLogger(__name__).warning("bad checksum in no-ack mode, "
+                                                        f"using packet anyway: {packet}")
 
-            # OK is an acknolwedgement, and '' is an error. In both cases, don't ack.
-            if not packet == b'OK' or not packet == b'':
                 # Send an ack. Directly append to send queue, because ack doesn't need checksum
-                self._send_queue.put(b'+')
+                if not self.no_ack_mode:
+                    self._send_queue.put(b'+')
 
-            logging.getLogger(__name__).debug(f"received packet {packet}")
+                logging.getLogger(__name__).debug(f"received packet {packet}")
 
-            if _is_stop_packet(packet):
-                self.stop_queue.put(packet)
-            else:
-                self.read_queue.put(packet)
+                if _is_stop_packet(packet) and not self.non_stop:
+                    self.stop_queue.put(packet)
+                else:
+                    self.read_queue.put(packet)
 
     def close(self):
         """ Close connection to gdbstub, terminate read/write threads, and close selectors """
@@ -205,25 +272,71 @@ class GdbRsp():
         self._write_selector.close()
 
 
-def _get_first_packet_indices(data):
-    # It's possible that we read more than one packet from the socket. We need to
-    # get just the first one.
-    start = data.find(b'$')
+def _decode_packet_data(data):
+    """ Expand run-length encoding and undo '}' escapes in received packet data """
+    # Fast path, most packets are plain hex or text
+    if RLE_CHAR not in data and ESCAPE_CHAR not in data:
+        return data
+
+    # Run-length encoding is applied on top of the escaped data, so it has to be expanded
+    # first. 'X*n' means X followed by (ord(n) - 29) more copies of X. Whole runs of plain
+    # data between markers are copied with slices, so big replies aren't walked byte by byte.
+    expanded = bytearray()
+    pos = 0
+    star = data.find(RLE_CHAR)
+
+    while star != -1 and star + 1 < len(data):
+        expanded += data[pos:star]
+
+        if expanded:
+            expanded += expanded[-1:] * (data[star + 1] - 29)
+
+        pos = star + 2
+        star = data.find(RLE_CHAR, pos)
+
+    expanded += data[pos:]
 
-    # If we somehow don't have a packet start symbol - $ - then this is corrupt data.
-    # Ignore it.
-    if start == -1:
-        raise GdbRspError("Packet start marker not found")
+    # An escaped byte is sent as '}' followed by the original byte xor 0x20
+    decoded = bytearray()
+    pos = 0
+    escape = expanded.find(ESCAPE_CHAR)
 
-    end = data.find(b'#', start)
+    while escape != -1 and escape + 1 < len(expanded):
+        decoded += expanded[pos:escape]
+        decoded.append(expanded[escape + 1] ^ 0x20)
+        pos = escape + 2
+        escape = expanded.find(ESCAPE_CHAR, pos)
 
-    # This should never happen, because the recv function looks for the checksum when
-    # reading data. But for good measure, make sure it exists too.
-    if end == -1:
-        raise GdbRspError("Packet checksum not found")
+    decoded += expanded[pos:]
 
-    # Return start + 1 because that is the first character of the packet data
-    return start + 1, end
+    return bytes(decoded)
+
+def _frame_start(buf):
+    """ Find where the first packet or notification in the buffer starts, or -1 """
+    starts = [pos for pos in (buf.find(PACKET_START), buf.find(NOTIFICATION_START))
+              if pos != -1]
+
+    return min(starts, default=-1)
+
+def _queue_notification(packet, checksum_ok, put_stop):
+    """ Queue the stop reply a Stop notification carries, e.g. Stop:T05thread:p01.02;
+
+    :param bytes packet: the notification
+    :param bool checksum_ok: whether the checksum matched. There's no retransmit for
+    notifications, so a bad one is used anyway.
+    :param function put_stop: queues the stop reply
+    """
+    if not checksum_ok:
+        logging.getLogger(__name__).warning(f"bad checksum on notification {packet}")
+
+    name, _, stop = packet.partition(b':')
+
+    if name != b'Stop':
+        logging.getLogger(__name__).debug(f"ignoring notification {packet}")
+        return
+
+    logging.getLogger(__name__).debug(f"received stop notification {stop}")
+    put_stop(stop)
 
 def _make_checksum(data):
     checksum = sum(b for b in data) % 256
@@ -245,4 +358,16 @@ def _is_stop_packet(packet):
 
     stop_code = chr(packet[0])
 
-    return stop_code in ('S', 'T', 'W', 'X', 'w', 'N', 'O', 'F')
+    if stop_code not in ('S', 'T', 'W', 'X', 'w', 'N', 'O', 'F'):
+        return False
+
+    # Some replies to ordinary requests start with the same letters. qTStatus replies with
+    # 'T0;...' or 'T1;...', where a stop packet has a two digit signal number, and QTFrame
+    # replies with 'F<frame>T<tracepoint>' or 'F-1', where a File-I/O request has a call name.
+    if stop_code == 'T' and len(packet) > 1:
+        return _T_STOP_PACKET.match(packet) is not None
+
+    if stop_code == 'F' and len(packet) > 1:
+        return _FILE_IO_REQUEST.match(packet) is not None
+
+    return True
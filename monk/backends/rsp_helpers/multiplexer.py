@@ -0,0 +1,234 @@
+"""
+Lets many threads share one RSP connection, with several requests in flight at once.
+
+The gdbstub answers requests in the order it receives them, so a reply is matched to its
+request by position: requests are queued in the order they're sent, and each reply read off
+the connection resolves the oldest request that hasn't been answered yet.
+"""
+
+from collections import deque
+import threading
+import time
+import logging
+
+# Default number of requests a pipeline keeps in flight
+DEFAULT_PIPELINE_DEPTH = 32
+
+
+class PendingReply():
+    """ A reply to a request that has been sent, but possibly not received yet """
+    def __init__(self, mux, decode=None):
+        """
+        :param RspMultiplexer mux: the multiplexer the request was sent through
+        :param function decode: optional function to transform the raw reply with
+        """
+        self._mux = mux
+        self._decode = decode
+        self._reply = None
+        self.done = False
+
+    def _resolve(self, reply):
+        self._reply = reply
+        self.done = True
+
+    def result(self, timeout=None):
+        """ Wait for the reply
+
+        :param float timeout: how long to wait for the reply, or None to wait forever
+        :returns: the reply, passed through the decode function if one was given, or None
+        if the timeout expired
+        """
+        self._mux.wait_for(self, timeout)
+
+        if not self.done:
+            return None
+
+        if self._decode:
+            return self._decode(self._reply)
+
+        return self._reply
+
+
+class RspMultiplexer():
+    """ Thread-safe sharing of a RSP connection, correlating replies to requests by order
+
+    Sending only holds a lock long enough to queue the request and write the packet, so
+    threads don't wait on each other's round trips. Whichever waiting thread gets there first
+    reads replies off the connection and hands them out to their requesters, so no extra
+    thread is needed.
+    """
+    def __init__(self, rsp):
+        """
+        :param GdbRsp rsp: the connection to share
+        """
+        self._rsp = rsp
+        self._pending = deque()
+
+        # Keeps the order of _pending the same as the order packets went out on the wire
+        self._send_lock = threading.Lock()
+        # Guards _pending and _reading, and wakes up threads waiting for their replies
+        self._cond = threading.Condition()
+        # True while some thread is reading replies on behalf of everyone
+        self._reading = False
+
+    def request(self, packet, decode=None):
+        """ Send a packet that the stub will reply to, without waiting for the reply
+
+        :param bytes packet: the packet to send
+        :param function decode: optional function to transform the raw reply with
+        :rtype: PendingReply
+        :returns: the reply, once it arrives
+        """
+        pending = PendingReply(self, decode)
+
+        with self._send_lock:
+            with self._cond:
+                self._pending.append(pending)
+
+            self._rsp.send(packet)
+
+        return pending
+
+    def transact(self, packet, timeout=None, decode=None):
+        """ Send a packet and wait for the reply
+
+        :param bytes packet: the packet to send
+        :param float timeout: how long to wait for the reply, or None to wait forever
+        :param function decode: optional function to transform the raw reply with
+        :returns: the reply, or None if the timeout expired
+        """
+        return self.request(packet, decode).result(timeout)
+
+    def send(self, packet):
+        """ Send a packet that the stub will not reply to (e.g. vCont;c)
+
+        :param bytes packet: the packet to send
+        """
+        with self._send_lock:
+            self._rsp.send(packet)
+
+    def wait_for(self, pending, timeout=None):
+        """ Block until pending has been resolved, or the timeout expires
+
+        :param PendingReply pending: the reply to wait for
+        :param float timeout: how long to wait, or None to wait forever
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._cond:
+            while not pending.done:
+                if not self._reading:
+                    self._reading = True
+                    break
+
+                remaining = _remaining(deadline)
+
+                if remaining is not None and remaining <= 0:
+                    return
+
+                self._cond.wait(remaining)
+            else:
+                return
+
+        # This thread is now the reader. Read until our own reply turns up, resolving everyone
+        # else's along the way.
+        try:
+            while not pending.done:
+                remaining = _remaining(deadline)
+
+                if remaining is not None and remaining <= 0:
+                    return
+
+                reply = self._rsp.recv(timeout=remaining)
+
+                # Timed out. Our request stays queued so that if its reply turns up late, it
+                # doesn't get handed to the next request instead.
+                if reply is None:
+                    return
+
+                with self._cond:
+                    self._resolve_oldest(reply)
+                    self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._reading = False
+                self._cond.notify_all()
+
+    def _resolve_oldest(self, reply):
+        try:
+            oldest = self._pending.popleft()
+        except IndexError:
+            logging.getLogger(__name__).debug(f"dropping unsolicited reply {reply}")
+            return
+
+        oldest._resolve(reply)  # pylint:disable=protected-access
+
+
+class RspPipeline():
+    """ Keeps up to depth requests in flight, collecting the replies in request order
+
+    Used as a context manager; leaving the with block waits for every outstanding reply.
+
+        with target.pipeline() as p:
+            for addr in addrs:
+                p.request(b'm%x,4' % addr)
+
+        replies = p.results()
+    """
+    def __init__(self, mux, depth=DEFAULT_PIPELINE_DEPTH):
+        """
+        :param RspMultiplexer mux: the multiplexer to send requests through
+        :param int depth: the maximum number of requests in flight at once
+        """
+        self._mux = mux
+        self._depth = depth
+        self._replies = []
+        # Index of the oldest reply that might not have arrived yet
+        self._oldest = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.wait()
+
+    def request(self, packet, decode=None):
+        """ Send a packet, first waiting for the oldest reply if the pipeline is full
+
+        :param bytes packet: the packet to send
+        :param function decode: optional function to transform the raw reply with
+        :rtype: PendingReply
+        :returns: the reply, once it arrives
+        """
+        while len(self._replies) - self._oldest >= self._depth:
+            self._replies[self._oldest].result()
+            self._oldest += 1
+
+        pending = self._mux.request(packet, decode)
+        self._replies.append(pending)
+
+        return pending
+
+    def wait(self):
+        """ Wait for every outstanding reply """
+        for pending in self._replies[self._oldest:]:
+            pending.result()
+
+        self._oldest = len(self._replies)
+
+    def results(self):
+        """ Get every reply, in the order the requests were made
+
+        :rtype: list
+        :returns: the replies
+        """
+        self.wait()
+
+        return [pending.result() for pending in self._replies]
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+
+    return deadline - time.monotonic()
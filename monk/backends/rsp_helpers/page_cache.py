@@ -0,0 +1,165 @@
+"""
+Page-granular cache of target memory.
+
+Target memory can only change while the target runs, so anything read while it's stopped stays
+good until it's resumed. RspTarget fills the cache a page at a time and throws the whole thing
+away whenever it resumes the target. Each of those resumes starts a new epoch, so a page that
+was being fetched when the target resumed is never stored.
+"""
+
+from collections import OrderedDict
+import threading
+import logging
+
+# Bytes per cached page. Kept small enough to fit in a single m packet for QEMU's stub.
+DEFAULT_PAGE_SIZE = 1024
+# Maximum number of pages to cache before evicting the least recently used
+DEFAULT_CACHE_PAGES = 256
+
+
+class PageCache():
+    """ LRU cache of target memory pages, valid until invalidate() is called """
+    def __init__(self, max_pages=DEFAULT_CACHE_PAGES, page_size=DEFAULT_PAGE_SIZE):
+        """
+        :param int max_pages: the most pages to keep, or 0 to disable the cache
+        :param int page_size: the number of bytes in a page
+        """
+        self.max_pages = max_pages
+        self.page_size = page_size
+
+        # Page address to page contents, least recently used first
+        self._pages = OrderedDict()
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        """ Whether the cache holds anything at all """
+        return self.max_pages > 0
+
+    def read(self, addr, size, fetch):
+        """ Read memory through the cache
+
+        :param int addr: the address to read from
+        :param int size: the number of bytes to read
+        :param function fetch: called as fetch(addr, size) to read whole pages that aren't
+        cached, returning bytes
+        :rtype: bytes
+        :returns: the memory read
+        """
+        return self.read_many([(addr, size)],
+                              lambda runs: [fetch(a, s) for a, s in runs])[0]
+
+    def read_many(self, ranges, fetch_many):
+        """ Read several ranges of memory through the cache, fetching every missing page at once
+
+        :param list ranges: (address, size) of each range to read
+        :param function fetch_many: called as fetch_many(runs) with a list of (address, size)
+        runs of whole pages that aren't cached, returning a list of bytes, one per run
+        :rtype: list
+        :returns: the memory read for each range, in order
+        """
+        pages = {}
+        wanted = []
+
+        for addr, size in ranges:
+            wanted.extend(range(addr - addr % self.page_size, addr + size, self.page_size))
+
+        with self._lock:
+            epoch = self._epoch
+
+            for page_addr in wanted:
+                page = self._pages.get(page_addr)
+
+                if page is not None:
+                    self._pages.move_to_end(page_addr)
+                    pages[page_addr] = page
+
+        missing = sorted(set(wanted) - set(pages))
+
+        if missing:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        # Fetch runs of consecutive missing pages with one read each
+        runs = _runs(missing, self.page_size)
+
+        if runs:
+            for (run_start, run_len), data in zip(runs, fetch_many(runs)):
+                for offset in range(0, run_len, self.page_size):
+                    pages[run_start + offset] = data[offset:offset + self.page_size]
+
+            with self._lock:
+                # If the target was resumed while we were fetching, what we fetched is already
+                # out of date; return it to the caller, but don't keep it
+                if epoch == self._epoch:
+                    for page_addr in missing:
+                        self._store(page_addr, pages[page_addr])
+
+        return [self._assemble(pages, addr, size) for addr, size in ranges]
+
+    def _assemble(self, pages, addr, size):
+        first_page = addr - addr % self.page_size
+        data = b''.join(pages[a] for a in range(first_page, addr + size, self.page_size))
+        start = addr - first_page
+
+        return data[start:start + size]
+
+    def write(self, addr, data):
+        """ Update any cached pages with memory that was just written to the target
+
+        :param int addr: the address written to
+        :param bytes data: the bytes written
+        """
+        with self._lock:
+            for page_addr in range(addr - addr % self.page_size, addr + len(data),
+                                   self.page_size):
+                page = self._pages.get(page_addr)
+
+                if page is None:
+                    continue
+
+                start = max(addr, page_addr)
+                end = min(addr + len(data), page_addr + self.page_size)
+                page = bytearray(page)
+                page[start - page_addr:end - page_addr] = data[start - addr:end - addr]
+                self._pages[page_addr] = bytes(page)
+
+    def invalidate(self):
+        """ Throw away everything cached, because the target is about to run (or has run) """
+        with self._lock:
+            self._pages.clear()
+            self._epoch += 1
+
+        logging.getLogger(__name__).debug(f"memory cache invalidated, now epoch {self._epoch}")
+
+    def _store(self, page_addr, page):
+        self._pages[page_addr] = page
+        self._pages.move_to_end(page_addr)
+
+        while len(self._pages) > self.max_pages:
+            self._pages.popitem(last=False)
+
+
+def _runs(page_addrs, page_size):
+    """
+    Group sorted page addresses into runs of consecutive pages
+
+    :param list page_addrs: the page addresses, in ascending order
+    :param int page_size: the number of bytes in a page
+    :rtype: list
+    :returns: (start address, length in bytes) of each run
+    """
+    runs = []
+
+    for page_addr in page_addrs:
+        if runs and runs[-1][0] + runs[-1][1] == page_addr:
+            runs[-1][1] += page_size
+        else:
+            runs.append([page_addr, page_size])
+
+    return [tuple(run) for run in runs]
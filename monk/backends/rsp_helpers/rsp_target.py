@@ -2,16 +2,54 @@
 """
 
 import xml.etree.ElementTree as ET
+import bisect
 import threading
+import time
+from collections import deque
 from queue import Empty
-from time import sleep
 import signal
+import string
 import logging
 
 from monk.backends.rsp_helpers.gdbrsp import GdbRsp
+from monk.backends.rsp_helpers.async_gdbrsp import LoopGdbRsp
+from monk.backends.rsp_helpers.multiplexer import RspMultiplexer, RspPipeline, \
+    DEFAULT_PIPELINE_DEPTH
+from monk.backends.rsp_helpers.page_cache import PageCache, DEFAULT_CACHE_PAGES, \
+    DEFAULT_PAGE_SIZE
+from monk.backends.rsp_helpers.agent_expr import compile_condition, AgentExprError
+from monk.backends.rsp_helpers.breakpoints import BreakpointTable, SlotAllocator, BP_SW, BP_HW, \
+    WP_WRITE, WP_READ, WP_ACCESS, DEFAULT_HW_BREAKPOINT_SLOTS, DEFAULT_WATCHPOINT_SLOTS
+from monk.backends.rsp_helpers.tracepoints import Tracepoint, TraceStatus, TraceFrame, \
+    TracepointError, parse_frame_reply, memory_address
 from monk.utils.helpers import hexbyte, byte_order_int, hexaddr, hexval
 
-SMALL_DELAY = 0.0001
+# How long to wait for the stop packet after asking the target to step
+STEP_TIMEOUT = 1
+# The most steps step_until takes when it's single stepping
+DEFAULT_MAX_STEPS = 10000
+
+# The kind (i.e. length) sent with software breakpoint Z0/z0 packets
+SW_BREAKPOINT_KIND = 4
+# The kind sent with hardware breakpoint Z1/z1 packets, which QEMU ignores
+HW_BREAKPOINT_KIND = 0
+
+# Packet size to assume if the stub doesn't tell us its PacketSize. This is GDB's default.
+DEFAULT_PACKET_SIZE = 400
+
+# Number of trace frames to download with each pipeline
+DEFAULT_TRACE_BATCH = 64
+
+# Transports RspTarget can use to talk to the gdbstub. The threaded transport uses a read
+# thread and a write thread per connection; the asyncio one shares a single event loop thread
+# between every connection.
+TRANSPORT_THREADS = "threads"
+TRANSPORT_ASYNCIO = "asyncio"
+
+_transports = {
+    TRANSPORT_THREADS: GdbRsp,
+    TRANSPORT_ASYNCIO: LoopGdbRsp
+}
 
 
 class RspTargetError(Exception):
@@ -29,13 +67,143 @@ class StopReasons:
     hwbreak = "hwbreak"
     rwatch = "rwatch"
     wwatch = "wwatch"
+    awatch = "awatch"
+
+
+# The Z packet type of the watchpoint behind each watchpoint stop reason
+_watch_types = {
+    StopReasons.wwatch: WP_WRITE,
+    StopReasons.rwatch: WP_READ,
+    StopReasons.awatch: WP_ACCESS
+}
+
+# Keys in a T stop packet that say why the target stopped
+_stop_reason_keys = {
+    'swbreak': StopReasons.swbreak,
+    'hwbreak': StopReasons.hwbreak,
+    'watch': StopReasons.wwatch,
+    'rwatch': StopReasons.rwatch,
+    'awatch': StopReasons.awatch
+}
+
+
+class StopReply():
+    """A decoded stop reply packet, e.g. T05swbreak:;0f:00801000;thread:p01.01;
+    """
+    def __init__(self, signal_code=None, reason=None, watch_addr=None, thread=None,
+                 registers=None):
+        """
+        :param int signal_code: the signal the target stopped with
+        :param str reason: the StopReasons the target stopped for, if known
+        :param int watch_addr: the address that triggered a watchpoint
+        :param str thread: the thread id that stopped, e.g. 'p01.01'
+        :param dict registers: register index to hex value for the expedited registers
+        """
+        self.signal_code = signal_code
+        self.reason = reason
+        self.watch_addr = watch_addr
+        self.thread = thread
+        self.registers = registers or {}
+
+
+class RspCapabilities():
+    """What the gdbstub said it supports in its reply to qSupported, and the transfer sizes
+    that follow from that.
+    """
+    def __init__(self, features=None):
+        """
+        :param dict features: feature name to value, as returned by _parse_qsupported
+        """
+        self.features = features or {}
+
+    @classmethod
+    def from_qsupported(cls, reply):
+        """Build the capabilities from the stub's reply to qSupported
+
+        :param bytes reply: the qSupported reply
+        :rtype: RspCapabilities
+        """
+        return cls(_parse_qsupported(reply))
+
+    @property
+    def packet_size(self):
+        """The largest packet the stub will send or accept"""
+        try:
+            return int(self.features.get('PacketSize', ''), 16)
+        except ValueError:
+            return DEFAULT_PACKET_SIZE
+
+    @property
+    def no_ack(self):
+        """Whether the stub can turn off acks with QStartNoAckMode"""
+        return bool(self.features.get('QStartNoAckMode'))
+
+    @property
+    def swbreak(self):
+        """Whether the stub reports software breakpoint hits in its stop packets"""
+        return bool(self.features.get('swbreak'))
+
+    @property
+    def hwbreak(self):
+        """Whether the stub reports hardware breakpoint hits in its stop packets"""
+        return bool(self.features.get('hwbreak'))
+
+    @property
+    def conditional_breakpoints(self):
+        """Whether the stub can check agent expression conditions on breakpoints itself"""
+        return bool(self.features.get('ConditionalBreakpoints'))
+
+    @property
+    def conditional_tracepoints(self):
+        """Whether the stub can check agent expression conditions on tracepoints"""
+        return bool(self.features.get('ConditionalTracepoints'))
+
+    def supports_xfer(self, obj, operation='read'):
+        """Whether the stub supports qXfer for an object, e.g. 'features'
+
+        :param str obj: the object to transfer
+        :param str operation: 'read' or 'write'
+        :rtype: bool
+        """
+        return bool(self.features.get(f'qXfer:{obj}:{operation}'))
+
+    @property
+    def max_read_size(self):
+        """
+        The most bytes of memory that can be read with a single m packet. Memory is sent back
+        as hex, two characters per byte, and the packet framing takes up four more.
+        """
+        return max((self.packet_size - 4) // 2, 1)
+
+    def max_write_size(self, addr_size):
+        """
+        The most bytes of memory that can be written with a single M packet. Besides the
+        framing, the packet has to fit 'M', the address, a length of up to 8 hex digits, and
+        two separators before the hex data.
+
+        :param int addr_size: the number of bytes in the target's addresses
+        :rtype: int
+        """
+        header = 1 + addr_size * 2 + 1 + 8 + 1
+        return max((self.packet_size - 4 - header) // 2, 1)
+
+    @property
+    def xfer_chunk_size(self):
+        """
+        The most bytes to ask for with a single qXfer read. The reply has the framing plus
+        a one character 'm' or 'l' prefix.
+        """
+        return max(self.packet_size - 5, 1)
 
 
 # pylint: disable=too-many-instance-attributes
 class RspTarget():
     """RSP Target
     """
-    def __init__(self, host, port):
+    # pylint: disable=too-many-arguments
+    def __init__(self, host, port, transport=TRANSPORT_THREADS, cache_pages=DEFAULT_CACHE_PAGES,
+                 page_size=DEFAULT_PAGE_SIZE, hw_breakpoint_slots=DEFAULT_HW_BREAKPOINT_SLOTS,
+                 watchpoint_slots=DEFAULT_WATCHPOINT_SLOTS, non_stop=False):
         # THE ORDER IN WHICH THINGS ARE INITIALIZED IN THIS CONSTRUCTOR MATTERS.
         # Modify it at your own peril.
 
@@ -56,9 +224,8 @@ class RspTarget():
         self.on_write = lambda addr: addr
         self.on_access = lambda addr: addr
         self.on_execute = lambda addr: addr
-
-        # Gets set if a callback unsets the breakpoint that triggered it
-        self._callback_unset_bp = False
+        # Told how long handling each hook's stop took, once the target's resumed
+        self.on_resume = lambda dispatch, resume: None
 
         self._shutdown_flag = False  # Set by close() to tell event thread to terminate
         # Set by cmd_stop() to indicate that the user stopped execution, and so handling of a stop
@@ -66,37 +233,98 @@ class RspTarget():
         # execution of the guest in this state is cmd_continue()
         self._user_stopped = False
 
-        # To handle some weirdness with how breakpoints get set/unset when they're hit,
-        # this variable is used to store the most recently hit breakpoint address, so that
-        # it can be restored just before continuing execution again.
-        self._saved_bp = None
-
-        # This locks RSP so that multiple threads sharing the same RSP connection do not
-        # interleave their requests and subsequently receive a response not meant for them,
-        # or otherwise corrupt the communication. This lock should be acquired at the
-        # beginning of any RSP operation - e.g. reading memory - to ensure that both the
-        # command that's sent and the reply from the target (if any) are sent/received
-        # before any other thread is allowed to use the RSP connection.
-        self._rsp_lock = threading.Lock()
+        # The breakpoints the stub has inserted, so that setting one that's already there, or
+        # removing one that isn't, doesn't cost a packet. Breakpoints stay inserted across
+        # stops; the only one that has to come out is one at the pc we resume from.
+        self._breakpoints = BreakpointTable()
+        # The target's debug registers, which hardware breakpoints and watchpoints each need
+        # one of
+        self._hw_breakpoint_slots = SlotAllocator(hw_breakpoint_slots)
+        self._watchpoint_slots = SlotAllocator(watchpoint_slots)
+        # Agent expression bytecode the stub checks before stopping at each breakpoint, for the
+        # breakpoints that have conditions
+        self._bp_conditions = {}
+        # Tracepoint number to Tracepoint, for the tracepoints defined since the last QTinit.
+        # None until the first QTinit.
+        self._tracepoints = None
+        # The actions the stub supports in vCont packets, e.g. b'r' for range stepping. None
+        # until the stub's been asked.
+        self._vcont_actions = None
+
         # This lock is used around commands that execute or stop the target, so that the
         # target does not resume execution in the middle of event callbacks. This lock is
         # also picked up by the event thread when it begins processing a stop event.
         # Effectively this means that calls to cmd_continue and cmd_stop will block until
         # a callback is not running.
         self._event_lock = threading.Lock()
+        # Signalled, under the event lock, whenever the event thread finishes with a stop
+        # packet. A main thread step also waits on it for the event thread to hand over the
+        # stop packet the step produces.
+        self._event_cond = threading.Condition(self._event_lock)
+        # Set while a step from the main thread is waiting on its stop packet
+        self._awaiting_step = False
+        self._step_stop = None
+
+        # Whether the stub is in non-stop mode, where each thread (vCPU) stops and resumes on
+        # its own rather than the whole target at once, so a hook only stops the vCPU that hit
+        # it while the others carry on
+        self.non_stop = False
+        # Stop packets drained with vStopped that haven't been handled yet, in non-stop mode
+        self._queued_stops = deque()
+        # The threads that are stopped, in non-stop mode
+        self._stopped_threads = set()
+        # The thread being stepped, whose stop a step waits for in non-stop mode
+        self._step_thread = None
+
+        # What the stub reported it supports in its reply to qSupported. Until it's been
+        # asked, assume the defaults.
+        self.capabilities = RspCapabilities()
+
+        # Memory read while the target is stopped, thrown away whenever it resumes. Setting
+        # cache_pages to 0 turns caching off.
+        self.memory_cache = PageCache(cache_pages, page_size)
+        # Thread id to a dict of register number to hex value, filled from a single g packet
+        # the first time one of the thread's registers is read after a stop, and thrown away on
+        # resume. Each of an SMP guest's vCPUs is a thread.
+        self._reg_cache = {}
+        # Register number to hex value for the registers sent along with the last stop packet
+        self._expedited_regs = {}
+        self._reg_cache_lock = threading.Lock()
+        # The most recent stop packet, decoded
+        self.last_stop = None
+        # The thread the last stop was for, which is the one registers are read from unless
+        # another is asked for. None if the stub doesn't say.
+        self._stop_thread = None
+        # The thread the stub reads registers and memory from, set with Hg. Held while
+        # selecting a thread and using it, so other threads can't switch it in between.
+        self._selected_thread = None
+        self._selection_lock = threading.RLock()
 
         self._main_thread_id = threading.get_ident()
         # Thread to dispatch stop events. We don't start the thread yet because we don't want any
         # stop events to be handled until RspTarget is fully initialized.
         self._stop_events_thread = threading.Thread(target=self._handle_stop_packets)
 
-        self._rsp = GdbRsp(host, port)
+        try:
+            rsp_class = _transports[transport]
+        except KeyError as e:
+            raise RspTargetError(f"Unknown transport '{transport}'") from e
+
+        self._rsp = rsp_class(host, port)
+        # Every request to the stub goes through the multiplexer, so that multiple threads
+        # sharing the same RSP connection never receive a reply meant for someone else. It
+        # matches replies to requests by order, which also lets requests be pipelined.
+        self._mux = RspMultiplexer(self._rsp)
         self._clear_rsp()  # Clear out anything that might be in the recv buf
         # We have to figure out if the target is stopped before calling cmd_stop because cmd_stop
         # depends upon that flag.
         self.target_is_stopped = self._is_target_stopped()
         self.cmd_stop()
         self._negotiate_features()
+
+        if non_stop:
+            self._start_non_stop_mode()
+
         # reg_sizes is current unused, but might be useful for other CPUs
         self._reg_sizes, self._reg_map = self._get_reg_layout()
 
@@ -122,95 +350,293 @@ class RspTarget():
 
     def _negotiate_features(self):
         # Pretty likely we're saying we support stuff here that we don't
-        self._rsp.send(b'qSupported:multiprocess+;swbreak+;hwbreak+;qRelocInsn+;'
-                       b'fork-events+;exec-events+;vContSupported+;QThreadEvents+;'
-                       b'no-resumed+;xmlRegisters=i386')
-        self._rsp.recv()  # Don't care what the stub says it supports
+        self.capabilities = RspCapabilities.from_qsupported(self._mux.transact(
+            b'qSupported:multiprocess+;swbreak+;hwbreak+;qRelocInsn+;'
+            b'fork-events+;exec-events+;vContSupported+;QThreadEvents+;'
+            b'no-resumed+;xmlRegisters=i386'))
+
+        logging.getLogger(__name__).debug(f"stub packet size = {self.capabilities.packet_size}")
+
+        # Acks are pointless over a reliable connection like TCP, so turn them off if we can
+        if self.capabilities.no_ack:
+            self._start_no_ack_mode()
+
+    def _start_no_ack_mode(self):
+        """
+        Ask the stub to stop sending and expecting acks. The OK reply to QStartNoAckMode is
+        still acked by GdbRsp, which is what the protocol requires; everything after it isn't.
+        """
+        reply = self._mux.transact(b'QStartNoAckMode')
+
+        if reply == b'OK':
+            logging.getLogger(__name__).debug("no-ack mode enabled")
+            self._rsp.no_ack_mode = True
+
+    def _start_non_stop_mode(self):
+        """
+        Ask the stub for non-stop mode. The target was stopped in all-stop mode, so every
+        thread starts out stopped.
+
+        :raises RspTargetError: if the stub doesn't support it
+        """
+        reply = self._mux.transact(b'QNonStop:1')
+
+        if reply != b'OK':
+            self._rsp.close()
+            raise RspTargetError(f"Unable to start non-stop mode - target error '{reply}'")
+
+        logging.getLogger(__name__).debug("non-stop mode enabled")
+        self.non_stop = True
+        self._rsp.non_stop = True
+        self._stopped_threads.update(self.threads())
 
-    # pylint: disable=consider-using-with
     def _handle_stop_packets(self):
         """
-        Loop forever waiting for stop packets from the target
+        Loop forever waiting for stop packets from the target. This is the only reader of the
+        stop queue once RspTarget is initialized, apart from steps made by the event thread
+        itself. It blocks until a packet arrives, and close() wakes it up with None.
+
+        In non-stop mode the stub sends a notification for a stop, and the stops that follow
+        it are drained with vStopped; each one is dispatched for the thread that stopped.
         """
         while True:
-            if self._shutdown_flag:
+            packet = self._take_stop()
+            stopped_at = time.monotonic()
+
+            if packet is None or self._shutdown_flag:
                 return
 
-            self._event_lock.acquire()
+            stop = _parse_stop_packet(packet)
+
+            with self._event_cond:
+                # A step from the main thread is waiting for this packet; it's not an event
+                if self._awaiting_step and self._is_step_stop(stop):
+                    self._step_stop = packet
+                    self._awaiting_step = False
+                    self._event_cond.notify_all()
+                    continue
+
+                self._dispatch_stop(packet, stopped_at)
+                self._event_cond.notify_all()
+
+    def _is_step_stop(self, stop):
+        """
+        Whether a stop is the one a step is waiting for
+
+        :param StopReply stop: the stop
+        :rtype: bool
+        """
+        # A SIGINT stop is left alone, since it's from an earlier cmd_stop, not the step. In
+        # non-stop mode, so is a stop with no signal, which is how vCont;t stops are reported,
+        # and the stop has to be for the thread that was stepped.
+        # pylint: disable=no-member
+        if self.non_stop:
+            return stop.thread == self._step_thread and \
+                stop.signal_code not in (0, signal.SIGINT.value)
+
+        return stop.signal_code != signal.SIGINT.value
+
+    def _take_stop(self, thread=None, timeout=None):
+        """
+        Get the next stop packet, or the next one for a thread. Only the event thread calls
+        this. In non-stop mode, each notification is followed by draining the stub's other
+        stops with vStopped, and stops for threads other than the one asked for are queued
+        until they're asked for.
+
+        :param str thread: the thread to get a stop for, or None for any thread
+        :param float timeout: how long to wait, or None to wait forever
+        :returns: the stop packet, or None if none arrived in time or RspTarget is closing
+        """
+        for i, packet in enumerate(self._queued_stops):
+            if thread is None or _parse_stop_packet(packet).thread == thread:
+                del self._queued_stops[i]
+                return packet
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+
             try:
-                # This timeout must be kept short in order to avoid delaying other functions which
-                # require the event lock
-                packet = self._rsp.stop_queue.get(timeout=SMALL_DELAY)
+                packet = self._rsp.stop_queue.get(timeout=remaining)
             except Empty:
-                self._event_lock.release()
-                # We put a small sleep here in order to let other functions which require
-                # the event lock to pick it up before we try again. Technically things work
-                # without this, but main thread operations requiring the event lock will get
-                # starved and run much slower.
-                sleep(SMALL_DELAY)
-                continue
+                return None
+
+            # close() woke us up. Leave it for the event loop, in case this was a step.
+            if packet is None:
+                self._rsp.stop_queue.put(None)
+                return None
+
+            stops = [packet] + (self._drain_stops() if self.non_stop else [])
+
+            for i, stop in enumerate(stops):
+                if thread is None or _parse_stop_packet(stop).thread == thread:
+                    self._queued_stops.extend(stops[:i] + stops[i + 1:])
+                    return stop
 
-            # TODO: Since we track all of the breakpoints locally (in execution/control.py, because
-            # we have to in order to associate an address with its callbacks) we can probably skip
-            # checking what type of breakpoint/stop event we hit, and just dispatch the address to
-            # all of the handlers. It's simpler and likely more efficient than querying the stub.
+            self._queued_stops.extend(stops)
+
+    def _drain_stops(self):
+        """
+        Get the stops the stub has queued up behind a stop notification, in non-stop mode. The
+        stub won't send another notification until they've all been drained.
+
+        :rtype: list
+        :returns: the stop packets
+        """
+        stops = []
+        reply = self._mux.transact(b'vStopped')
 
-            # run() and stop() both have to be disabled while handling events. Running the guest
-            # will mess up the target state that the event handlers and user callbacks depend on.
-            # And stopping the guest again, while it's already stopped, will change the stop
-            # reason and subsequently change the handlers that get notified.
+        while reply and reply != b'OK' and not _is_error_reply(reply):
+            stops.append(reply)
+            reply = self._mux.transact(b'vStopped')
+
+        return stops
+
+    def _dispatch_stop(self, packet, stopped_at=None):
+        """
+        Handle a stop event: call the event handler for the reason the target stopped, then
+        continue the target. Called by the event thread with the event lock held. Once it's
+        continued, on_resume is told how long it took to get to the handler, and from the
+        handler returning to the target running again.
+
+        :param bytes packet: the stop packet
+        :param float stopped_at: when the event thread picked up the packet, in
+        time.monotonic() seconds
+        """
+        if stopped_at is None:
+            stopped_at = time.monotonic()
+
+        dispatched_at = None
+
+        # run() and stop() both have to be disabled while handling events. Running the guest
+        # will mess up the target state that the event handlers and user callbacks depend on.
+        # And stopping the guest again, while it's already stopped, will change the stop
+        # reason and subsequently change the handlers that get notified. In non-stop mode only
+        # the thread that stopped is stopped, and the others have been changing memory.
+        if self.non_stop:
+            self.memory_cache.invalidate()
+        else:
             logging.getLogger(__name__).debug("_handle_stop_packet target_is_stopped = True")
             self.target_is_stopped = True
-            logging.getLogger(__name__).debug("_handle_stop_packet()")
-            logging.getLogger(__name__).debug("getting stop reason...")
-            bp_type = self._get_stop_reason(packet)
-            logging.getLogger(__name__).debug(f"stop reason = {bp_type}")
-
-            logging.getLogger(__name__).debug("determining event handler...")
-            # Call the appropriate event handler for the type of breakpoint encountered.
-            # The event handlers are overridden by control.hooks
-            if bp_type == StopReasons.swbreak:
-                logging.getLogger(__name__).debug("getting pc...")
-                addr = self.read_register('pc')
-                logging.getLogger(__name__).debug(f"pc = {addr}")
-
-                # If the callback unsets the breakpoint for the current address, this will get set
-                self._callback_unset_bp = False
-                logging.getLogger(__name__).debug("got swbreak, removing breakpoint")
-
-                # Try to remove the breakpoint at the current address; if it fails, the target
-                # probably already removed it for us. We have to remove the breakpoint, step,
-                # and then set the breakpoint again because otherwise when we continue the target
-                # will immediately hit the breakpoint again without executing.
-                # TODO: We can remove this now, we don't set our breakpoints to persist w/ the stub.
-                try:
-                    self.remove_sw_breakpoint(addr)
-                except RspTargetError:
-                    pass
-
-                logging.getLogger(__name__).debug("calling on_execute")
-                self.on_execute(addr)
 
-                # XXX The callback may have unset this breakpoint. We don't want to set it again
-                # in that case.
-                if not self._callback_unset_bp:
-                    logging.getLogger(__name__).debug("saving breakpoint to re-set before"
-                                                      "execution continues")
-                    # When cmd_continue gets called at the end of the event loop, it will
-                    # check to see if there's a saved_bp and re-set it before it continues
-                    self._saved_bp = addr
+        logging.getLogger(__name__).debug("_handle_stop_packet()")
+        # Everything we need to dispatch the stop is in the stop packet itself, so there's
+        # no need to ask the stub for anything more
+        stop = self._record_stop(packet)
+        bp_type = stop.reason
+        logging.getLogger(__name__).debug(f"stop reason = {bp_type}")
+
+        logging.getLogger(__name__).debug("determining event handler...")
+        # Call the appropriate event handler for the type of breakpoint encountered.
+        # The event handlers are overridden by control.hooks
+        if bp_type in (StopReasons.swbreak, StopReasons.hwbreak):
+            logging.getLogger(__name__).debug("getting pc...")
+            addr = self.read_register('pc')
+            logging.getLogger(__name__).debug(f"pc = {addr}")
+
+            # The breakpoint stays inserted. If it's still there when we continue, cmd_continue
+            # steps over it first.
+            logging.getLogger(__name__).debug("calling on_execute")
+            dispatched_at = time.monotonic()
+            self.on_execute(addr)
+        elif bp_type in _watch_types:
+            addr = self._watchpoint_hit(_watch_types[bp_type], stop.watch_addr)
+            logging.getLogger(__name__).debug(f"{bp_type} at {addr}")
+
+            if addr is not None:
+                handlers = {
+                    StopReasons.wwatch: self.on_write,
+                    StopReasons.rwatch: self.on_read,
+                    StopReasons.awatch: self.on_access
+                }
+                dispatched_at = time.monotonic()
+                handlers[bp_type](addr)
+
+        # TODO: If we step, will it trigger a swbreak if we hit a breakpoint, or do we need to
+        # manually check for callbacks at that address?
+        else:
+            logging.getLogger(__name__).debug("unrecognized stop reason")
 
-            # TODO: If we step, will it trigger a swbreak if we hit a breakpoint, or do we need to
-            # manually check for callbacks at that address?
-            else:
-                logging.getLogger(__name__).debug("unrecognized stop reason")
+        handled_at = time.monotonic()
 
-            # Invoking continue here assumes that we'll never have a stop packet queued at
-            # this point. We could check...
+        # Invoking continue here assumes that we'll never have a stop packet queued at
+        # this point. We could check...
+        if self.non_stop:
+            self._continue_thread(stop.thread)
+        else:
             self.cmd_continue()
 
-            self._event_lock.release()
-            logging.getLogger(__name__).debug("finished handling event")
+        if dispatched_at is not None:
+            self.on_resume(dispatched_at - stopped_at, time.monotonic() - handled_at)
+
+        logging.getLogger(__name__).debug("finished handling event")
+
+    def _continue_thread(self, thread):
+        """
+        Resume the thread a stop event was for, in non-stop mode, leaving the others as they
+        are. Called by the event thread with the event lock held.
+
+        :param str thread: the thread
+        """
+        # The user stopped the target while the event was handled, so it stays stopped
+        if self._user_stopped or self._shutdown_flag:
+            return
+
+        if self._breakpoints_at_pc(thread):
+            self._single_step(False, thread)
+
+        self._resume(b'c', thread)
+        self._invalidate_caches(thread)
+
+    def _record_stop(self, packet):
+        """
+        Decode a stop packet and keep the registers the stub sent along with it
+
+        :param bytes packet: the stop packet
+        :rtype: StopReply
+        :returns: the decoded packet
+        """
+        stop = _parse_stop_packet(packet)
+        self.last_stop = stop
+
+        with self._reg_cache_lock:
+            self._expedited_regs = stop.registers
+
+        # The stub switches to the thread that stopped, except in non-stop mode
+        if stop.thread is not None:
+            with self._selection_lock:
+                self._stop_thread = stop.thread
+
+                if self.non_stop:
+                    self._stopped_threads.add(stop.thread)
+                else:
+                    self._selected_thread = stop.thread
+
+        return stop
+
+    def _watchpoint_hit(self, z_type, watch_addr):
+        """
+        Work out which watchpoint a watchpoint stop was for. Stubs report the address that was
+        accessed, which can be anywhere in the watched range, so it's matched against the
+        watchpoints that are inserted. Hooks are registered at the start of the range.
+
+        :param int z_type: the Z packet type of the watchpoint, e.g. WP_WRITE
+        :param int watch_addr: the address the stop packet reported, or None if it didn't
+        :rtype: int
+        :returns: the address of the watchpoint, or None if it can't be worked out
+        """
+        watchpoints = self._breakpoints.inserted(z_type)
+
+        if watch_addr is None:
+            # Without an address, only a lone watchpoint can be the one that was hit
+            return watchpoints[0][1] if len(watchpoints) == 1 else None
+
+        for _, addr, size in watchpoints:
+            if addr <= watch_addr < addr + size:
+                return addr
+
+        return watch_addr
 
     def _is_target_stopped(self):
         """
@@ -220,7 +646,7 @@ class RspTarget():
         impact. Instead, RspTarget keeps track of whether or not the target is running as 
         it receives notification packets and sends commands from/to the target.
         """
-        self._rsp.send(b'?')
+        self._mux.send(b'?')
 
         try:
             reply = self._rsp.stop_queue.get(timeout=1)
@@ -233,16 +659,20 @@ class RspTarget():
         # The ? query receives a stop reason if the target is stopped, or nothing if not.
         if reply:
             is_stopped = True
+            # Keep it, so we know which thread stopped from the start
+            self._record_stop(reply)
 
         logging.getLogger(__name__).debug(f"_is_target_stopped returning {is_stopped}")
 
         return is_stopped
 
-    def read_register(self, regname):
+    def read_register(self, regname, thread=None):
         """
         Read target register
 
         :param str regname: The register to read
+        :param str thread: the thread (vCPU) to read it from, e.g. 'p01.02', or None for the
+        one that stopped
         :return: The register value
         :raises RspTargetError: if the register is not successfully read
         """
@@ -260,24 +690,30 @@ class RspTarget():
             if raise_err:
                 raise RspTargetError(f"Unable to read register '{regname}': register unknown")
 
-        with self._rsp_lock:
-            self._rsp.send(b'p%s' % hexbyte(regnum))
-            response = self._rsp.recv()
+        thread = thread or self._stop_thread
+        response = self._cached_register(regnum, thread)
+
+        # Not every register is in the g packet, so fall back to asking for it on its own
+        if response is None:
+            with self._selection_lock:
+                self._select_thread(thread)
+                response = self._mux.transact(b'p%s' % hexbyte(regnum))
 
-        if _is_error_reply(response):
-            raise RspTargetError(f"Unable to read register '{regname}' with index "
-                                 f"{regnum}, received error '{response}'")
+            if _is_error_reply(response):
+                raise RspTargetError(f"Unable to read register '{regname}' with index "
+                                     f"{regnum}, received error '{response}'")
 
         response = byte_order_int(response, self.endian)
 
         return response
 
-    def write_register(self, regname, val):
+    def write_register(self, regname, val, thread=None):
         """
         Write target register
 
         :param str regname: The register to write
         :param int val: The value to write
+        :param str thread: the thread (vCPU) to write it in, or None for the one that stopped
         :raises RspTargetError: if the register is not successfully written
         """
         raise_err = False
@@ -290,14 +726,127 @@ class RspTarget():
         if raise_err:
             raise RspTargetError(f"Failed to write register '{regname}': register unknown")
 
-        with self._rsp_lock:
-            self._rsp.send(b'P%s=%s' % (hexbyte(regnum), hexbyte(val)))
-            response = self._rsp.recv()
+        thread = thread or self._stop_thread
+
+        with self._selection_lock:
+            self._select_thread(thread)
+            response = self._mux.transact(b'P%s=%s' % (hexbyte(regnum), hexbyte(val)))
 
         if not b'OK' in response:
             raise RspTargetError(f"Failed to write register '{regname}' with value "
                                  f"{hex(val)}: target error")
 
+        with self._reg_cache_lock:
+            if thread == self._stop_thread:
+                self._expedited_regs.pop(regnum, None)
+
+            self._reg_cache.get(thread, {}).pop(regnum, None)
+
+    def _cached_register(self, regnum, thread):
+        """
+        Get a register's value from the register cache, reading every register of the thread
+        with one g packet if this is the first of its registers read since the target stopped.
+
+        :param int regnum: the register's index
+        :param str thread: the thread to read it from, or None if the stub doesn't do threads
+        :rtype: bytes
+        :return: the register's value as hex, or None if it isn't in the cache
+        """
+        # In non-stop mode, a thread that stopped for a hook has its registers cached even
+        # though the others are running
+        if not self.target_is_stopped and thread not in self._stopped_threads:
+            return None
+
+        # Holding the lock while the g packet goes out means callbacks reading registers at
+        # the same time wait for the one g packet rather than each sending their own
+        with self._reg_cache_lock:
+            if thread == self._stop_thread and regnum in self._expedited_regs:
+                return self._expedited_regs[regnum]
+
+            if thread not in self._reg_cache:
+                self._reg_cache[thread] = self._read_all_registers(thread)
+
+            return self._reg_cache[thread].get(regnum)
+
+    def _read_all_registers(self, thread=None):
+        """
+        Read the registers covered by the g packet
+
+        :param str thread: the thread to read them from, or None for the selected one
+        :rtype: dict
+        :return: register index to hex value
+        """
+        with self._selection_lock:
+            self._select_thread(thread)
+            reply = self._mux.transact(b'g')
+
+        if not reply or _is_error_reply(reply):
+            logging.getLogger(__name__).debug(f"g packet failed: '{reply}'")
+            return {}
+
+        return _split_g_packet(reply, self._reg_sizes, self._reg_map)
+
+    def _invalidate_caches(self, thread=None):
+        """
+        Throw away cached memory and registers, because the target has been resumed
+
+        :param str thread: the thread that was resumed, in non-stop mode, or None if the whole
+        target was
+        """
+        self.memory_cache.invalidate()
+
+        with self._reg_cache_lock:
+            if thread is None:
+                self._reg_cache = {}
+                self._expedited_regs = {}
+                return
+
+            self._reg_cache.pop(thread, None)
+
+            if thread == self._stop_thread:
+                self._expedited_regs = {}
+
+    def _select_thread(self, thread):
+        """
+        Point the stub at a thread with Hg, so registers and memory are read from it, unless
+        it's already selected. Call it with the selection lock held, and keep holding it while
+        using the thread.
+
+        :param str thread: the thread, or None to leave the selection alone
+        :raises RspTargetError: if the stub refused
+        """
+        if thread is None or thread == self._selected_thread:
+            return
+
+        reply = self._mux.transact(b'Hg%s' % thread.encode('utf-8'))
+
+        if reply != b'OK':
+            raise RspTargetError(f"Unable to select thread '{thread}' - target error '{reply}'")
+
+        self._selected_thread = thread
+
+    def threads(self):
+        """
+        Ask the stub for its threads. On an SMP guest, each vCPU is a thread.
+
+        :rtype: list
+        :returns: the thread ids, e.g. ['p01.01', 'p01.02']
+        """
+        threads = []
+        reply = self._mux.transact(b'qfThreadInfo')
+
+        # Each reply starting with 'm' has more ids, 'l' means that's all of them
+        while reply and reply.startswith(b'm'):
+            threads += reply[1:].decode('utf-8').split(',')
+            reply = self._mux.transact(b'qsThreadInfo')
+
+        return threads
+
+    @property
+    def stop_thread(self):
+        """The thread (vCPU) the target last stopped for, or None if the stub doesn't say"""
+        return self._stop_thread
+
     def read_memory(self, addr, size):
         """
         Read target memory
@@ -309,13 +858,122 @@ class RspTarget():
         """
         # Make the bold assumption that this is never going to be called for anything
         # bigger than an int, so we can return an int.
-        with self._rsp_lock:
-            self._rsp.send(b'm%s,%d' % (hexaddr(addr, self.addr_size), size))
-            reply = self._rsp.recv()
+        return int.from_bytes(self.read_bytes(addr, size), self.endian)
+
+    def read_bytes(self, addr, size):
+        """
+        Read a range of target memory. While the target is stopped, reads go through the
+        memory cache, so memory that was read since the target last ran doesn't get read again.
+
+        :param int addr: The memory address to read from
+        :param int size: The number of bytes to read
+        :rtype: bytes
+        :return: the memory read
+        :raises RspTargetError: if the target fails to read any part of the range
+        """
+        return self.read_many([(addr, size)])[0]
+
+    def read_many(self, ranges):
+        """
+        Read several ranges of target memory at once. Ranges that touch or overlap are merged
+        so they're read together, and every read is pipelined, so the whole lot costs about
+        one round trip.
+
+        :param list ranges: (address, size) of each range to read
+        :rtype: list
+        :return: the bytes read for each range, in the same order as ranges
+        :raises RspTargetError: if the target fails to read any part of any range
+        """
+        spans = _merge_ranges(ranges)
+
+        if not self.memory_cache.enabled or not self.target_is_stopped:
+            span_data = self._read_spans_uncached(spans)
+        else:
+            try:
+                span_data = self.memory_cache.read_many(spans, self._read_spans_uncached)
+            except RspTargetError:
+                # The rest of a page isn't necessarily readable just because the part we want is
+                logging.getLogger(__name__).debug("unable to read whole pages, reading without "
+                                                  "the cache")
+                span_data = self._read_spans_uncached(spans)
+
+        span_starts = [start for start, _ in spans]
+        results = []
+
+        for addr, size in ranges:
+            i = bisect.bisect_right(span_starts, addr) - 1
+            offset = addr - span_starts[i]
+            results.append(span_data[i][offset:offset + size])
+
+        return results
+
+    def _read_spans_uncached(self, spans):
+        """
+        Read ranges of target memory from the stub. Ranges bigger than fit in one packet are
+        split up, and the pieces of every range are sent down a single pipeline.
+
+        :param list spans: (address, size) of each range to read
+        :rtype: list
+        :return: the bytes read for each range
+        :raises RspTargetError: if the target fails to read any part of any range
+        """
+        chunk_size = self.capabilities.max_read_size
+        chunks = []
+
+        # Memory is read through the vCPU that stopped, whose page tables are the ones in use
+        with self._selection_lock, self.pipeline() as p:
+            self._select_thread(self._stop_thread)
+
+            for span, (addr, size) in enumerate(spans):
+                for offset in range(0, size, chunk_size):
+                    chunks.append((span, addr + offset))
+                    p.request(b'm%s,%x' % (hexaddr(addr + offset, self.addr_size),
+                                           min(chunk_size, size - offset)))
+
+        data = [bytearray() for _ in spans]
+
+        for (span, chunk_addr), reply in zip(chunks, p.results()):
+            if not reply or _is_error_reply(reply):
+                raise RspTargetError(f"Unable to read memory at address {hex(chunk_addr)}, "
+                                     f"received error '{reply}'")
+
+            data[span] += bytes.fromhex(reply.decode())
+
+        for (addr, size), span_data in zip(spans, data):
+            if len(span_data) != size:
+                raise RspTargetError(f"Short read of memory at address {hex(addr)}: got "
+                                     f"{len(span_data)} of {size} bytes")
+
+        return [bytes(span_data) for span_data in data]
+
+    def write_bytes(self, addr, data):
+        """
+        Write a range of target memory. Like read_bytes, ranges bigger than fit in one packet
+        are split up and the pieces are pipelined.
+
+        :param int addr: The memory address to write to
+        :param bytes data: The bytes to write
+        :raises RspTargetError: if the target fails to write any part of the range
+        """
+        chunk_size = self.capabilities.max_write_size(self.addr_size)
+        offsets = range(0, len(data), chunk_size)
+
+        with self._selection_lock, self.pipeline() as p:
+            self._select_thread(self._stop_thread)
 
-        reply = byte_order_int(reply, self.endian)
+            for offset in offsets:
+                chunk = data[offset:offset + chunk_size]
+                p.request(b'M%s,%x:%s' % (hexaddr(addr + offset, self.addr_size), len(chunk),
+                                          chunk.hex().encode('utf-8')))
 
-        return reply
+        for offset, reply in zip(offsets, p.results()):
+            if reply != b'OK':
+                # Some of the range may have been written, so none of the cache can be trusted
+                self.memory_cache.invalidate()
+                raise RspTargetError(f"Failed to write memory at address {hex(addr + offset)}, "
+                                     f"received error '{reply}'")
+
+        self.memory_cache.write(addr, data)
 
     def write_memory(self, addr, val, size):
         """Write to memory
@@ -324,14 +982,30 @@ class RspTarget():
         :param int val: the value to write
         :param int size: the number of bytes to write
         """
-        with self._rsp_lock:
-            self._rsp.send(b'M%s,%d,%s' %
-                           (hexaddr(addr, self.addr_size), size, hexval(val, size * 2)))
-            reply = self._rsp.recv()
+        data = hexval(val, size * 2)
+
+        with self._selection_lock:
+            self._select_thread(self._stop_thread)
+            reply = self._mux.transact(b'M%s,%d,%s' % (hexaddr(addr, self.addr_size), size,
+                                                       data))
 
         if not b'OK' in reply:
             raise RspTargetError(f"Failed to write memory at address {hex(addr)}")
 
+        self.memory_cache.write(addr, bytes.fromhex(data.decode()))
+
+    def pipeline(self, depth=DEFAULT_PIPELINE_DEPTH):
+        """
+        Get a pipeline for sending many requests without waiting a round trip for each one.
+        Replies are matched to requests by order. Other threads can keep using the target
+        while a pipeline is in use.
+
+        :param int depth: the maximum number of requests in flight at once
+        :rtype: RspPipeline
+        :returns: the pipeline, to be used as a context manager
+        """
+        return RspPipeline(self._mux, depth)
+
     def _guard_execution(self, cmd_str):
         """
         Guard target execution against running from user callbacks or calling execution
@@ -364,15 +1038,35 @@ class RspTarget():
     # pylint: disable=consider-using-with
     def _acquire_event_lock_on_empty_stop_queue(self):
         """
-        Ensures that at the time the event lock is acquired, the stop queue is empty
+        Ensures that at the time the event lock is acquired, the stop queue is empty, by
+        waiting for the event thread to finish with anything already queued
         """
-
         self._event_lock.acquire()
 
-        while not self._rsp.stop_queue.empty():
-            self._event_lock.release()
-            sleep(SMALL_DELAY)
-            self._event_lock.acquire()
+        while not self._rsp.stop_queue.empty() or self._queued_stops:
+            self._event_cond.wait()
+
+    def _wait_for_step_stop(self, is_main_thread, timeout=STEP_TIMEOUT):
+        """
+        Wait for the stop packet produced by a step. On the event thread we read it straight
+        off the stop queue, since nobody else does; on the main thread the event thread hands
+        it over. Either way the event lock is held. In non-stop mode it's the stop of the
+        thread that was stepped.
+
+        :param bool is_main_thread: whether this is the main thread
+        :param float timeout: how long to wait, or None to wait forever
+        :returns: the stop packet, or None if none arrived in time
+        """
+        if not is_main_thread:
+            return self._take_stop(self._step_thread if self.non_stop else None, timeout)
+
+        # Waiting releases the event lock so the event thread can hand the packet over
+        self._event_cond.wait_for(lambda: self._step_stop is not None, timeout=timeout)
+        packet = self._step_stop
+        self._awaiting_step = False
+        self._step_stop = None
+
+        return packet
 
     def cmd_step(self):
         """Send a step command to the target
@@ -382,42 +1076,212 @@ class RspTarget():
 
         is_main_thread = threading.get_ident() == self._main_thread_id
 
-        # Make sure the event loop isn't executing - there's a slight race condition between
-        # when the event is queued and when the event loop picks it up. Hopefully this isn't
-        # a problem.
-        # Narrator voice: it was. A small delay had to be added to the event loop to give this
-        # function a chance to pick up the event lock.
+        # Make sure the event loop isn't executing, and has handled any stop events that were
+        # pending before we step
         if is_main_thread:
-            # Make sure no stop events are pending that the event loop should process
             self._acquire_event_lock_on_empty_stop_queue()
 
-        with self._rsp_lock:
-            self._rsp.send(b'vCont;s')
+        try:
+            self._single_step(is_main_thread)
 
-            # # Wait for the stop packet to arrive; if we try to send commands before the target
-            # has stopped again, the target will ignore them.
-            # TODO: Figure out if we ever need the SIGINT stop packet that this generates - i.e.
-            # if stepping will also produce a SIGTRAP if it hits a software breakpoint, or not.
-            # If it won't produce a SIGTRAP, we need to push this stop event back into the
-            # queue so that it gets handled by the event loop.
-            try:
-                self._rsp.stop_queue.get(timeout=1)
-            except Empty:
-                pass  # Maybe?
+            # Run any callbacks for the new address
+            addr = self.read_register('pc')
+            self.on_execute(addr)
+        finally:
+            if is_main_thread:
+                self._event_lock.release()
+
+        logging.getLogger(__name__).debug("cmd_step finished")
+
+    def cmd_step_n(self, count):
+        """
+        Step the target by a number of instructions, recording the pc after each one. The
+        steps are taken back to back without running hooks, and the pc comes from the stop
+        packet when the stub sends it along, so each step costs a single round trip.
+
+        :param int count: the number of instructions to step
+        :rtype: list
+        :returns: the pc after each step
+        :raises RspTargetError: if the target doesn't stop after a step
+        """
+        return self._step_batch("step_n", lambda is_main_thread: self._step_while(
+            is_main_thread, lambda pc: False, count))
+
+    def cmd_step_until(self, until, max_steps=DEFAULT_MAX_STEPS):
+        """
+        Step the target until a condition on the pc holds, recording the pc after each step.
+        Like cmd_step_n, no hooks run.
+
+        An (start, end) range means stepping through the range: stepping stops as soon as the
+        pc is outside it. If the stub supports range stepping, it steps through the range
+        itself without stopping, so only the pc it leaves the range at is recorded, and
+        max_steps doesn't apply. To record every pc in the range, pass a function instead.
+
+        :param function|tuple until: a function that takes the pc and returns True to stop,
+        or an (start, end) range of addresses, end exclusive, to step through
+        :param int max_steps: the most instructions to single step
+        :rtype: list
+        :returns: the pc after each stop
+        :raises RspTargetError: if the target doesn't stop after a step
+        """
+        if callable(until):
+            return self._step_batch("step_until", lambda is_main_thread: self._step_while(
+                is_main_thread, until, max_steps))
+
+        start, end = until
 
-        # Run any callbacks for the new address
-        addr = self.read_register('pc')
-        self.on_execute(addr)
+        if self._supports_vcont_action(b'r'):
+            return self._step_batch("step_until", lambda is_main_thread: self._range_step(
+                is_main_thread, start, end))
 
-        if self._saved_bp:
-            logging.getLogger(__name__).debug("re-setting saved breakpoint")
-            self.set_sw_breakpoint(self._saved_bp)
-            self._saved_bp = None
+        return self._step_batch("step_until", lambda is_main_thread: self._step_while(
+            is_main_thread, lambda pc: not start <= pc < end, max_steps))
+
+    def _step_batch(self, cmd_str, steps):
+        """
+        Take a batch of steps with the event lock held the whole time, so no stop events get
+        handled in between
+
+        :param str cmd_str: the command, for errors
+        :param function steps: takes whether this is the main thread, takes the steps, and
+        returns the pcs
+        :rtype: list
+        """
+        if not self._guard_execution(cmd_str):
+            return []
+
+        is_main_thread = threading.get_ident() == self._main_thread_id
 
         if is_main_thread:
-            self._event_lock.release()
+            self._acquire_event_lock_on_empty_stop_queue()
 
-        logging.getLogger(__name__).debug("cmd_step finished")
+        try:
+            return steps(is_main_thread)
+        finally:
+            if is_main_thread:
+                self._event_lock.release()
+
+    def _step_while(self, is_main_thread, until, max_steps):
+        pcs = []
+
+        for _ in range(max_steps):
+            if self._single_step(is_main_thread) is None:
+                raise RspTargetError(f"The target didn't stop after a step, at step {len(pcs)}")
+
+            # Comes from the stop packet if the stub sent it along
+            pc = self.read_register('pc')
+            pcs.append(pc)
+
+            if until(pc):
+                break
+
+        return pcs
+
+    def _range_step(self, is_main_thread, start, end):
+        """
+        Step through a range with vCont;r. The stub may stop early inside the range, e.g. at a
+        breakpoint, in which case we step past the breakpoint and carry on.
+        """
+        pcs = []
+
+        while True:
+            if self._breakpoints_at_pc():
+                if self._single_step(is_main_thread) is None:
+                    raise RspTargetError("The target didn't stop after a step")
+            else:
+                if is_main_thread:
+                    self._awaiting_step = True
+
+                self._step_thread = self._stop_thread
+                self._resume(b'r%x,%x' % (start, end), self._stop_thread)
+                # The stub steps until the pc leaves the range, however long that takes
+                packet = self._wait_for_step_stop(is_main_thread, timeout=None)
+                self._invalidate_caches(self._step_thread if self.non_stop else None)
+                self._record_stop(packet)
+
+            pc = self.read_register('pc')
+            pcs.append(pc)
+
+            if not start <= pc < end:
+                return pcs
+
+    def _supports_vcont_action(self, action):
+        """
+        Whether the stub supports an action in vCont packets, asking it with vCont? the first
+        time
+
+        :param bytes action: the action, e.g. b'r'
+        :rtype: bool
+        """
+        if self._vcont_actions is None:
+            reply = self._mux.transact(b'vCont?')
+            self._vcont_actions = set(reply.split(b';')[1:]) if reply else set()
+
+        return action in self._vcont_actions
+
+    def _single_step(self, is_main_thread, thread=None):
+        """
+        Step the target by one instruction. If there's a breakpoint inserted at the pc, it's
+        taken out for the step and put back afterwards, otherwise the target would just stop
+        on it again without going anywhere. The event lock must be held.
+
+        In non-stop mode only the thread is stepped. The other threads keep running while the
+        breakpoint's out, so they can miss it.
+
+        :param bool is_main_thread: whether this is the main thread
+        :param str thread: the thread to step, or None for the one that stopped
+        :returns: the stop packet, or None if none arrived in time
+        """
+        thread = thread or self._stop_thread
+        breakpoints = self._breakpoints_at_pc(thread)
+        conditions = [self._bp_conditions.get(bp) for bp in breakpoints]
+
+        for z_type, addr, kind in breakpoints:
+            logging.getLogger(__name__).debug(f"stepping over breakpoint at {hex(addr)}")
+
+            try:
+                self._remove_breakpoint(z_type, addr, kind)
+            except RspTargetError:
+                pass
+
+        if is_main_thread:
+            self._awaiting_step = True
+
+        self._step_thread = thread
+        self._resume(b's', thread)
+
+        # Wait for the stop packet to arrive; if we try to send commands before the target
+        # has stopped again, the target will ignore them.
+        packet = self._wait_for_step_stop(is_main_thread)
+
+        # Stepping may have changed memory and registers
+        self._invalidate_caches(thread if self.non_stop else None)
+
+        if packet is not None:
+            self._record_stop(packet)
+
+        for (z_type, addr, kind), bp_conditions in zip(breakpoints, conditions):
+            self._insert_breakpoint(z_type, addr, kind, bp_conditions)
+
+        return packet
+
+    def _breakpoints_at_pc(self, thread=None):
+        """
+        Find the execution breakpoints, software or hardware, inserted at the pc. The pc isn't
+        read at all if there are no execution breakpoints.
+
+        :param str thread: the thread whose pc to check, or None for the one that stopped
+        :rtype: list
+        :returns: (Z packet type, address, kind) of each breakpoint at the pc
+        """
+        breakpoints = self._breakpoints.inserted(BP_SW) + self._breakpoints.inserted(BP_HW)
+
+        if not breakpoints:
+            return []
+
+        addr = self.read_register('pc', thread)
+
+        return [bp for bp in breakpoints if bp[1] == addr]
 
     def cmd_continue(self):
         """Send a continue command to the target
@@ -430,30 +1294,29 @@ class RspTarget():
         # un-setting user_stopped before (potentially) stepping, so that it will actually step
         self._user_stopped = False
 
-        if self._saved_bp:
-            # We have to step and set the breakpoint rather than issuing continue and
-            # then setting it because a) we could miss the breakpoint address in the
-            # time between when the target continues and we set the breakpoint, and b)
-            # also the target has to be stopped for us to set breakpoints.
-            logging.getLogger(__name__).debug("stepping before re-setting saved breakpoint")
-            # cmd_step will re-set the saved breakpoint as part of its logic, so no need
-            # to do it here
-            self.cmd_step()
-
         # Make sure the event loop isn't executing - there's a slight race condition between
         # when the event is queued and when the event loop picks it up. Hopefully this isn't
         # a problem.
         if is_main_thread:
-            self._event_lock.acquire()  # pylint: disable=consider-using-with
+            self._acquire_event_lock_on_empty_stop_queue()
+
+        try:
+            # Continuing from a breakpoint would stop on it again straight away, so step past
+            # it first. We step rather than removing it and setting it again after continuing,
+            # because the target has to be stopped to set breakpoints, and we'd miss any hits
+            # in between. In non-stop mode, that's every stopped thread that's on one.
+            for thread in sorted(self._stopped_threads) if self.non_stop else [None]:
+                if self._breakpoints_at_pc(thread):
+                    self._single_step(is_main_thread, thread)
 
-        with self._rsp_lock:
             self.target_is_stopped = False
             logging.getLogger(__name__).debug("Sending continue cmd")
-            self._rsp.send(b'vCont;c')
+            self._resume(b'c')
+            self._invalidate_caches()
             logging.getLogger(__name__).debug("Sent continue cmd")
-
-        if is_main_thread:
-            self._event_lock.release()
+        finally:
+            if is_main_thread:
+                self._event_lock.release()
 
     def cmd_stop(self):
         """Send a stop command to the target
@@ -467,71 +1330,195 @@ class RspTarget():
         if self.target_is_stopped:
             return
 
-        with self._event_lock, self._rsp_lock:
+        if self.non_stop:
+            self._stop_all_threads()
+            return
+
+        with self._event_lock:
             self.target_is_stopped = True
-            self._rsp.send(b'vCtrlC')
+            self._mux.send(b'vCtrlC')
 
         # TODO: Check for an error, and unset _user_stopped if it seems like the target didn't
         # actually stop. - How? QEMU doesn't send the OK reply that it's supposed to... do we get
         # a stop packet...?
 
-    def set_sw_breakpoint(self, addr):
-        """Set a software breakpoint
+    def _stop_all_threads(self):
+        """
+        Stop every thread with vCont;t, in non-stop mode. The stub reports each thread's stop
+        with a notification, which the event thread records. The main thread waits for them, so
+        the target's stopped by the time cmd_stop returns. A callback can't wait, because the
+        event thread is waiting on it, and it doesn't take the event lock for the same reason.
+
+        :raises RspTargetError: if the stub refused
+        """
+        self.target_is_stopped = True
+        wait = threading.get_ident() == self._main_thread_id and not self._shutdown_flag
+        threads = set(self.threads()) if wait else set()
+
+        reply = self._mux.transact(b'vCont;t')
+
+        if reply != b'OK':
+            raise RspTargetError(f"Unable to stop the target - target error '{reply}'")
+
+        if not wait:
+            return
+
+        with self._event_cond:
+            if not self._event_cond.wait_for(lambda: threads <= self._stopped_threads,
+                                             timeout=STEP_TIMEOUT):
+                logging.getLogger(__name__).warning("not every thread reported stopping: "
+                                                    f"{threads - self._stopped_threads}")
+
+    def _resume(self, action, thread=None):
+        """
+        Resume the target with a vCont action. In all-stop mode the whole target resumes, and
+        the stub doesn't reply until it stops again. In non-stop mode only the thread resumes,
+        or every thread if it's None, and the stub replies straight away.
+
+        :param bytes action: the action, e.g. b's' or b'r1000,2000'
+        :param str thread: the thread to resume in non-stop mode, or None for every thread
+        :raises RspTargetError: if the stub refused, in non-stop mode
+        """
+        packet = b'vCont;%s' % action
+
+        if not self.non_stop:
+            self._mux.send(packet)
+            return
+
+        if thread is None:
+            self._stopped_threads.clear()
+        else:
+            packet += b':%s' % thread.encode('utf-8')
+            self._stopped_threads.discard(thread)
+
+        reply = self._mux.transact(packet)
+
+        if reply != b'OK':
+            raise RspTargetError(f"Unable to resume the target with '{packet}' - target "
+                                 f"error '{reply}'")
+
+    def set_sw_breakpoint(self, addr, conditions=None):
+        """Set a software breakpoint. Setting it again with different conditions replaces them.
 
         :param int addr: the address of the breakpoint
+        :param list conditions: agent expressions for the stub to check, stopping only if one
+        of them holds; None to always stop
         :raises RspTargetError: if unable to set the breakpoint
         """
-        with self._rsp_lock:
-            self._rsp.send(b'Z0,%s,4' % hexaddr(addr, self.addr_size))
-            status = self._rsp.recv()
+        self._insert_breakpoint(BP_SW, addr, SW_BREAKPOINT_KIND, conditions)
 
-            logging.getLogger(__name__).debug(f"set_sw_breakpoint: status = {status}")
+    def set_hw_breakpoint(self, addr, conditions=None):
+        """Set a hardware breakpoint. Setting it again with different conditions replaces them.
 
-            if status != b'OK':
-                raise RspTargetError(f"Unable to set SW breakpoint - target error '{status}'")
+        :param int addr: the address for the hardware breakpoint
+        :param list conditions: agent expressions for the stub to check, stopping only if one
+        of them holds; None to always stop
+        :raises RspTargetError: if there's no debug register free, or the target refused
+        """
+        self._insert_breakpoint(BP_HW, addr, HW_BREAKPOINT_KIND, conditions)
 
-    def set_hw_breakpoint(self, addr):
-        """Set a hardware breakpoint
+    def set_exec_breakpoint(self, addr, hardware=False, conditions=None):
+        """
+        Set an execution breakpoint. A hardware breakpoint doesn't modify the target's memory,
+        but the target only has a few of them, so once they're all in use (or if the stub
+        refuses one) this falls back to a software breakpoint.
 
-        :param int addr: the address for the hardware breakpoint
+        :param int addr: the address of the breakpoint
+        :param bool hardware: whether to try a hardware breakpoint first
+        :param list conditions: agent expressions for the stub to check, stopping only if one
+        of them holds; None to always stop
         :raises RspTargetError: if unable to set the breakpoint
         """
-        with self._rsp_lock:
-            self._rsp.send(b'Z1,%s,0' % hexaddr(addr, self.addr_size))
-            status = self._rsp.recv()
+        if self._breakpoints.is_inserted(BP_HW, addr, HW_BREAKPOINT_KIND):
+            self.set_hw_breakpoint(addr, conditions)
+            return
 
-            # TODO: Can we move this and subsequent lines outside the lock?
-            logging.getLogger(__name__).debug(f"set_hw_breakpoint: status = {status}")
+        if hardware and not self._breakpoints.is_inserted(BP_SW, addr, SW_BREAKPOINT_KIND):
+            try:
+                self.set_hw_breakpoint(addr, conditions)
+                return
+            except RspTargetError as e:
+                logging.getLogger(__name__).debug(f"{e}, falling back to a software breakpoint")
 
-            if status != b'OK':
-                raise RspTargetError("Unable to set HW breakpoint - target error")
+        self.set_sw_breakpoint(addr, conditions)
+
+    def set_exec_breakpoints(self, breakpoints):
+        """
+        Set many execution breakpoints at once, e.g. on every function matching a pattern. The
+        Z packets are pipelined, so the lot costs about one round trip rather than one each.
+        They're software breakpoints, because there are never enough debug registers for a
+        batch, except where a hardware breakpoint is already set.
+
+        :param dict breakpoints: address to the conditions for the stub to check there, as for
+        set_exec_breakpoint, or None to always stop
+        :raises RspTargetError: if any of them couldn't be set. The rest are still set.
+        """
+        software = []
+
+        for addr, conditions in breakpoints.items():
+            if self._breakpoints.is_inserted(BP_HW, addr, HW_BREAKPOINT_KIND):
+                self.set_hw_breakpoint(addr, conditions)
+            else:
+                software.append((addr, SW_BREAKPOINT_KIND, conditions))
+
+        self._insert_breakpoints(BP_SW, software)
+
+    def remove_exec_breakpoints(self, addrs):
+        """
+        Remove many execution breakpoints at once, pipelining the z packets
+
+        :param iterable addrs: the addresses of the breakpoints
+        :raises RspTargetError: if the target returned an error code for any of them
+        """
+        software = []
+
+        for addr in addrs:
+            if self._breakpoints.is_inserted(BP_HW, addr, HW_BREAKPOINT_KIND):
+                self.remove_hw_breakpoint(addr)
+            else:
+                software.append((addr, SW_BREAKPOINT_KIND))
+
+        self._remove_breakpoints(BP_SW, software)
+
+    def compile_condition(self, cond):
+        """
+        Compile a condition into agent expression bytecode for the stub to check
+
+        :param Expr cond: the condition, from monk.conditions
+        :rtype: bytes
+        :raises RspTargetError: if the condition can't be expressed in bytecode
+        """
+        try:
+            return compile_condition(cond, self._reg_map)
+        except AgentExprError as e:
+            raise RspTargetError(f"Unable to compile condition {cond!r}: {e}") from e
 
     def set_write_watchpoint(self, addr, sz):
         """Set a write watchpoint
 
         :param int addr: the address of the watchpoint
         :param int sz: the size of memory to watch
+        :raises RspTargetError: if there's no debug register free, or the target refused
         """
-        with self._rsp_lock:
-            self._rsp.send(b'Z2,%s,%s' % (hexaddr(addr, self.addr_size), str(sz).encode('utf-8')))
+        self._insert_breakpoint(WP_WRITE, addr, sz)
 
     def set_read_watchpoint(self, addr, sz):
         """Set a read watchpoint
 
         :param int addr: the address of the watchpoint
         :param int sz: the size of memory to watch
+        :raises RspTargetError: if there's no debug register free, or the target refused
         """
-        with self._rsp_lock:
-            self._rsp.send(b'Z3,%s,%s' % (hexaddr(addr, self.addr_size), str(sz).encode('utf-8')))
+        self._insert_breakpoint(WP_READ, addr, sz)
 
     def set_access_watchpoint(self, addr, sz):
         """Set an access watchpoint
 
         :param int addr: the address of the watchpoint
         :param int sz: the size of memory to watch
+        :raises RspTargetError: if there's no debug register free, or the target refused
         """
-        with self._rsp_lock:
-            self._rsp.send(b'Z4,%s,%s' % (hexaddr(addr, self.addr_size), str(sz).encode('utf-8')))
+        self._insert_breakpoint(WP_ACCESS, addr, sz)
 
     def remove_sw_breakpoint(self, addr):
         """
@@ -541,67 +1528,426 @@ class RspTarget():
         :raises RspTargetError: if the target returns an error code
         """
         logging.getLogger(__name__).debug(f"rsp_target.remove_sw_breakpoint: {hex(addr)}")
-        with self._rsp_lock:
-            self._rsp.send(b'z0,%s,4' % hexaddr(addr, self.addr_size))
-            status = self._rsp.recv()
-
-        # If we're in a callback and we just unset the breakpoint at the current pc, we set
-        # a flag so that the event loop won't reset the current breakpoint before continuing
-        # target execution.
-        if threading.get_ident() != self._main_thread_id and \
-           threading.get_ident() != self._stop_events_thread.ident and \
-           addr == self.read_register('pc'):
-            self._callback_unset_bp = True
-
-        # In keeping with gdbstubs doing more or less whatever the heck they want, if removing
-        # a breakpoint results in an error from the target, it probably doesn't mean that removing
-        # the breakpoint actually failed. This is... neat, to say the least.
-        #
-        # I found some documentation on the internet that GDB apparently just ignores errors it
-        # gets from the target in basically all cases. I've made the decision to have this function
-        # raise the error, but at the backends/rsp.py interface I have it ignore the error. This
-        # makes it easy to propagate the errors up later if that seems wise.
-        #
-        # If this becomes onerous, it's fine to just choose to ignore the error here. There are
-        # plenty of places in RspTarget where we *could* look for error codes and we don't, anyway.
-
-        if status and chr(status[0]) == 'E':
-            raise RspTargetError(f"Unable to remove software breakpoint: {status}")
+        self._remove_breakpoint(BP_SW, addr, SW_BREAKPOINT_KIND)
 
     def remove_hw_breakpoint(self, addr):
         """Remove a hardware breakpoint
 
         :param int addr: the address of the breakpoint
+        :raises RspTargetError: if the target returns an error code
         """
-        with self._rsp_lock:
-            self._rsp.send(b'z1,%s,0' % hexaddr(addr, self.addr_size))
+        self._remove_breakpoint(BP_HW, addr, HW_BREAKPOINT_KIND)
+
+    def remove_exec_breakpoint(self, addr):
+        """Remove an execution breakpoint, whichever kind set_exec_breakpoint ended up setting
+
+        :param int addr: the address of the breakpoint
+        :raises RspTargetError: if the target returns an error code
+        """
+        if self._breakpoints.is_inserted(BP_HW, addr, HW_BREAKPOINT_KIND):
+            self.remove_hw_breakpoint(addr)
+        else:
+            self.remove_sw_breakpoint(addr)
 
     def remove_write_watchpoint(self, addr, sz):
         """Remove a write watchpoint
 
         :param int addr: the address of the write watchpoint
-        :param int sz: the size of the memory watched by the watchpoint?
+        :param int sz: the size of the memory watched by the watchpoint
+        :raises RspTargetError: if the target returns an error code
         """
-        with self._rsp_lock:
-            self._rsp.send(b'z2,%s,%s' % (hexaddr(addr, self.addr_size), str(sz).encode('utf-8')))
+        self._remove_breakpoint(WP_WRITE, addr, sz)
 
     def remove_read_watchpoint(self, addr, sz):
         """Remove a read watchpoint
 
         :param int addr: the address of the read watchpoint
-        :param int sz: the size of the memory watched by the watchpoint?
+        :param int sz: the size of the memory watched by the watchpoint
+        :raises RspTargetError: if the target returns an error code
         """
-        with self._rsp_lock:
-            self._rsp.send(b'z3,%s,%s' % (hexaddr(addr, self.addr_size), str(sz).encode('utf-8')))
+        self._remove_breakpoint(WP_READ, addr, sz)
 
     def remove_access_watchpoint(self, addr, sz):
         """Remove an access watchpoint
 
         :param int addr: the address of the watchpoint
-        :param int sz: size of the memory watched by the watchpoint?
+        :param int sz: the size of the memory watched by the watchpoint
+        :raises RspTargetError: if the target returns an error code
         """
-        with self._rsp_lock:
-            self._rsp.send(b'z4,%s,%s' % (hexaddr(addr, self.addr_size), str(sz).encode('utf-8')))
+        self._remove_breakpoint(WP_ACCESS, addr, sz)
+
+    def trace_init(self):
+        """
+        Clear the stub's tracepoints and trace buffer
+
+        :raises RspTargetError: if the stub doesn't support tracepoints
+        """
+        reply = self._mux.transact(b'QTinit')
+
+        if reply != b'OK':
+            raise RspTargetError(f"Unable to start a new trace - target error '{reply}'")
+
+        self._tracepoints = {}
+
+    def set_tracepoint(self, addr, capture, condition=None, pass_count=0):
+        """
+        Define a tracepoint. The stub collects what it's told to each time the target reaches
+        the address, without stopping it. Tracepoints can only be defined while the trace isn't
+        running, and don't do anything until it's started.
+
+        :param int addr: the address of the tracepoint
+        :param Capture capture: the registers and memory to collect. Memory addresses can be
+        constants, or a register plus or minus a constant.
+        :param bytes condition: agent expression the stub checks before collecting, or None
+        :param int pass_count: stop the trace after this many hits, or 0 to never stop
+        :rtype: int
+        :returns: the tracepoint's number
+        :raises RspTargetError: if the stub refused it, or it can't be expressed as actions
+        """
+        if condition is not None and not self.capabilities.conditional_tracepoints:
+            raise RspTargetError("The stub doesn't support conditional tracepoints")
+
+        if self._tracepoints is None:
+            self.trace_init()
+
+        tracepoint = Tracepoint(len(self._tracepoints) + 1, addr, capture, condition,
+                                pass_count)
+
+        try:
+            packets = tracepoint.packets(self._reg_map, self.addr_size)
+        except TracepointError as e:
+            raise RspTargetError(f"Unable to set tracepoint at {hex(addr)}: {e}") from e
+
+        with self.pipeline() as p:
+            for packet in packets:
+                p.request(packet)
+
+        for reply in p.results():
+            if reply != b'OK':
+                raise RspTargetError(f"Unable to set tracepoint at {hex(addr)} - target error "
+                                     f"'{reply}'")
+
+        self._tracepoints[tracepoint.number] = tracepoint
+
+        return tracepoint.number
+
+    def trace_start(self):
+        """
+        Start the trace. Tracepoints start collecting once the target's running.
+
+        :raises RspTargetError: if the stub refused
+        """
+        reply = self._mux.transact(b'QTStart')
+
+        if reply != b'OK':
+            raise RspTargetError(f"Unable to start the trace - target error '{reply}'")
+
+    def trace_stop(self):
+        """
+        Stop the trace. What's already been collected stays in the trace buffer.
+
+        :raises RspTargetError: if the stub refused
+        """
+        reply = self._mux.transact(b'QTStop')
+
+        if reply != b'OK':
+            raise RspTargetError(f"Unable to stop the trace - target error '{reply}'")
+
+    def trace_status(self):
+        """
+        Ask the stub how the trace is going
+
+        :rtype: TraceStatus
+        :raises RspTargetError: if the stub doesn't support tracepoints
+        """
+        reply = self._mux.transact(b'qTStatus')
+
+        if not reply or not reply.startswith(b'T'):
+            raise RspTargetError(f"Unable to get the trace status - target error '{reply}'")
+
+        return TraceStatus.from_reply(reply)
+
+    def trace_frames(self, batch=DEFAULT_TRACE_BATCH):
+        """
+        Download the trace buffer, a batch of frames per round trip. The target has to be
+        stopped. Between batches the stub is pointed back at the live target, so reading the
+        target while iterating reads the target, not the trace.
+
+        :param int batch: the number of frames to download at once
+        :rtype: iterator
+        :returns: a TraceFrame for each frame in the buffer, in order
+        :raises RspTargetError: if the target is running
+        """
+        if not self.target_is_stopped:
+            raise RspTargetError("The target has to be stopped to read the trace buffer")
+
+        first = 0
+
+        while True:
+            frames = self._read_trace_frames(first, batch)
+            yield from frames
+
+            if len(frames) < batch:
+                return
+
+            first += batch
+
+    def _read_trace_frames(self, first, count):
+        """
+        Download some trace frames: select each one and read its registers, then select each
+        one again and read the memory it collected, whose address can depend on those
+        registers. Both passes are pipelined.
+
+        :param int first: the number of the first frame
+        :param int count: the most frames to download
+        :rtype: list
+        :returns: a TraceFrame for each frame, stopping at the end of the buffer
+        """
+        names = {regnum: name for name, regnum in self._reg_map.items()}
+        tracepoints = self._tracepoints or {}
+        has_memory = any(tp.capture.memory for tp in tracepoints.values())
+
+        with self.pipeline() as p:
+            for number in range(first, first + count):
+                p.request(b'QTFrame:%x' % number)
+                p.request(b'g')
+
+            if not has_memory:
+                p.request(b'QTFrame:-1')
+
+        replies = p.results()
+        frames = []
+
+        for i in range(count):
+            selected = parse_frame_reply(replies[i * 2])
+
+            if selected is None:
+                break
+
+            regs = _split_g_packet(replies[i * 2 + 1], self._reg_sizes, self._reg_map)
+            registers = {names[regnum]: byte_order_int(value, self.endian)
+                         for regnum, value in regs.items()}
+            frames.append((selected, registers))
+
+        memory = self._read_trace_memory(frames) if has_memory else [[] for _ in frames]
+
+        return [TraceFrame(number, tp_number, getattr(tracepoints.get(tp_number), 'addr', None),
+                           registers, frame_memory)
+                for ((number, tp_number), registers), frame_memory in zip(frames, memory)]
+
+    def _read_trace_memory(self, frames):
+        """
+        Read the memory each trace frame's tracepoint collected, then point the stub back at
+        the live target
+
+        :param list frames: ((frame number, tracepoint number), registers) of each frame
+        :rtype: list
+        :returns: the ((address, size), bytes) of each range read, for each frame
+        """
+        chunk_size = self.capabilities.max_read_size
+        # The ranges to read for each frame
+        plans = []
+
+        with self.pipeline() as p:
+            for (number, tp_number), registers in frames:
+                tracepoint = self._tracepoints.get(tp_number)
+                ranges = []
+
+                for expr, size in tracepoint.capture.memory if tracepoint else ():
+                    try:
+                        ranges.append((memory_address(expr, registers), size))
+                    except KeyError:
+                        # The register it's relative to wasn't collected this time
+                        continue
+
+                plans.append(ranges)
+                p.request(b'QTFrame:%x' % number)
+
+                for addr, size in ranges:
+                    for offset in range(0, size, chunk_size):
+                        p.request(b'm%s,%x' % (hexaddr(addr + offset, self.addr_size),
+                                               min(chunk_size, size - offset)))
+
+            p.request(b'QTFrame:-1')
+
+        replies = iter(p.results())
+        memory = []
+
+        for ranges in plans:
+            next(replies)  # QTFrame
+            frame_memory = []
+
+            for addr, size in ranges:
+                chunks = [next(replies) for _ in range(0, size, chunk_size)]
+
+                # Ranges the stub didn't collect are left out, so reading them from the frame
+                # fails
+                if any(not chunk or _is_error_reply(chunk) for chunk in chunks):
+                    continue
+
+                frame_memory.append(((addr, size),
+                                     b''.join(bytes.fromhex(chunk.decode()) for chunk in chunks)))
+
+            memory.append(frame_memory)
+
+        return memory
+
+    def _debug_registers(self, z_type):
+        """
+        Get the debug registers a type of breakpoint uses
+
+        :param int z_type: the Z packet type
+        :rtype: SlotAllocator
+        :returns: the allocator for its debug registers, or None for software breakpoints
+        """
+        if z_type == BP_SW:
+            return None
+
+        if z_type == BP_HW:
+            return self._hw_breakpoint_slots
+
+        return self._watchpoint_slots
+
+    def _insert_breakpoint(self, z_type, addr, kind, conditions=None):
+        """
+        Send a Z packet for a breakpoint or watchpoint, unless it's already inserted with the
+        same conditions. Hardware ones have to get a debug register first.
+
+        :param int z_type: the Z packet type, e.g. BP_SW
+        :param int addr: the address of the breakpoint
+        :param int kind: the breakpoint's length, or the watchpoint's size
+        :param list conditions: agent expressions for the stub to check, or None
+        :raises RspTargetError: if there's no debug register free, or the target refused
+        """
+        self._insert_breakpoints(z_type, [(addr, kind, conditions)])
+
+    def _insert_breakpoints(self, z_type, breakpoints):
+        """
+        Insert many breakpoints or watchpoints of one type, pipelining their Z packets. Any
+        that fail don't stop the rest from being inserted.
+
+        :param int z_type: the Z packet type, e.g. BP_SW
+        :param iterable breakpoints: (address, kind, conditions) of each one, as for
+        _insert_breakpoint
+        :raises RspTargetError: if any of them couldn't be inserted
+        """
+        slots = self._debug_registers(z_type)
+        to_send = []
+        errors = []
+
+        for addr, kind, conditions in breakpoints:
+            holder = (z_type, addr, kind)
+            conditions = tuple(conditions or ())
+            was_inserted = self._breakpoints.is_inserted(z_type, addr, kind)
+
+            if was_inserted and self._bp_conditions.get(holder, ()) == conditions:
+                continue
+
+            if conditions and not self.capabilities.conditional_breakpoints:
+                errors.append("The stub doesn't support conditional breakpoints")
+                continue
+
+            if slots is not None and not slots.allocate(holder):
+                errors.append(f"Unable to set Z{z_type} at {hex(addr)} - all {slots.slots} "
+                              "debug registers are in use")
+                continue
+
+            to_send.append((holder, conditions, was_inserted))
+
+        with self.pipeline() as p:
+            for (_, addr, kind), conditions, _ in to_send:
+                packet = b'Z%d,%s,%x' % (z_type, hexaddr(addr, self.addr_size), kind)
+
+                # The stub replaces the conditions of a breakpoint that's inserted again
+                if conditions:
+                    packet += b';' + b''.join(b'X%x,%s' % (len(cond),
+                                                           cond.hex().encode('utf-8'))
+                                              for cond in conditions)
+
+                p.request(packet)
+
+        for (holder, conditions, was_inserted), status in zip(to_send, p.results()):
+            _, addr, kind = holder
+
+            logging.getLogger(__name__).debug(f"Z{z_type} {hex(addr)}: status = {status}")
+
+            # An empty reply means the stub doesn't support this type at all. An error usually
+            # means the target ran out of debug registers sooner than we thought it would.
+            if status != b'OK':
+                if slots is not None and not was_inserted:
+                    slots.release(holder)
+
+                errors.append(f"Unable to set Z{z_type} at {hex(addr)} - target error "
+                              f"'{status}'")
+                continue
+
+            self._breakpoints.insert(z_type, addr, kind)
+
+            if conditions:
+                self._bp_conditions[holder] = conditions
+            else:
+                self._bp_conditions.pop(holder, None)
+
+        if errors:
+            raise RspTargetError("; ".join(errors))
+
+    def _remove_breakpoint(self, z_type, addr, kind):
+        """
+        Send a z packet for a breakpoint or watchpoint, if it's inserted, and free its debug
+        register.
+
+        :param int z_type: the Z packet type, e.g. BP_SW
+        :param int addr: the address of the breakpoint
+        :param int kind: the breakpoint's length, or the watchpoint's size
+        :raises RspTargetError: if the target returns an error code
+        """
+        self._remove_breakpoints(z_type, [(addr, kind)])
+
+    def _remove_breakpoints(self, z_type, breakpoints):
+        """
+        Remove many breakpoints or watchpoints of one type, pipelining their z packets
+
+        :param int z_type: the Z packet type, e.g. BP_SW
+        :param iterable breakpoints: (address, kind) of each one
+        :raises RspTargetError: if the target returned an error code for any of them
+        """
+        # Nothing to do for the ones we never inserted, or already took out
+        to_send = [(addr, kind) for addr, kind in breakpoints
+                   if self._breakpoints.is_inserted(z_type, addr, kind)]
+        slots = self._debug_registers(z_type)
+
+        with self.pipeline() as p:
+            for addr, kind in to_send:
+                p.request(b'z%d,%s,%x' % (z_type, hexaddr(addr, self.addr_size), kind))
+
+        errors = []
+
+        for (addr, kind), status in zip(to_send, p.results()):
+            self._breakpoints.remove(z_type, addr, kind)
+            self._bp_conditions.pop((z_type, addr, kind), None)
+
+            if slots is not None:
+                slots.release((z_type, addr, kind))
+
+            # In keeping with gdbstubs doing more or less whatever the heck they want, if
+            # removing a breakpoint results in an error from the target, it probably doesn't
+            # mean that removing the breakpoint actually failed. This is... neat, to say the
+            # least.
+            #
+            # I found some documentation on the internet that GDB apparently just ignores
+            # errors it gets from the target in basically all cases. I've made the decision to
+            # have this function raise the error, but at the backends/rsp.py interface I have
+            # it ignore the error. This makes it easy to propagate the errors up later if that
+            # seems wise.
+            #
+            # If this becomes onerous, it's fine to just choose to ignore the error here. There
+            # are plenty of places in RspTarget where we *could* look for error codes and we
+            # don't, anyway.
+            if _is_error_reply(status):
+                errors.append(f"Unable to remove Z{z_type} at {hex(addr)}: {status}")
+
+        if errors:
+            raise RspTargetError("; ".join(errors))
 
     def close(self):
         """
@@ -617,16 +1963,16 @@ class RspTarget():
                                  "than the main user thread.")
 
         self._shutdown_flag = True
+        # Wake the event thread up from waiting on the stop queue
+        self._rsp.stop_queue.put(None)
         self._stop_events_thread.join()
         self.cmd_stop()
         self._detach()
         self._rsp.close()
 
     def _detach(self):
-        with self._rsp_lock:
-            self._rsp.send(b'D;1')
-            # Reply should be 'OK' -- XXX do we care? Use timeout at least.
-            self._rsp.recv(timeout=1)
+        # Reply should be 'OK' -- XXX do we care? Use timeout at least.
+        self._mux.transact(b'D;1', timeout=1)
 
     def _get_reg_layout(self):
         """
@@ -640,14 +1986,16 @@ class RspTarget():
         :return: (register layout, register map) or None if unable to get register layout
         """
 
-        with self._rsp_lock:
-            self._rsp.send(b'qXfer:features:read:target.xml:0,ffb')
-            response = self._rsp.recv()
+        if not self.capabilities.supports_xfer('features'):
+            logging.getLogger(__name__).debug("stub didn't report qXfer:features:read support, "
+                                              "trying anyway")
+
+        target_xml = self._xfer_read(b'features', b'target.xml')
 
         try:
-            xml_files = _get_xml_file_names(response)
+            xml_files = _get_xml_file_names(target_xml)
         except ET.ParseError:
-            print(f"Unable to parse XML file names '{response}'")
+            print(f"Unable to parse XML file names '{target_xml}'")
             return None
 
         xml_contents = self._request_xml_files(xml_files)
@@ -660,69 +2008,50 @@ class RspTarget():
         # Request the xml file contents from the gdbstub. The XML files each describe a group
         # of registers, providing their names and sizes.
         for f in xml_files:
-            file_contents = b''
-
-            while not file_contents.endswith(b'</feature>\n') \
-            and not file_contents.endswith(b'</feature>'):
-                with self._rsp_lock:
-                    self._rsp.send(b'qXfer:features:read:%s:%s,ffb' %
-                                   (f.encode('utf-8'), hex(len(file_contents)).encode('utf-8')))
-                    response = self._rsp.recv()
-                file_contents += response[1:]
-
-            xml_contents.append(file_contents)
+            xml_contents.append(self._xfer_read(b'features', f.encode('utf-8')))
 
         return xml_contents
 
-    def _get_stop_reason(self, packet):
+    def _xfer_read(self, obj, annex):
         """
-        Determines the stop reason for packet. Assumes packet is a stop reply packet.
-        :param bytes packet: stop reply packet
-        :rtype: str 
+        Read an object from the stub with qXfer, in chunks as big as the stub's packets allow.
+        Each reply starts with 'm' if there's more to read, or 'l' if it's the last chunk.
+
+        :param bytes obj: the object to read, e.g. b'features'
+        :param bytes annex: which one to read, e.g. b'target.xml'
+        :rtype: bytes
+        :returns: the object's contents
+        :raises RspTargetError: if the stub replies with an error
         """
-        stop_reason = None
-        logging.getLogger(__name__).debug("_get_stop_reason")
-        logging.getLogger(__name__).debug(packet)
-
-        # Stop reply packet indicates target stopped due to a signal
-        if chr(packet[0]) == 'T':
-            logging.getLogger(__name__).debug("_get_stop_reason() stop is signal")
-            signal_code = int(packet[1:3])
-            logging.getLogger(__name__).debug(f"__get_stop_reason() signal code = {signal_code}")
+        contents = b''
 
-            if signal_code == signal.SIGINT.value:  # pylint: disable=no-member
-                logging.getLogger(__name__).debug("SIGINT")
-            elif signal_code == signal.SIGTRAP.value:  # pylint: disable=no-member
-                logging.getLogger(__name__).debug("SIGTRAP")
+        while True:
+            response = self._mux.transact(b'qXfer:%s:read:%s:%x,%x' %
+                                          (obj, annex, len(contents),
+                                           self.capabilities.xfer_chunk_size))
 
-                # Request the stop reason from the target
-                with self._rsp_lock:
-                    self._rsp.send(b'?')
-                    logging.getLogger(__name__).debug("Getting reason response...")
-                    stop_reason_packet = self._rsp.stop_queue.get()
-                    logging.getLogger(__name__).debug("Got response.")
+            if _is_error_reply(response):
+                raise RspTargetError(f"Unable to read {annex} with qXfer, received error "
+                                     f"'{response}'")
 
-                # Assume the reply is TXXthread:nn again and get XX
-                signal_code = int(stop_reason_packet[1:3])
-                logging.getLogger(__name__).debug(signal_code)
-                stop_reason = _decode_stop_reason(signal_code)
-                logging.getLogger(__name__).debug(stop_reason)
+            contents += response[1:]
 
-        return stop_reason
+            if not response.startswith(b'm'):
+                return contents
 
 
 def _get_xml_file_names(response):
     """
-    Extract the XML file names from a binary string
+    Extract the XML file names from target.xml
 
-    :param bytes response: The string to extract XML file names from
+    :param bytes response: The contents of target.xml
     """
     xml_files = []
 
     # ElementTree doesn't like unbound prefix tags, i.e. 'xi:include' in this xml. The quick
     # and dirty way to get around this is to remove the suffix and just make the prefix the
-    # tag. This might be brittle. The list slicing is to remove the response code from the packet.
-    response = response[1:].replace(b':include', b'')
+    # tag. This might be brittle.
+    response = response.replace(b':include', b'')
     root = ET.fromstring(response)
 
     # Parse out the xml file names from the response
@@ -764,15 +2093,124 @@ def _get_register_info(xml_contents):
 
     return reg_sizes, reg_map
 
-def _decode_stop_reason(signal_code):
-    stop_reason = None
+def _split_g_packet(reply, reg_sizes, reg_map):
+    """
+    Split the reply to a g packet into register values. The g packet holds registers in
+    index order, starting at 0, and stops at the first index that the register layout doesn't
+    describe, since without its size we can't tell where the next register starts.
+
+    :param bytes reply: the reply to the g packet, as hex
+    :param dict reg_sizes: register name to size in bytes
+    :param dict reg_map: register name to index
+    :rtype: dict
+    :returns: register index to hex value, leaving out any the stub reported as unavailable
+    """
+    names = {regnum: name for name, regnum in reg_map.items()}
+    regs = {}
+    offset = 0
+    regnum = 0
+
+    while regnum in names:
+        size = reg_sizes[names[regnum]] * 2
+        value = reply[offset:offset + size]
+
+        if len(value) < size:
+            break
+
+        # Registers the stub can't read are sent as 'xx...'
+        if b'x' not in value:
+            regs[regnum] = value
+
+        offset += size
+        regnum += 1
+
+    return regs
+
+def _merge_ranges(ranges):
+    """
+    Merge memory ranges that touch or overlap, so that each can be read with one request
+
+    :param list ranges: (address, size) of each range
+    :rtype: list
+    :returns: (address, size) of the merged ranges, in ascending address order
+    """
+    spans = []
+
+    for addr, size in sorted(ranges):
+        if spans and addr <= spans[-1][0] + spans[-1][1]:
+            start = spans[-1][0]
+            spans[-1][1] = max(spans[-1][1], addr + size - start)
+        else:
+            spans.append([addr, size])
+
+    return [tuple(span) for span in spans]
+
+def _parse_qsupported(reply):
+    """
+    Parse the stub's reply to qSupported into a dict of feature name to value. Features
+    reported as 'name+' or 'name-' map to True or False, and 'name=value' maps to value.
+
+    :param bytes reply: the qSupported reply
+    :rtype: dict
+    :returns: the features the stub reported
+    """
+    features = {}
+
+    if not reply:
+        return features
+
+    for feature in reply.decode('utf-8', errors='replace').split(';'):
+        if '=' in feature:
+            name, value = feature.split('=', 1)
+            features[name] = value
+        elif feature.endswith('+'):
+            features[feature[:-1]] = True
+        elif feature.endswith('-'):
+            features[feature[:-1]] = False
+
+    return features
+
+def _parse_stop_packet(packet):
+    """
+    Decode a stop reply packet. T packets carry key:value pairs saying why the target stopped,
+    which thread stopped, and the values of some registers, so that none of that has to be
+    asked for separately.
+
+    :param bytes packet: the stop reply packet
+    :rtype: StopReply
+    :returns: the decoded packet
+    """
+    stop = StopReply()
+    kind = chr(packet[0]) if packet else ''
+
+    if kind not in ('S', 'T'):
+        return stop
+
+    try:
+        stop.signal_code = int(packet[1:3], 16)
+    except ValueError:
+        return stop
+
+    if kind == 'T':
+        for pair in packet[3:].decode('utf-8', errors='replace').split(';'):
+            key, _, value = pair.partition(':')
+
+            if key in _stop_reason_keys:
+                stop.reason = _stop_reason_keys[key]
+
+                if value:
+                    stop.watch_addr = int(value, 16)
+            elif key == 'thread':
+                stop.thread = value
+            elif key and value and all(c in string.hexdigits for c in key):
+                stop.registers[int(key, 16)] = value.encode('utf-8')
 
-    # TODO: Implement the required checks to figure out when read/write watchpoints are hit
+    # Stubs that don't report swbreak just stop with a SIGTRAP
     # pylint: disable=no-member
-    if signal_code == signal.SIGTRAP.value:
-        stop_reason = StopReasons.swbreak
+    if stop.reason is None and stop.signal_code == signal.SIGTRAP.value:
+        stop.reason = StopReasons.swbreak
 
-    return stop_reason
+    return stop
 
 def _is_error_reply(packet):
     return packet and chr(packet[0]) == 'E'
@@ -0,0 +1,241 @@
+"""
+Tracepoints: the stub collects registers and memory each time the target reaches an address,
+without stopping it or telling us, and keeps what it collected in a trace buffer. Once the
+target's stopped, the buffer's downloaded a batch of frames at a time.
+
+See "Tracepoint Packets" in the GDB manual for the protocol.
+"""
+
+from monk.conditions import Const, Reg, BinOp
+from monk.snapshot import Snapshot
+
+# Kind of the snapshots trace frames are
+TRACE_KIND = "trace"
+
+# Offsets in M actions are 64 bit, so negative ones wrap around
+_OFFSET_MASK = (1 << 64) - 1
+
+# Keys in the qTStatus reply saying why the trace stopped
+_stop_reasons = ('tnotrun', 'tstop', 'tfull', 'tdisconnected', 'tpasscount', 'terror',
+                 'tunknown')
+
+
+class TracepointError(Exception):
+    """Error raised when a tracepoint can't be expressed in the protocol"""
+
+
+class Tracepoint():
+    """A tracepoint, and what the stub collects each time it's hit"""
+    # pylint: disable=too-many-arguments
+    def __init__(self, number, addr, capture, condition=None, pass_count=0):
+        """
+        :param int number: the tracepoint's number, unique in the trace
+        :param int addr: the address it's at
+        :param Capture capture: the registers and memory to collect
+        :param bytes condition: agent expression the stub checks before collecting, or None
+        :param int pass_count: stop the trace after this many hits, or 0 to never stop
+        """
+        self.number = number
+        self.addr = addr
+        self.capture = capture
+        self.condition = condition
+        self.pass_count = pass_count
+
+    def packets(self, reg_map, addr_size):
+        """
+        Build the QTDP packets that define the tracepoint: one for the tracepoint itself, then
+        one per action. Every packet but the last ends in '-' to say more are coming.
+
+        :param dict reg_map: register name to register number, as the stub numbers them
+        :param int addr_size: the number of bytes in the target's addresses
+        :rtype: list
+        :raises TracepointError: if something to collect can't be expressed as an action
+        """
+        addr = b'%0*x' % (addr_size * 2, self.addr)
+        header = b'QTDP:%x:%s:E:0:%x' % (self.number, addr, self.pass_count)
+
+        if self.condition is not None:
+            header += b':X%x,%s' % (len(self.condition), self.condition.hex().encode('utf-8'))
+
+        actions = []
+        regnums = {_regnum(name, reg_map) for name in self.capture.registers}
+
+        for expr, size in self.capture.memory:
+            basereg, offset = _memory_base(expr, reg_map)
+
+            # The address is worked out from the register when the frame's read back, so the
+            # register has to be collected too
+            if basereg is not None:
+                regnums.add(basereg)
+
+            actions.append(b'M%s,%x,%x' % (b'-1' if basereg is None else b'%x' % basereg,
+                                          offset & _OFFSET_MASK, size))
+
+        if regnums:
+            actions.insert(0, b'R%x' % sum(1 << regnum for regnum in regnums))
+
+        packets = [header] + [b'QTDP:-%x:%s:%s' % (self.number, addr, action)
+                              for action in actions]
+
+        return [packet + b'-' for packet in packets[:-1]] + packets[-1:]
+
+
+class TraceStatus():
+    """The state of the trace, from the stub's reply to qTStatus"""
+    def __init__(self, running, fields):
+        """
+        :param bool running: whether the trace is running
+        :param dict fields: the reply's name:value fields
+        """
+        self.running = running
+        self.fields = fields
+
+    @classmethod
+    def from_reply(cls, reply):
+        """
+        Decode a qTStatus reply, e.g. T0;tstop::0;tframes:2;tcreated:2;tfree:fff00;tsize:100000
+
+        :param bytes reply: the reply
+        :rtype: TraceStatus
+        """
+        parts = reply.decode('utf-8', errors='replace').split(';')
+        fields = {}
+
+        for part in parts[1:]:
+            name, _, value = part.partition(':')
+            fields[name] = value
+
+        return cls(parts[0] == 'T1', fields)
+
+    def _hex_field(self, name):
+        try:
+            return int(self.fields[name], 16)
+        except (KeyError, ValueError):
+            return None
+
+    @property
+    def frames(self):
+        """The number of frames in the trace buffer, or None if the stub didn't say"""
+        return self._hex_field('tframes')
+
+    @property
+    def created(self):
+        """The number of frames created since the trace started, including any discarded"""
+        return self._hex_field('tcreated')
+
+    @property
+    def buffer_size(self):
+        """The size of the trace buffer in bytes"""
+        return self._hex_field('tsize')
+
+    @property
+    def buffer_free(self):
+        """The free space in the trace buffer in bytes"""
+        return self._hex_field('tfree')
+
+    @property
+    def stop_reason(self):
+        """Why the trace stopped, e.g. 'tpasscount', or None if it's running or didn't say"""
+        return next((reason for reason in _stop_reasons if reason in self.fields), None)
+
+
+class TraceFrame(Snapshot):
+    """What a tracepoint collected on one hit. Reads work like a Snapshot's."""
+    __slots__ = ('_number', '_tracepoint')
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, number, tracepoint, addr, registers, memory):
+        """
+        :param int number: the frame's number in the trace buffer
+        :param int tracepoint: the number of the tracepoint that collected it
+        :param int addr: the tracepoint's address
+        :param dict registers: register name to value
+        :param iterable memory: ((address, size), bytes) of each range collected
+        """
+        super().__init__(TRACE_KIND, addr, registers, memory)
+        object.__setattr__(self, '_number', number)
+        object.__setattr__(self, '_tracepoint', tracepoint)
+
+    @property
+    def number(self):
+        """The frame's number in the trace buffer"""
+        return self._number
+
+    @property
+    def tracepoint(self):
+        """The number of the tracepoint that collected it"""
+        return self._tracepoint
+
+    def __repr__(self):
+        return f"TraceFrame({self._number}, tracepoint {self._tracepoint}, {hex(self._addr)})"
+
+
+def parse_frame_reply(reply):
+    """
+    Decode the reply to QTFrame, e.g. F2T1 for frame 2, collected by tracepoint 1
+
+    :param bytes reply: the reply
+    :rtype: tuple
+    :returns: (frame number, tracepoint number), or None if there's no such frame
+    """
+    if not reply.startswith(b'F') or reply.startswith(b'F-1'):
+        return None
+
+    frame, _, tracepoint = reply[1:].partition(b'T')
+
+    try:
+        return int(frame, 16), int(tracepoint, 16)
+    except ValueError:
+        return None
+
+
+def memory_address(expr, registers):
+    """
+    Work out the address of a range a tracepoint collected, from the registers collected
+    with it
+
+    :param Expr expr: the address, as given to the Capture
+    :param dict registers: register name to value
+    :rtype: int
+    """
+    if isinstance(expr, Const):
+        return expr.value
+
+    if isinstance(expr, Reg):
+        return registers[expr.name]
+
+    if expr.op == '+':
+        return registers[expr.left.name] + expr.right.value
+
+    return registers[expr.left.name] - expr.right.value
+
+
+def _regnum(name, reg_map):
+    try:
+        return reg_map[name]
+    except KeyError as e:
+        raise TracepointError(f"Unknown register '{name}'") from e
+
+
+def _memory_base(expr, reg_map):
+    """
+    M actions collect memory at a register plus an offset, or at an absolute address
+
+    :rtype: tuple
+    :returns: (register number or None for absolute, offset)
+    :raises TracepointError: if the address isn't a constant, a register, or a register plus
+    or minus a constant
+    """
+    if isinstance(expr, Const):
+        return None, expr.value
+
+    if isinstance(expr, Reg):
+        return _regnum(expr.name, reg_map), 0
+
+    if isinstance(expr, BinOp) and expr.op in ('+', '-') and isinstance(expr.left, Reg) and \
+       isinstance(expr.right, Const):
+        offset = expr.right.value if expr.op == '+' else -expr.right.value
+        return _regnum(expr.left.name, reg_map), offset
+
+    raise TracepointError(f"Tracepoints can't collect memory at {expr!r}, only at a constant "
+                          "or a register plus a constant")
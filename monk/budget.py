@@ -0,0 +1,101 @@
+"""Budgets limiting how often a hook's callback runs, for hooks on hot paths
+
+A hook on something like __switch_to is hit far more often than anyone needs samples of it,
+and every hit stops the target. A Budget says how many of those hits to act on:
+
+    # Sample every 100th context switch, at most 10 times a second, and stop after 50000
+    target.on_execute(addr, sample, budget=Budget(every=100, per_second=10, max_hits=50000))
+
+The event thread checks the budget as soon as the hook is hit, before its condition is checked
+or anything is read for it. A hook that's used up its hits has its breakpoint taken out for good,
+until it's removed. A hook over its rate has its breakpoint taken out until the second is up,
+so the target stops paying for hits that would only be thrown away, if the stub's in non-stop
+mode and can put it back while the target's running. Otherwise the breakpoint stays in, and
+the hits are skipped until the second's up.
+"""
+import math
+
+
+class MonkBudgetError(Exception):
+    """Error raised for a budget that can't be met"""
+
+
+class Budget():
+    """How often a hook's callback is allowed to run. The same Budget can be given to many
+    hooks; each keeps its own count."""
+    def __init__(self, every=1, per_second=None, max_hits=None):
+        """
+        :param int every: run the callback on every Nth hit, starting with the first
+        :param int per_second: run it at most this many times a second, or None for no limit
+        :param int max_hits: disarm the hook for good after this many hits, or None to never
+        :raises MonkBudgetError: if any of them is less than 1
+        """
+        for name, value in (('every', every), ('per_second', per_second),
+                            ('max_hits', max_hits)):
+            if value is not None and value < 1:
+                raise MonkBudgetError(f"{name} has to be at least 1, not {value}")
+
+        self.every = every
+        self.per_second = per_second
+        self.max_hits = max_hits
+
+    def tracker(self):
+        """
+        :rtype: BudgetTracker
+        :returns: a fresh count of one hook's hits against the budget
+        """
+        return BudgetTracker(self)
+
+    def __repr__(self):
+        return f"Budget(every={self.every}, per_second={self.per_second}, " \
+            f"max_hits={self.max_hits})"
+
+
+class BudgetTracker():
+    """One hook's hits, counted against its Budget. Only the event thread uses it."""
+    def __init__(self, budget):
+        """
+        :param Budget budget: the budget
+        """
+        self.budget = budget
+        self.hits = 0
+        # When the current one second window started, and how many runs it's had
+        self._window_start = None
+        self._window_runs = 0
+
+    def hit(self, now):
+        """
+        Count a hit, and decide whether the callback runs for it and whether the hook has to be
+        disarmed afterwards
+
+        :param float now: the time of the hit, in time.monotonic() seconds
+        :rtype: tuple
+        :returns: (whether the callback runs, when to re-arm the hook in time.monotonic()
+        seconds, math.inf to leave it disarmed for good, or None to leave it armed)
+        """
+        budget = self.budget
+        self.hits += 1
+        run = (self.hits - 1) % budget.every == 0
+        rearm_at = None
+
+        if run and budget.per_second is not None:
+            if self._window_start is None or now - self._window_start >= 1:
+                self._window_start = now
+                self._window_runs = 0
+
+            # Hits can still turn up after the second's runs are used up, e.g. when another hook
+            # shares the breakpoint
+            if self._window_runs >= budget.per_second:
+                run = False
+            else:
+                self._window_runs += 1
+
+            # Once the second's runs are used up, there's no point stopping again until the
+            # next one
+            if self._window_runs >= budget.per_second:
+                rearm_at = self._window_start + 1
+
+        if budget.max_hits is not None and self.hits >= budget.max_hits:
+            rearm_at = math.inf
+
+        return run, rearm_at
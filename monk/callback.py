@@ -6,6 +6,7 @@ import logging
 import threading
 
 from monk.callback_manager import MonkControlError
+from monk.conditions import All
 
 
 class MonkCallbackError(Exception):
@@ -47,18 +48,35 @@ class Callback:
         if callback:
             self.run = callback
 
-    def add_hook(self, symbol, cb):
+    def add_hook(self, symbol, cb, *predicates, deferred=False, capture=None, budget=None):
         """
         Add a hook to the target
 
         :param string|int symbol: the symbol for which to register the hook. Can be a function
         name or address.
         :param function cb: the callback function to execute when the hook is triggered
+        :param Expr predicates: predicates from monk.predicates (or any monk.conditions
+        condition) that must all hold for cb to run. They're checked before cb gets a thread,
+        so hits that don't match cost next to nothing.
+        :param bool deferred: resume the target as soon as the hook is hit and run cb later,
+        passing it a monk.snapshot.Snapshot. Use it for hooks that only record data.
+        :param Capture capture: the registers and memory a deferred hook's snapshot holds
+        :param Budget budget: a monk.budget.Budget to sample a hot hook: run cb every Nth hit,
+        at most K times a second, and disarm the hook after N hits. Hits over budget are
+        turned away before predicates are checked, and the hook's breakpoint comes out while
+        it's over its rate.
         :rtype: tuple
         :returns: the hook
         """
+        condition = None
+
+        if len(predicates) == 1:
+            condition = predicates[0]
+        elif predicates:
+            condition = All(*predicates)
+
         with self._hook_lock:
-            h = self._on_execute(symbol, cb)
+            h = self._on_execute(symbol, cb, condition, deferred, capture, budget)
             self._hooks.append(h)
 
         return h  # So that hooks can be tracked and later removed individually
@@ -136,7 +154,9 @@ class Callback:
 
         return addr
 
-    def _on_execute(self, symbol, callback):
+    # pylint: disable=too-many-arguments
+    def _on_execute(self, symbol, callback, condition=None, deferred=False, capture=None,
+                    budget=None):
         logging.getLogger(__name__).debug("on_execute")
         addr = self._symbol_to_address(symbol)
 
@@ -145,6 +165,6 @@ class Callback:
                                     "cannot resolve address")
 
         logging.getLogger(__name__).debug("Adding callback")
-        bp = self.target.on_execute(addr, callback)
+        bp = self.target.on_execute(addr, callback, condition, deferred, capture, budget)
 
         return bp
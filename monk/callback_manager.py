@@ -1,9 +1,15 @@
 """Provides an interface for adding and removing callbacks.
 """
 
-from collections import defaultdict
-import threading
 import logging
+import math
+import threading
+import time
+
+from monk.callback_pool import CallbackPool, DEFAULT_WORKERS
+from monk.intervals import IntervalIndex, span
+from monk.snapshot import Capture
+from monk.stats import StatsRecorder
 
 EVENT_READ = "read"
 EVENT_WRITE = "write"
@@ -20,17 +26,31 @@ class CallbackManager():
     CallbackManager. The CallbackManager is responsible for calling the callbacks registered for
     a certain event when it is signalled by the backend that the event occurred on the target.
     The event can be an execution breakpoint, readpoint, or watchpoint.
+
+    A hook can be on a single address, or on a range of them, e.g. range(task, task + size) to
+    catch writes anywhere in a struct, or range(start, end, 4) to catch execution of any
+    instruction in a function with 4 byte instructions.
     """
-    def __init__(self, backend):
+    def __init__(self, backend, workers=DEFAULT_WORKERS, callback_timeout=None):
         """
         :param backend: the initialized backend to connect the callback dispatchers to
+        :param int workers: the number of threads to keep for running callbacks
+        :param float callback_timeout: the most seconds a callback can hold up the target
+        before it's abandoned, or None to wait forever
         """
-        # Callback registries are dictionaries of addresses with associated lists of callbacks
-        # registered for that address
-        self._on_read_callbacks = defaultdict(lambda: [])
-        self._on_write_callbacks = defaultdict(lambda: [])
-        self._on_access_callbacks = defaultdict(lambda: [])
-        self._on_execute_callbacks = defaultdict(lambda: [])
+        # Callbacks run on these threads. They aren't allowed to run, stop or step the target.
+        self._pool = CallbackPool(workers, callback_timeout)
+        # Deferred callbacks get their own worker, so a backlog of them never holds up the
+        # callbacks the target is waiting for. One worker means snapshots are handled in the
+        # order they were taken.
+        self._deferred_pool = CallbackPool(1)
+
+        # Callback registries index the callbacks by the address or range of addresses they
+        # were registered for, so the ones covering an address are found with a binary search
+        self._on_read_callbacks = IntervalIndex()
+        self._on_write_callbacks = IntervalIndex()
+        self._on_access_callbacks = IntervalIndex()
+        self._on_execute_callbacks = IntervalIndex()
         self._callback_registries = {
             EVENT_READ: self._on_read_callbacks,
             EVENT_WRITE: self._on_write_callbacks,
@@ -38,48 +58,138 @@ class CallbackManager():
             EVENT_EXECUTE: self._on_execute_callbacks
         }
 
+        # The condition of each hook that has one, keyed by the hook's (kind, addr, callback),
+        # and the same conditions compiled, ready to check when the hook is hit
+        self._conditions = {}
+        self._checks = {}
+        # What each deferred hook captures, keyed the same way
+        self._captures = {}
+
+        # What each hook has cost the target, and the hooks covering the address of the stop
+        # being handled, which the backend's timings for the stop are recorded against
+        self._stats = StatsRecorder()
+        self._stop_hooks = []
+
+        # The budget of each hook that has one, and when each hook that's been disarmed for
+        # going over its budget gets re-armed. Disarmed hooks are out of their registry, so
+        # their breakpoints come out unless another hook needs them.
+        self._budgets = {}
+        self._disarmed = {}
+        self._rearm_timers = {}
+        self._budget_lock = threading.RLock()
+
         # Tell the backend to call CallbackManager's dispatchers when breakpoints are hit
         self._backend = backend
         self._backend.set_on_read_callback(self._on_read_dispatcher)
         self._backend.set_on_write_callback(self._on_write_dispatcher)
         self._backend.set_on_access_callback(self._on_access_dispatcher)
         self._backend.set_on_execute_callback(self._on_execute_dispatcher)
+        self._backend.set_on_resume_callback(self._on_resume_dispatcher)
 
-    def on_read(self, addr, callback):
+    def on_read(self, addr, callback, condition=None, deferred=False, capture=None,
+                budget=None):
         """
         Add a callback that runs when address addr is read
 
-        :param int addr: the address
+        :param int|range addr: the address, or a range of addresses to run it for any of
         :param function callback: the callback
+        :param Expr condition: a condition from monk.conditions that has to hold for the
+        callback to run, or None to always run it
+        :param bool deferred: resume the target straight away and run the callback later,
+        passing it a Snapshot
+        :param Capture capture: what a deferred callback's snapshot captures
+        :param Budget budget: how often the callback is allowed to run, from monk.budget
         """
-        return self._break_on_event(EVENT_READ, addr, callback)
+        return self._break_on_event(EVENT_READ, addr, callback, condition, deferred, capture,
+                                    budget)
 
-    def on_write(self, addr, callback):
+    def on_write(self, addr, callback, condition=None, deferred=False, capture=None,
+                 budget=None):
         """
         Add a callback that runs when address addr is written to
 
-        :param int addr: the address
+        :param int|range addr: the address, or a range of addresses to run it for any of
         :param function callback: the callback
+        :param Expr condition: a condition from monk.conditions that has to hold for the
+        callback to run, or None to always run it
+        :param bool deferred: resume the target straight away and run the callback later,
+        passing it a Snapshot
+        :param Capture capture: what a deferred callback's snapshot captures
+        :param Budget budget: how often the callback is allowed to run, from monk.budget
         """
-        return self._break_on_event(EVENT_WRITE, addr, callback)
+        return self._break_on_event(EVENT_WRITE, addr, callback, condition, deferred, capture,
+                                    budget)
 
-    def on_access(self, addr, callback):
+    def on_access(self, addr, callback, condition=None, deferred=False, capture=None,
+                  budget=None):
         """
         Add a callback that runs when address addr is accessed
 
-        :param int addr: the address
+        :param int|range addr: the address, or a range of addresses to run it for any of
         :param function callback: the callback
+        :param Expr condition: a condition from monk.conditions that has to hold for the
+        callback to run, or None to always run it
+        :param bool deferred: resume the target straight away and run the callback later,
+        passing it a Snapshot
+        :param Capture capture: what a deferred callback's snapshot captures
+        :param Budget budget: how often the callback is allowed to run, from monk.budget
         """
-        return self._break_on_event(EVENT_ACCESS, addr, callback)
+        return self._break_on_event(EVENT_ACCESS, addr, callback, condition, deferred, capture,
+                                    budget)
 
-    def on_execute(self, addr, callback):
+    def on_execute(self, addr, callback, condition=None, deferred=False, capture=None,
+                   budget=None):
         """
         Add a callback that runs when address addr is executed
 
-        :param int addr: the address
+        :param int|range addr: the address, or a range of addresses to run it for any of
         :param function callback: the callback
+        :param Expr condition: a condition from monk.conditions that has to hold for the
+        callback to run, or None to always run it. The stub checks it itself if it can, so
+        that the target doesn't even stop when it doesn't hold.
+        :param bool deferred: resume the target straight away and run the callback later,
+        passing it a Snapshot
+        :param Capture capture: what a deferred callback's snapshot captures
+        :param Budget budget: how often the callback is allowed to run, from monk.budget
         """
-        return self._break_on_event(EVENT_EXECUTE, addr, callback)
+        return self._break_on_event(EVENT_EXECUTE, addr, callback, condition, deferred,
+                                    capture, budget)
+
+    def on_execute_many(self, addrs, callback, condition=None, deferred=False, capture=None,
+                        budget=None):
+        """
+        Add the same callback to run when any of many addresses is executed, e.g. every
+        function matching a pattern. The breakpoints are set in one pipelined batch rather than
+        a round trip each. If any of them can't be set, none of the hooks are added.
+
+        :param iterable addrs: the addresses, or ranges of addresses
+        :param function callback: the callback
+        :param Expr condition: a condition from monk.conditions that has to hold for the
+        callback to run, or None to always run it
+        :param bool deferred: resume the target straight away and run the callback later,
+        passing it a Snapshot
+        :param Capture capture: what a deferred callback's snapshot captures
+        :param Budget budget: how often the callback is allowed to run. Each address's hook
+        counts its hits separately.
+        :rtype: list
+        :returns: a hook per address, which remove_callbacks takes out together
+        """
+        hooks = []
+
+        try:
+            for addr in addrs:
+                hooks.append(self._register(EVENT_EXECUTE, addr, callback, condition, deferred,
+                                            capture, budget))
+
+            self._sync_exec_breakpoints(_covered(hooks))
+        except Exception:
+            for hook in hooks:
+                self._unregister(hook)
+
+            self._sync_exec_breakpoints(_covered(hooks))
+            raise
+
+        return hooks
 
     def remove_callback(self, cb):
         """
@@ -88,32 +198,135 @@ class CallbackManager():
         :param tuple cb: A tuple of (kind, addr, callback) representing the callback to remove.
         This is the same type of tuple returned by any of the break_on_* functions.
         """
-        kind, addr, callback = cb
-        logging.getLogger(__name__).debug(f"Removing callback '{kind}: {hex(addr)}'")
+        kind, addr, _ = cb
+        logging.getLogger(__name__).debug(f"Removing callback '{kind}: {_describe(addr)}'")
+
+        cb_registry = self._unregister(cb)
+
+        # If there are no more callbacks registered for this address, we need to remove the
+        # breakpoint. Otherwise the conditions the target checks may have changed.
+        if len(cb_registry[addr]) < 1:
+            self._del_breakpoint(kind, addr)
+        elif self._has_conditions(kind, addr):
+            self._set_breakpoint(kind, addr)
+
+    def remove_callbacks(self, cbs):
+        """
+        Remove many callbacks at once, e.g. the hooks on_execute_many added. The execution
+        breakpoints they leave unused are deleted in one pipelined batch.
+
+        :param iterable cbs: the (kind, addr, callback) tuples of the callbacks to remove
+        :raises MonkControlError: if any of them weren't registered. The rest are still removed.
+        """
+        exec_hooks = []
+        errors = []
+
+        for cb in cbs:
+            try:
+                if cb[0] == EVENT_EXECUTE:
+                    self._unregister(cb)
+                    exec_hooks.append(cb)
+                else:
+                    self.remove_callback(cb)
+            except MonkControlError as e:
+                errors.append(str(e))
+
+        self._sync_exec_breakpoints(_covered(exec_hooks))
+
+        if errors:
+            raise MonkControlError("; ".join(errors))
+
+    def _register(self, kind, addr, callback, condition, deferred, capture, budget=None):
+        """
+        Add a callback to its registry, along with its condition and capture, without touching
+        the target's breakpoints
+
+        :rtype: tuple
+        :returns: the hook, (kind, addr, callback)
+        :raises MonkControlError: if the kind isn't recognized or the address range is empty
+        """
         fail = False
 
         try:
             cb_registry = self._callback_registries[kind]
-        except KeyError:
+        except: # pylint:disable=bare-except
             fail = True
 
+        # We raise outside of the try-except above so that we don't end up with "exception while
+        # handling other exception" if this is uncaught by the caller. In practice, this should
+        # never happen because it's an internal function and we're only ever calling it with a
+        # "kind" that should be defined, but code changes, and assumptions don't always hold.
         if fail:
-            raise MonkControlError("callback kind '{kind}' not recognized")
+            raise MonkControlError(f"breakpoint kind '{kind}' not recognized")
+
+        if capture is not None and not deferred:
+            raise MonkControlError("only deferred callbacks capture snapshots")
+
+        try:
+            cb_registry.add(addr, callback)
+        except ValueError as e:
+            raise MonkControlError(str(e)) from e
+
+        if condition is not None:
+            # Compile it now rather than on every hit
+            self._checks[(kind, addr, callback)] = condition.compile()
+            self._conditions[(kind, addr, callback)] = condition
+
+        if deferred:
+            self._captures[(kind, addr, callback)] = capture if capture is not None else Capture()
+
+        if budget is not None:
+            self._budgets[(kind, addr, callback)] = budget.tracker()
+
+        return (kind, addr, callback)
+
+    def _unregister(self, cb):
+        """
+        Take a callback out of its registry, without touching the target's breakpoints
+
+        :param tuple cb: the hook, (kind, addr, callback)
+        :rtype: IntervalIndex
+        :returns: the registry it was in
+        :raises MonkControlError: if it wasn't registered
+        """
+        kind, addr, callback = cb
+        fail = False
 
         try:
-            cb_registry[addr].remove(callback)
-        except ValueError:
+            cb_registry = self._callback_registries[kind]
+        except KeyError:
             fail = True
 
         if fail:
-            raise MonkControlError(f"no '{kind}' callback found for address '{hex(addr)}'")
+            raise MonkControlError(f"callback kind '{kind}' not recognized")
 
-        # If there are no more callbacks registered for this address, we need to remove the
-        # breakpoint
-        if len(cb_registry[addr]) < 1:
-            self._del_breakpoint(kind, addr)
+        with self._budget_lock:
+            # A disarmed hook is already out of the registry
+            if self._disarmed.pop(cb, None) is None:
+                try:
+                    cb_registry.remove(addr, callback)
+                except ValueError:
+                    fail = True
+
+            timer = self._rearm_timers.pop(cb, None)
+
+        if timer is not None:
+            timer.cancel()
 
-    def _break_on_event(self, kind, addr, callback=None):
+        if fail:
+            raise MonkControlError(f"no '{kind}' callback found for address '{_describe(addr)}'")
+
+        if callback not in cb_registry[addr]:
+            self._conditions.pop(cb, None)
+            self._checks.pop(cb, None)
+            self._captures.pop(cb, None)
+            self._budgets.pop(cb, None)
+            self._stats.forget(cb)
+
+        return cb_registry
+
+    def _break_on_event(self, kind, addr, callback=None, condition=None, deferred=False,
+                        capture=None, budget=None):
         """
         Sets a callback for an address, adding a breakpoint if one does not already exist.
         """
@@ -126,92 +339,435 @@ class CallbackManager():
         # has no way of detecting this, but if it needs to know when a callback is fired,
         # well, it should give the Callback a callback function that will signal it.
 
-        logging.getLogger(__name__).debug(f"_break_on_event({kind}, {hex(addr)})")
-
-        fail = False
-
-        try:
-            cb_registry = self._callback_registries[kind]
-        except: # pylint:disable=bare-except
-            fail = True
-
-        # We raise outside of the try-except above so that we don't end up with "exception while
-        # handling other exception" if this is uncaught by the caller. In practice, this should
-        # never happen because it's an internal function and we're only ever calling it with a
-        # "kind" that should be defined, but code changes, and assumptions don't always hold.
-        if fail:
-            raise MonkControlError(f"breakpoint kind '{kind}' not recognized")
+        logging.getLogger(__name__).debug(f"_break_on_event({kind}, {_describe(addr)})")
 
-        cb_registry[addr].append(callback)
+        hook = self._register(kind, addr, callback, condition, deferred, capture, budget)
+        cb_registry = self._callback_registries[kind]
 
         # If this is the first callback added for this address, we need to add the breakpoint
-        # to the target
+        # to the target. If it isn't, the conditions the target checks may have changed.
         if len(cb_registry[addr]) < 2:
             logging.getLogger(__name__).debug("Adding breakpoint")
+
+            # Watchpoints in particular can fail, e.g. when the target's debug registers are
+            # all in use. Don't leave behind a callback that can never be called.
+            try:
+                self._set_breakpoint(kind, addr)
+            except Exception:
+                self._unregister(hook)
+
+                # Take out the breakpoints already set for the rest of the range
+                if kind == EVENT_EXECUTE and isinstance(addr, range):
+                    self._del_breakpoint(kind, addr)
+
+                raise
+        elif self._has_conditions(kind, addr):
             self._set_breakpoint(kind, addr)
 
         logging.getLogger(__name__).debug(f"_break_on_event() new callback registry kind:{kind}"
                                           " addr:{addr} = {cb_registry[addr]}")
 
-        return (kind, addr, callback)
+        return hook
 
     def _set_breakpoint(self, kind, addr):
+        """
+        Set the breakpoint for a hook's address. A range of addresses is watched with one
+        watchpoint covering all of it, but needs an execution breakpoint on every address.
+        """
+        watch_args = _watch_args(addr)
+
         if kind == EVENT_READ:
-            self._backend.set_read_breakpoint(addr)
+            self._backend.set_read_breakpoint(*watch_args)
         elif kind == EVENT_WRITE:
-            self._backend.set_write_breakpoint(addr)
+            self._backend.set_write_breakpoint(*watch_args)
         elif kind == EVENT_ACCESS:
-            self._backend.set_access_breakpoint(addr)
+            self._backend.set_access_breakpoint(*watch_args)
         elif kind == EVENT_EXECUTE:
-            self._backend.set_exec_breakpoint(addr)
+            for exec_addr in _addresses(addr):
+                self._set_exec_breakpoint(exec_addr)
         else:
             raise MonkControlError(f"breakpoint kind '{kind}' not recognized")
 
+    def _set_exec_breakpoint(self, addr):
+        conditions = self._breakpoint_conditions(EVENT_EXECUTE, addr)
+
+        if conditions:
+            self._backend.set_exec_breakpoint(addr, conditions)
+        else:
+            self._backend.set_exec_breakpoint(addr)
+
+    def _has_conditions(self, kind, addr):
+        # Only execution breakpoints can have their conditions checked by the target. Other
+        # hooks, e.g. on a range the address is in, share the breakpoint.
+        if kind != EVENT_EXECUTE:
+            return False
+
+        registry = self._callback_registries[kind]
+
+        return any((kind, key, cb) in self._conditions
+                   for exec_addr in _addresses(addr) for key, cb in registry.at(exec_addr))
+
+    def _breakpoint_conditions(self, kind, addr):
+        """
+        Get the conditions for the target to check before stopping at a breakpoint. It has to
+        stop if any hook's condition holds, so if any hook has no condition, there are none.
+
+        :param int addr: the address of the breakpoint
+        :rtype: list
+        :returns: the conditions, or None if the target always has to stop
+        """
+        conditions = [self._conditions.get((kind, key, cb))
+                      for key, cb in self._callback_registries[kind].at(addr)]
+
+        if not conditions or any(cond is None for cond in conditions):
+            return None
+
+        return conditions
+
     def _del_breakpoint(self, kind, addr):
+        """
+        Delete the breakpoint for a hook's address, once it has no callbacks left. Execution
+        breakpoints are shared by every hook covering their address, so the ones other hooks
+        still cover are left in, with the conditions of the hooks that are left.
+        """
+        watch_args = _watch_args(addr)
+
         if kind == EVENT_READ:
-            self._backend.del_read_breakpoint(addr)
+            self._backend.del_read_breakpoint(*watch_args)
         elif kind == EVENT_WRITE:
-            self._backend.del_write_breakpoint(addr)
+            self._backend.del_write_breakpoint(*watch_args)
         elif kind == EVENT_ACCESS:
-            self._backend.del_access_breakpoint(addr)
+            self._backend.del_access_breakpoint(*watch_args)
         elif kind == EVENT_EXECUTE:
-            self._backend.del_exec_breakpoint(addr)
+            for exec_addr in _addresses(addr):
+                if self._on_execute_callbacks.at(exec_addr):
+                    self._set_exec_breakpoint(exec_addr)
+                else:
+                    self._backend.del_exec_breakpoint(exec_addr)
         else:
             raise MonkControlError(f"breakpoint kind '{kind}' not recognized")
 
+    def _sync_exec_breakpoints(self, addrs):
+        """
+        Bring the execution breakpoints at many addresses in line with the hooks covering them,
+        in one batch to delete the unused ones and one to set the rest. Setting a breakpoint
+        that's already set with the same conditions doesn't send anything.
+
+        :param iterable addrs: the addresses
+        """
+        keep = {}
+        drop = []
+
+        for addr in addrs:
+            if self._on_execute_callbacks.at(addr):
+                keep[addr] = self._breakpoint_conditions(EVENT_EXECUTE, addr)
+            else:
+                drop.append(addr)
+
+        if drop:
+            self._backend.del_exec_breakpoints(drop)
+
+        if keep:
+            self._backend.set_exec_breakpoints(keep)
+
     # Signal handlers hooked into the backend signals notification functions
     def _on_read_dispatcher(self, addr):
-        self._callback_handler(self._on_read_callbacks[addr])
+        self._dispatch(EVENT_READ, addr)
 
     def _on_write_dispatcher(self, addr):
-        self._callback_handler(self._on_write_callbacks[addr])
+        self._dispatch(EVENT_WRITE, addr)
 
     def _on_access_dispatcher(self, addr):
-        self._callback_handler(self._on_access_callbacks[addr])
+        self._dispatch(EVENT_ACCESS, addr)
 
     def _on_execute_dispatcher(self, addr):
         logging.getLogger(__name__).debug("_on_execute_dispatcher({hex(addr)})")
-        self._callback_handler(self._on_execute_callbacks[addr])
+        self._dispatch(EVENT_EXECUTE, addr)
+
+    def _on_resume_dispatcher(self, dispatch, resume):
+        """
+        Record the backend's timings for the stop that was just handled against every hook
+        covering its address
+
+        :param float dispatch: seconds from the stop to the event handler being called
+        :param float resume: seconds from the handler returning to the target running again
+        """
+        hooks, self._stop_hooks = self._stop_hooks, []
+
+        for hook in hooks:
+            self._stats.record(hook, 'dispatch', dispatch)
+            self._stats.record(hook, 'resume', resume)
+
+    def _dispatch(self, kind, addr):
+        callbacks = []
+        hooks = []
+        self._stop_hooks = []
+
+        # The target's stopped, so it's safe to put back the breakpoints of hooks whose
+        # budgets have recovered
+        self.rearm_due()
+
+        for key, callback in self._matching_callbacks(kind, addr):
+            hook = (kind, key, callback)
+            capture = self._captures.get(hook)
+
+            if capture is None:
+                callbacks.append(callback)
+                hooks.append(hook)
+            else:
+                self._defer(hook, addr, capture)
+
+        self._callback_handler(callbacks, hooks)
+
+    def _defer(self, hook, addr, capture):
+        """
+        Snapshot the target for a deferred callback and queue the callback, without waiting
+        for it. This runs on the event thread, before the target resumes, so the time the
+        capture takes is what the hook costs the target.
+        """
+        kind, _, callback = hook
+        started = time.monotonic()
+
+        try:
+            snapshot = capture.take(self._backend, kind, addr)
+        except Exception as e:  # pylint:disable=broad-except
+            logging.getLogger(__name__).warning(f"Unable to capture {capture!r}, skipping "
+                                                f"callback: {e}")
+            return
+        finally:
+            self._stats.record(hook, 'callback', time.monotonic() - started)
+
+        if not self._deferred_pool.submit(callback, snapshot):
+            logging.getLogger(__name__).warning(f"Too many deferred callbacks queued up, "
+                                                f"dropped the snapshot for {hex(addr)}")
+
+    def _matching_callbacks(self, kind, addr):
+        """
+        Get the callbacks for an event whose conditions hold, from every hook covering the
+        address. Even if the target checked the conditions, it stopped because at least one of
+        them held, not necessarily all. This runs on the event thread, so if nothing matches,
+        the target resumes without a callback thread ever getting involved.
+
+        :rtype: list
+        :returns: (address or range the hook is on, callback) for each callback to run
+        """
+        callbacks = []
+        over_budget = []
+        now = time.monotonic()
+
+        for key, callback in self._callback_registries[kind].at(addr):
+            hook = (kind, key, callback)
+            check = self._checks.get(hook)
+            self._stop_hooks.append(hook)
+            tracker = self._budgets.get(hook)
+
+            # The budget comes first, so that hits it skips cost no reads at all
+            if tracker is not None:
+                run, rearm_at = tracker.hit(now)
+
+                if rearm_at is not None:
+                    over_budget.append((hook, rearm_at))
+
+                if not run:
+                    self._stats.hit(hook, False)
+                    continue
+
+            if check is not None:
+                try:
+                    if not check(self._backend):
+                        self._stats.hit(hook, False)
+                        continue
+                except Exception as e:  # pylint:disable=broad-except
+                    condition = self._conditions.get(hook)
+                    logging.getLogger(__name__).warning(f"Unable to check condition "
+                                                        f"{condition!r}, skipping callback: {e}")
+                    self._stats.hit(hook, False)
+                    continue
+
+            self._stats.hit(hook, True)
+            callbacks.append((key, callback))
+
+        for hook, rearm_at in over_budget:
+            self._disarm(hook, rearm_at)
+
+        return callbacks
+
+    def _disarm(self, hook, rearm_at):
+        """
+        Take a hook that's over its budget out of its registry, and its breakpoint out of the
+        target unless another hook needs it, until it's re-armed. A hook over its rate is only
+        disarmed if the stub can re-arm it while the target's running.
+
+        :param tuple hook: the hook
+        :param float rearm_at: when to re-arm it, in time.monotonic() seconds, or math.inf to
+        leave it disarmed
+        """
+        kind, addr, callback = hook
+
+        # Only a stub in non-stop mode takes breakpoints while the target's running, so in
+        # all-stop mode nothing could put the breakpoint back when the second's up. The hook's
+        # left armed instead, and its budget skips its hits until then, before anything's read.
+        if rearm_at != math.inf and not self._backend.can_set_breakpoints_while_running():
+            return
 
-    def _callback_handler(self, callbacks):
+        with self._budget_lock:
+            if hook in self._disarmed:
+                return
+
+            logging.getLogger(__name__).debug(f"Disarming '{kind}: {_describe(addr)}' until "
+                                              f"{rearm_at}")
+
+            self._callback_registries[kind].remove(addr, callback)
+            self._disarmed[hook] = rearm_at
+            self._update_breakpoint(kind, addr)
+
+            if rearm_at != math.inf:
+                timer = threading.Timer(max(rearm_at - time.monotonic(), 0), self.rearm_due)
+                timer.daemon = True
+                self._rearm_timers[hook] = timer
+                timer.start()
+
+    def rearm_due(self):
+        """
+        Re-arm the hooks disarmed for going over their budgets whose time is up. It's called
+        whenever a hook is hit, and has to be called with the target stopped, unless the stub's
+        in non-stop mode.
+        """
+        now = time.monotonic()
+
+        with self._budget_lock:
+            due = [hook for hook, rearm_at in self._disarmed.items() if rearm_at <= now]
+
+            for hook in due:
+                kind, addr, callback = hook
+                logging.getLogger(__name__).debug(f"Re-arming '{kind}: {_describe(addr)}'")
+
+                del self._disarmed[hook]
+                self._rearm_timers.pop(hook, None)
+                self._callback_registries[kind].add(addr, callback)
+
+                try:
+                    self._update_breakpoint(kind, addr)
+                except Exception as e:  # pylint:disable=broad-except
+                    # e.g. the debug registers were taken while it was disarmed. Try again the
+                    # next time.
+                    logging.getLogger(__name__).warning(f"Unable to re-arm '{kind}: "
+                                                        f"{_describe(addr)}': {e}")
+                    self._callback_registries[kind].remove(addr, callback)
+                    self._disarmed[hook] = now
+
+    def _update_breakpoint(self, kind, addr):
+        """
+        Set or delete the breakpoint for a hook's address after a hook on it has been added to
+        or taken out of its registry, depending on whether any hook still needs it
+        """
+        if kind == EVENT_EXECUTE:
+            self._sync_exec_breakpoints(_addresses(addr))
+        elif self._callback_registries[kind][addr]:
+            self._set_breakpoint(kind, addr)
+        else:
+            self._del_breakpoint(kind, addr)
+
+    def _callback_handler(self, callbacks, hooks=None):
         logging.getLogger(__name__).debug("_callback_handler")
         logging.getLogger(__name__).debug(callbacks)
-        for callback in callbacks:
+        for i, callback in enumerate(callbacks):
             logging.getLogger(__name__).debug("invoking callback...")
-            # We kick off another thread here because new threads do not have permission to call
-            # target execution functions (run, stop, etc) and the callbacks must not execute the
-            # target. It also gives us agency to terminate the callback if it's hung.
-            t = threading.Thread(target=callback)
-            t.start()
-            t.join()
+            started = time.monotonic()
+            # Callbacks run on a worker thread because only the main thread and the event
+            # thread have permission to call target execution functions (run, stop, etc), and
+            # the callbacks must not execute the target. It also gives us agency to stop
+            # waiting for the callback if it's hung.
+            self._pool.run(callback)
+
+            if hooks:
+                self._stats.record(hooks[i], 'callback', time.monotonic() - started)
 
         logging.getLogger(__name__).debug("callbacks done.")
 
-        # This is an implementation detail of the RSP backend... All sw breakpoints get cleared
-        # by the gdbstub when the target stops. This makes it so that reading memory won't result
-        # in accidentally reading some breakpoint opcodes instead of the actual memory at that
-        # address. However, we have to set the breakpoints that got cleared again before
-        # re-starting the target, otherwise they're just gone, and all of our hooks are broken.
-        for addr in self._on_execute_callbacks.keys():
-            if len(self._on_execute_callbacks[addr]) > 0:
-                self._set_breakpoint(EVENT_EXECUTE, addr)
+    def hook_stats(self):
+        """
+        Get what each hook has cost the target: how often it's been hit, and histograms of how
+        long each stage of handling its stops took. Hooks that are removed take their stats
+        with them.
+
+        :rtype: StatsReport
+        :returns: a dict per hook, most expensive first, which to_json() exports
+        """
+        return self._stats.report()
+
+    def reset_hook_stats(self):
+        """
+        Start every hook's stats again from zero
+        """
+        self._stats.reset()
+
+    def close(self):
+        """
+        Stop the callback threads. Deferred callbacks that are already queued still run.
+        """
+        with self._budget_lock:
+            timers, self._rearm_timers = list(self._rearm_timers.values()), {}
+
+        for timer in timers:
+            timer.cancel()
+
+        self._pool.close()
+        self._deferred_pool.close()
+
+
+class HookGroup():
+    """Hooks added together, e.g. on every symbol matching a pattern, that are removed together
+    """
+    def __init__(self, manager, hooks, symbols=None):
+        """
+        :param CallbackManager manager: the manager the hooks were added to
+        :param list hooks: the hooks
+        :param dict symbols: symbol name to address, for each symbol the hooks are on
+        """
+        self._manager = manager
+        self._hooks = tuple(hooks)
+        self.symbols = dict(symbols or {})
+
+    @property
+    def hooks(self):
+        """The hooks in the group, or none once it's been removed"""
+        return self._hooks
+
+    def __len__(self):
+        return len(self._hooks)
+
+    def remove(self):
+        """
+        Remove every hook in the group, deleting their breakpoints in one batch. Removing it
+        again does nothing.
+        """
+        hooks, self._hooks = self._hooks, ()
+        self._manager.remove_callbacks(hooks)
+
+    def __repr__(self):
+        return f"HookGroup({len(self._hooks)} hooks, symbols={sorted(self.symbols)})"
+
+
+def _describe(addr):
+    """ Format a hook's address, or range of addresses, for messages """
+    start, end = span(addr)
+
+    return hex(start) if end == start + 1 else f"{hex(start)}-{hex(end)}"
+
+def _addresses(addr):
+    """ The addresses a hook's address or range covers, each needing a breakpoint """
+    return addr if isinstance(addr, range) else (addr,)
+
+def _covered(hooks):
+    """ The addresses a list of hooks cover, each once, in order """
+    return list(dict.fromkeys(exec_addr for _, addr, _ in hooks for exec_addr in _addresses(addr)))
+
+def _watch_args(addr):
+    """ The backend's arguments for a watchpoint covering a hook's address or range """
+    if not isinstance(addr, range):
+        return (addr,)
+
+    start, end = span(addr)
+
+    return (start, end - start)
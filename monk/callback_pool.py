@@ -0,0 +1,146 @@
+"""A pool of threads that run user callbacks.
+
+Callbacks used to get a brand new thread every time a hook was hit. Starting a thread costs far
+more than most callbacks take to run, and hot hooks get hit thousands of times a second, so the
+threads are kept around and reused instead.
+
+Callbacks run on these workers rather than on the thread that dispatches them because the
+workers are neither the main thread nor the backend's event thread, which is what stops
+callbacks from running, stopping or stepping the target.
+"""
+from queue import Queue
+import threading
+import logging
+
+# Number of worker threads to start with. Callbacks for a hit run one after another, so more
+# than one is only needed while a timed out callback is still holding on to its worker.
+DEFAULT_WORKERS = 2
+# Most callbacks submitted without waiting that can be queued up before more are dropped
+DEFAULT_MAX_PENDING = 10000
+
+
+class _Job():
+    """A callback handed to a worker, and whether it's finished"""
+    def __init__(self, callback, args=(), waited_for=True):
+        self.callback = callback
+        self.args = args
+        # Jobs that nobody waits for count against max_pending until they're done
+        self.waited_for = waited_for
+        self.done = threading.Event()
+        # Set when the dispatcher stops waiting for the callback. The worker running it is
+        # replaced, so it exits once the callback finally returns.
+        self.abandoned = False
+
+
+class CallbackPool():
+    """Runs callbacks on a set of reusable worker threads, waiting for each one to finish
+
+    Python can't kill a thread, so a callback that runs past the timeout is abandoned instead:
+    the dispatcher stops waiting for it and a fresh worker takes the hung one's place.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, timeout=None, max_pending=DEFAULT_MAX_PENDING):
+        """
+        :param int workers: the number of worker threads to start
+        :param float timeout: the most seconds to wait for a callback, or None to wait forever
+        :param int max_pending: the most submitted callbacks to queue up before dropping them
+        """
+        self.timeout = timeout
+        self.max_pending = max_pending
+        # Number of callbacks that were abandoned for running too long
+        self.timeouts = 0
+        # Number of submitted callbacks that were dropped because too many were queued up
+        self.dropped = 0
+
+        self._pending = 0
+
+        self._jobs = Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+
+        for _ in range(workers):
+            self._start_worker()
+
+    def _start_worker(self):
+        # Daemon threads, so that a hung callback can't keep the process alive
+        worker = threading.Thread(target=self._work, name="monk-callback", daemon=True)
+        self._workers.append(worker)
+        worker.start()
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+
+            if job is None:
+                return
+
+            try:
+                job.callback(*job.args)
+            except Exception:  # pylint:disable=broad-except
+                logging.getLogger(__name__).exception("callback raised an exception")
+
+            with self._lock:
+                job.done.set()
+
+                if not job.waited_for:
+                    self._pending -= 1
+
+                if job.abandoned:
+                    self._workers.remove(threading.current_thread())
+                    return
+
+    def run(self, callback):
+        """
+        Run a callback on a worker and wait for it to finish, or for the timeout
+
+        :param function callback: the callback to run
+        :rtype: bool
+        :returns: True if the callback finished, False if it timed out
+        """
+        job = _Job(callback)
+        self._jobs.put(job)
+
+        if job.done.wait(self.timeout):
+            return True
+
+        with self._lock:
+            # It may have finished just as we gave up on it
+            if job.done.is_set():
+                return True
+
+            job.abandoned = True
+            self.timeouts += 1
+            self._start_worker()
+
+        logging.getLogger(__name__).warning(f"callback {callback} timed out after "
+                                            f"{self.timeout}s, abandoning it")
+
+        return False
+
+    def submit(self, callback, *args):
+        """
+        Queue a callback to run on a worker, without waiting for it
+
+        :param function callback: the callback to run
+        :param args: the arguments to call it with
+        :rtype: bool
+        :returns: True if it was queued, False if it was dropped because too many callbacks
+        are already waiting
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.dropped += 1
+                return False
+
+            self._pending += 1
+
+        self._jobs.put(_Job(callback, args, waited_for=False))
+
+        return True
+
+    def close(self):
+        """Stop the workers once they've finished what they're running"""
+        with self._lock:
+            workers = list(self._workers)
+
+        for _ in workers:
+            self._jobs.put(None)
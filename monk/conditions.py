@@ -0,0 +1,264 @@
+"""Conditions that decide whether a hook's callback runs
+
+Conditions are built from registers, memory and constants with Python's operators, e.g. to only
+run a callback when r2 is a particular value and the word at sp+8 isn't zero:
+
+    (Reg('r2') == 0x1234) & (Mem(Reg('sp') + 8, 4) != 0)
+
+Values are unsigned. Comparisons are 1 when true and 0 when false, so & and | combine them;
+Python's own 'and', 'or' and 'not' can't be overloaded, so they aren't allowed. Use Not() to
+negate a condition.
+
+A condition can always be checked against the stopped target from the client. It's compiled
+once into nested closures, so checking it on every hit doesn't walk the expression again. The
+RSP backend can also hand it to the gdbstub, which checks it without stopping the target at all
+when it's false.
+"""
+import operator
+
+
+class MonkConditionError(Exception):
+    """Error raised when building or checking a condition"""
+
+
+class Expr():
+    """A value computed from the state of the stopped target"""
+    def compile(self):
+        """
+        Compile the expression into a function that computes its value
+
+        :rtype: function
+        :returns: a function that takes the backend to read registers and memory with, and
+        returns the value as an int
+        """
+        raise NotImplementedError
+
+    def evaluate(self, backend):
+        """
+        Compute the value against the stopped target. Use compile() to compute it repeatedly.
+
+        :param backend: the backend to read registers and memory with
+        :rtype: int
+        """
+        return self.compile()(backend)
+
+    def __add__(self, other):
+        return BinOp('+', self, as_expr(other))
+
+    def __sub__(self, other):
+        return BinOp('-', self, as_expr(other))
+
+    def __and__(self, other):
+        return BinOp('&', self, as_expr(other))
+
+    def __or__(self, other):
+        return BinOp('|', self, as_expr(other))
+
+    def __eq__(self, other):
+        return Compare('==', self, as_expr(other))
+
+    def __ne__(self, other):
+        return Compare('!=', self, as_expr(other))
+
+    def __lt__(self, other):
+        return Compare('<', self, as_expr(other))
+
+    def __le__(self, other):
+        return Compare('<=', self, as_expr(other))
+
+    def __gt__(self, other):
+        return Compare('>', self, as_expr(other))
+
+    def __ge__(self, other):
+        return Compare('>=', self, as_expr(other))
+
+    __hash__ = object.__hash__
+
+    def __bool__(self):
+        # Stops 'a and b' from quietly meaning just b
+        raise MonkConditionError("Conditions can't be used as bools, combine them with & and |")
+
+
+class Const(Expr):
+    """A constant"""
+    def __init__(self, value):
+        """
+        :param int value: the value, which can't be negative
+        """
+        if value < 0:
+            raise MonkConditionError(f"Condition constants are unsigned, got {value}")
+
+        self.value = value
+
+    def compile(self):
+        value = self.value
+        return lambda backend: value
+
+    def __repr__(self):
+        return hex(self.value)
+
+
+class Reg(Expr):
+    """The value of a register"""
+    def __init__(self, name):
+        """
+        :param str name: the name of the register, e.g. 'r2'
+        """
+        self.name = name
+
+    def compile(self):
+        name = self.name
+        return lambda backend: backend.get_reg(name)
+
+    def __repr__(self):
+        return f"Reg({self.name!r})"
+
+
+class Mem(Expr):
+    """An unsigned integer in target memory"""
+    def __init__(self, addr, size=4):
+        """
+        :param Expr|int addr: the address of the integer
+        :param int size: the size of the integer in bytes; 1, 2, 4 or 8
+        """
+        if size not in (1, 2, 4, 8):
+            raise MonkConditionError(f"Can't read a {size} byte integer in a condition")
+
+        self.addr = as_expr(addr)
+        self.size = size
+
+    def compile(self):
+        addr = self.addr.compile()
+        size = self.size
+
+        return lambda backend: int.from_bytes(backend.read_bytes(addr(backend), size),
+                                              backend.endian)
+
+    def __repr__(self):
+        return f"Mem({self.addr!r}, {self.size})"
+
+
+_binops = {
+    '+': operator.add,
+    '-': operator.sub,
+    '&': operator.and_,
+    '|': operator.or_,
+}
+
+_comparisons = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class BinOp(Expr):
+    """Arithmetic or bitwise operation on two values"""
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def compile(self):
+        op = _binops[self.op]
+        left = self.left.compile()
+        right = self.right.compile()
+
+        return lambda backend: op(left(backend), right(backend))
+
+    def __repr__(self):
+        return f"({self.left!r} {self.op} {self.right!r})"
+
+
+class Compare(Expr):
+    """Comparison of two values, 1 if it holds and 0 if not"""
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def compile(self):
+        op = _comparisons[self.op]
+        left = self.left.compile()
+        right = self.right.compile()
+
+        return lambda backend: int(op(left(backend), right(backend)))
+
+    def __repr__(self):
+        return f"({self.left!r} {self.op} {self.right!r})"
+
+
+class Not(Expr):
+    """1 if a value is zero, otherwise 0"""
+    def __init__(self, expr):
+        self.expr = as_expr(expr)
+
+    def compile(self):
+        expr = self.expr.compile()
+        return lambda backend: int(not expr(backend))
+
+    def __repr__(self):
+        return f"Not({self.expr!r})"
+
+
+class In(Expr):
+    """1 if a value is one of a set of values, otherwise 0"""
+    def __init__(self, expr, values):
+        """
+        :param Expr|int expr: the value
+        :param iterable values: the ints to look for it in
+        """
+        self.expr = as_expr(expr)
+        self.values = frozenset(values)
+
+        if any(value < 0 for value in self.values):
+            raise MonkConditionError("Condition constants are unsigned")
+
+    def compile(self):
+        expr = self.expr.compile()
+        values = self.values
+
+        return lambda backend: int(expr(backend) in values)
+
+    def __repr__(self):
+        return f"In({self.expr!r}, {sorted(self.values)})"
+
+
+class All(Expr):
+    """1 if every one of some values is non-zero, otherwise 0. Stops at the first zero."""
+    def __init__(self, *exprs):
+        self.exprs = [as_expr(expr) for expr in exprs]
+
+    def compile(self):
+        exprs = [expr.compile() for expr in self.exprs]
+        return lambda backend: int(all(expr(backend) for expr in exprs))
+
+    def __repr__(self):
+        return f"All({', '.join(repr(expr) for expr in self.exprs)})"
+
+
+class Any(Expr):
+    """1 if any of some values is non-zero, otherwise 0. Stops at the first non-zero one."""
+    def __init__(self, *exprs):
+        self.exprs = [as_expr(expr) for expr in exprs]
+
+    def compile(self):
+        exprs = [expr.compile() for expr in self.exprs]
+        return lambda backend: int(any(expr(backend) for expr in exprs))
+
+    def __repr__(self):
+        return f"Any({', '.join(repr(expr) for expr in self.exprs)})"
+
+
+def as_expr(value):
+    """Let plain ints be used wherever an Expr can be"""
+    if isinstance(value, Expr):
+        return value
+
+    if isinstance(value, int):
+        return Const(value)
+
+    raise MonkConditionError(f"Can't use {value!r} in a condition")
@@ -0,0 +1,40 @@
+"""vCPUs of an SMP target
+"""
+
+
+class Cpu():
+    """A vCPU of the target, with its own registers. Memory is shared, and read through Monk.
+    """
+    def __init__(self, backend, cpu_id):
+        """
+        :param backend: the backend to read registers with
+        :param str cpu_id: the vCPU's id, as the backend knows it, e.g. 'p01.02'
+        """
+        self._backend = backend
+        self.id = cpu_id
+
+    def get_reg(self, regname):
+        """Read one of the vCPU's registers
+
+        :param str regname: the name of the register to read
+        :rtype: int
+        :returns: the register value
+        """
+        return self._backend.get_reg(regname, self.id)
+
+    def write_reg(self, regname, val):
+        """Write one of the vCPU's registers
+
+        :param str regname: the name of the register to write to
+        :param int val: the value to write
+        """
+        self._backend.write_reg(regname, val, self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, Cpu) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"Cpu({self.id!r})"
@@ -0,0 +1,152 @@
+"""An index of values by the ranges of addresses they cover
+
+Hooks used to be kept in a dict keyed by their exact address, which can't answer "which hooks
+cover this address" for hooks on a whole struct or function. IntervalIndex answers it with a
+dict lookup for the hooks on single addresses, and a binary search for the ones on ranges: the
+boundaries of every range split the address space into segments, and each segment keeps the
+ranges that cover all of it.
+
+Hooks on single addresses never need the segments, so adding or removing them is O(1) however
+they're interleaved with lookups. Working the segments out for the ranges costs O(n log n) to
+sort their boundaries, plus an entry for every segment each range spans. Ranges added since
+the segments were last worked out are checked one by one until there are enough of them to be
+worth working the segments out again, and removed ones are skipped until then, so adding or
+removing thousands of ranges costs a handful of rebuilds, not one per range.
+"""
+import bisect
+import threading
+
+# The most ranges to check one by one before working the segments out again
+PENDING_LIMIT = 64
+
+
+def span(key):
+    """
+    Get the addresses a key covers
+
+    :param int|range key: an address, or a range of addresses
+    :rtype: tuple
+    :returns: (start, end), end exclusive
+    """
+    if isinstance(key, range):
+        return key.start, key.stop
+
+    return key, key + 1
+
+
+class IntervalIndex():
+    """Values keyed by an address or a range of addresses, looked up by any address they cover
+
+    A range with a step only covers the addresses it steps through, e.g. range(0x1000, 0x1010, 4)
+    covers the instructions of a function with 4 byte instructions, but not 0x1002.
+    """
+    def __init__(self):
+        # Key to the values added for it, in the order they were added, and to when the key was
+        # first added, which orders lookups
+        self._values = {}
+        self._order = {}
+        self._added = 0
+        # Sorted boundaries of the segments, and for each segment between one boundary and
+        # the next, the ranges that cover it. Ranges that have been removed since are skipped.
+        self._bounds = []
+        self._segments = []
+        self._segmented = set()
+        # Ranges added since the segments were worked out
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def add(self, key, value):
+        """
+        Add a value for an address or a range of addresses
+
+        :param int|range key: the address, or range of addresses
+        :param value: the value
+        :raises ValueError: if the range is empty or steps backwards
+        """
+        if isinstance(key, range) and (not key or key.step < 0):
+            raise ValueError(f"{key} doesn't cover any addresses going up")
+
+        with self._lock:
+            if key not in self._values:
+                self._order[key] = self._added
+                self._added += 1
+
+                if isinstance(key, range) and key not in self._segmented:
+                    self._pending.append(key)
+
+            self._values.setdefault(key, []).append(value)
+
+    def remove(self, key, value):
+        """
+        Remove a value added for a key
+
+        :param int|range key: the key it was added for
+        :param value: the value
+        :raises ValueError: if the value wasn't added for the key
+        """
+        with self._lock:
+            values = self._values.get(key, [])
+            values.remove(value)
+
+            if not values:
+                del self._values[key]
+                del self._order[key]
+
+                if key in self._pending:
+                    self._pending.remove(key)
+
+    def __getitem__(self, key):
+        """
+        Get the values added for exactly this key
+
+        :param int|range key: the key
+        :rtype: list
+        """
+        with self._lock:
+            return list(self._values.get(key, []))
+
+    def __len__(self):
+        return len(self._values)
+
+    def at(self, addr):
+        """
+        Get the values of every key that covers an address
+
+        :param int addr: the address
+        :rtype: list
+        :returns: (key, value) for each value, keys in the order they were first added
+        """
+        with self._lock:
+            if len(self._pending) > PENDING_LIMIT:
+                self._rebuild()
+
+            keys = [key for key in self._pending if addr in key]
+
+            if addr in self._values:
+                keys.append(addr)
+
+            segment = bisect.bisect_right(self._bounds, addr) - 1
+
+            if 0 <= segment < len(self._segments):
+                keys += [key for key in self._segments[segment]
+                         if key in self._values and addr in key]
+
+            keys.sort(key=self._order.__getitem__)
+
+            return [(key, value) for key in keys for value in self._values[key]]
+
+    def _rebuild(self):
+        ranges = [key for key in self._values if isinstance(key, range)]
+        self._bounds = sorted({bound for key in ranges for bound in span(key)})
+        self._segments = [[] for _ in self._bounds]
+
+        for key in ranges:
+            start, end = span(key)
+            first = bisect.bisect_left(self._bounds, start)
+            last = bisect.bisect_left(self._bounds, end)
+
+            for segment in self._segments[first:last]:
+                segment.append(key)
+
+        self._segmented = set(ranges)
+        self._pending = []
@@ -0,0 +1,113 @@
+"""Declarative predicates for filtering hooks
+
+Each of these builds a condition (see monk.conditions) out of the things hooks usually filter
+on: a register's value, a field of a kernel struct, or a run of bytes in memory. Pass them to
+Callback.add_hook, and the hook's callback only runs when all of them hold:
+
+    self.add_hook("__switch_to", self.run, reg_equals('r2', thread),
+                  field_in(target.structs.TaskStruct, 'pid', {1, 42}, base=task))
+
+Predicates are compiled once, when the hook is added, and checked on the event thread before
+anything else happens, so a hit that doesn't match just resumes the target.
+"""
+from monk.conditions import Reg, Mem, In, All, MonkConditionError, as_expr
+
+# Sizes Mem can read in one go, largest first
+_chunk_sizes = (8, 4, 2, 1)
+
+
+def reg_equals(reg, value):
+    """
+    A register has a value
+
+    :param str reg: the name of the register
+    :param int value: the value
+    :rtype: Expr
+    """
+    return Reg(reg) == value
+
+
+def reg_in(reg, values):
+    """
+    A register has one of some values
+
+    :param str reg: the name of the register
+    :param iterable values: the values
+    :rtype: Expr
+    """
+    return In(Reg(reg), values)
+
+
+def field(struct, name, base):
+    """
+    The value of an integer field of a kernel struct
+
+    :param class struct: the struct, e.g. target.structs.TaskStruct
+    :param str name: the name of the field
+    :param Expr|int|str base: the address of the struct, or the name of a register holding it
+    :rtype: Expr
+    """
+    try:
+        size = struct.field_sizes[name]
+        offset = getattr(struct, f"{name}_offset")
+    except (KeyError, AttributeError) as e:
+        raise MonkConditionError(f"{struct.name} has no integer field '{name}'") from e
+
+    return Mem(_base(base) + offset, size)
+
+
+def field_equals(struct, name, value, base):
+    """
+    An integer field of a kernel struct has a value
+
+    :param class struct: the struct, e.g. target.structs.TaskStruct
+    :param str name: the name of the field
+    :param int value: the value
+    :param Expr|int|str base: the address of the struct, or the name of a register holding it
+    :rtype: Expr
+    """
+    return field(struct, name, base) == value
+
+
+def field_in(struct, name, values, base):
+    """
+    An integer field of a kernel struct has one of some values
+
+    :param class struct: the struct, e.g. target.structs.TaskStruct
+    :param str name: the name of the field
+    :param iterable values: the values
+    :param Expr|int|str base: the address of the struct, or the name of a register holding it
+    :rtype: Expr
+    """
+    return In(field(struct, name, base), values)
+
+
+def bytes_equal(addr, data, endian):
+    """
+    Memory holds some bytes, e.g. a NUL terminated string. The bytes are compared up to eight
+    at a time.
+
+    :param Expr|int|str addr: the address, or the name of a register holding it
+    :param bytes data: the bytes
+    :param str endian: the target's endianness, 'big' or 'little'
+    :rtype: Expr
+    """
+    addr = _base(addr)
+    checks = []
+    offset = 0
+
+    while offset < len(data):
+        size = next(size for size in _chunk_sizes if size <= len(data) - offset)
+        chunk = int.from_bytes(data[offset:offset + size], endian)
+        checks.append(Mem(addr + offset, size) == chunk)
+        offset += size
+
+    return All(*checks)
+
+
+def _base(base):
+    """Register names stand for the register's value"""
+    if isinstance(base, str):
+        return Reg(base)
+
+    return as_expr(base)
@@ -0,0 +1,148 @@
+"""Snapshots of the stopped target, for deferred hooks
+
+A deferred hook doesn't keep the target stopped while its callback runs. Instead, the event
+thread reads the registers and memory the hook declared it needs, resumes the target straight
+away, and hands the callback a Snapshot of what it read:
+
+    capture = Capture(registers=['pc', 'r2'], memory=[(Reg('r2') + 0x10, 16)])
+    target.on_execute(addr, record, deferred=True, capture=capture)
+
+The callback runs later, on a worker, while the target carries on, so it can't read the target
+itself; everything it needs has to be in the snapshot. That makes guest slowdown depend only on
+how much is captured, not on how long the analysis takes.
+"""
+import time
+from types import MappingProxyType
+
+from monk.conditions import as_expr
+
+
+class MonkSnapshotError(Exception):
+    """Error raised when capturing or reading a snapshot"""
+
+
+class Capture():
+    """What a deferred hook captures when it's hit"""
+    def __init__(self, registers=(), memory=()):
+        """
+        :param iterable registers: the names of the registers to capture
+        :param iterable memory: (address, size) of each range of memory to capture. The address
+        can be an Expr from monk.conditions, e.g. Reg('r2') + 8, which is worked out at the hit.
+        """
+        self.registers = tuple(registers)
+        self.memory = tuple((as_expr(addr), size) for addr, size in memory)
+
+        # Compile the addresses now rather than on every hit
+        self._addrs = [addr.compile() for addr, _ in self.memory]
+
+    def take(self, backend, kind, addr):
+        """
+        Capture a snapshot of the stopped target. The memory ranges are read in one batch.
+
+        :param backend: the backend to read registers and memory with
+        :param str kind: the kind of event that was hit
+        :param int addr: the address of the hook that was hit
+        :rtype: Snapshot
+        """
+        registers = {name: backend.get_reg(name) for name in self.registers}
+        ranges = [(addr_fn(backend), size)
+                  for addr_fn, (_, size) in zip(self._addrs, self.memory)]
+        data = backend.read_many(ranges) if ranges else []
+
+        return Snapshot(kind, addr, registers, zip(ranges, data), backend.current_cpu())
+
+    def __repr__(self):
+        return f"Capture(registers={list(self.registers)}, memory={list(self.memory)})"
+
+
+class Snapshot():
+    """The registers and memory a deferred hook captured when it was hit. It can't be changed."""
+    __slots__ = ('_kind', '_addr', '_cpu', '_time', '_registers', '_memory')
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, kind, addr, registers, memory, cpu=None):
+        """
+        :param str kind: the kind of event that was hit
+        :param int addr: the address of the hook that was hit
+        :param dict registers: register name to value
+        :param iterable memory: ((address, size), bytes) of each range read
+        :param str cpu: the id of the vCPU that hit the hook, or None if it isn't known
+        """
+        object.__setattr__(self, '_kind', kind)
+        object.__setattr__(self, '_addr', addr)
+        object.__setattr__(self, '_cpu', cpu)
+        object.__setattr__(self, '_time', time.monotonic())
+        object.__setattr__(self, '_registers', MappingProxyType(dict(registers)))
+
+        # If two ranges start at the same address, keep the longer one
+        ranges = {}
+
+        for (start, _), data in memory:
+            if len(data) >= len(ranges.get(start, b'')):
+                ranges[start] = bytes(data)
+
+        object.__setattr__(self, '_memory', MappingProxyType(ranges))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshots can't be changed")
+
+    @property
+    def kind(self):
+        """The kind of event that was hit, e.g. 'execute'"""
+        return self._kind
+
+    @property
+    def addr(self):
+        """The address of the hook that was hit"""
+        return self._addr
+
+    @property
+    def cpu(self):
+        """The id of the vCPU that hit the hook, whose registers were captured, or None"""
+        return self._cpu
+
+    @property
+    def time(self):
+        """When the snapshot was taken, in time.monotonic() seconds"""
+        return self._time
+
+    @property
+    def registers(self):
+        """A read-only mapping of register name to value"""
+        return self._registers
+
+    @property
+    def memory(self):
+        """A read-only mapping of the start of each range captured to its bytes"""
+        return self._memory
+
+    def get_reg(self, regname):
+        """
+        Get a captured register's value
+
+        :param str regname: the name of the register
+        :rtype: int
+        :raises MonkSnapshotError: if the register wasn't captured
+        """
+        try:
+            return self._registers[regname]
+        except KeyError as e:
+            raise MonkSnapshotError(f"Register '{regname}' wasn't captured") from e
+
+    def read_bytes(self, addr, size):
+        """
+        Read bytes from the captured memory
+
+        :param int addr: the address to read from
+        :param int size: the number of bytes to read
+        :rtype: bytes
+        :raises MonkSnapshotError: if no captured range holds all of the bytes
+        """
+        for start, data in self._memory.items():
+            if start <= addr and addr + size <= start + len(data):
+                return data[addr - start:addr - start + size]
+
+        raise MonkSnapshotError(f"{size} bytes at {hex(addr)} weren't captured")
+
+    def __repr__(self):
+        return f"Snapshot({self._kind}, {hex(self._addr)}, registers={dict(self._registers)})"
@@ -0,0 +1,207 @@
+"""Per-hook statistics, for finding the hooks that slow the guest down
+
+Every time a hook's breakpoint stops the target, the CallbackManager records it against the
+hook, along with how long each stage of handling the stop took:
+
+    dispatch: from the event thread picking up the stop to the hooks being looked up
+    callback: how long the target waited for the hook's callback, or for a deferred hook's
+              snapshot to be captured
+    resume:   from the callbacks finishing to the target running again, including stepping
+              over the breakpoint to re-arm it
+
+Durations go in fixed-size histograms, so recording costs the same however long a hook's been
+hit for, and a report takes no more memory after a million hits than after one.
+
+    print(target.hook_stats().to_json())
+"""
+import bisect
+import json
+import threading
+
+from monk.intervals import span
+
+# Upper bounds of the histogram buckets, in seconds: 1us, 2us, 4us... up to about 8s. One more
+# bucket catches anything slower.
+BUCKET_BOUNDS = tuple(1e-6 * 2 ** i for i in range(24))
+
+STAGES = ('dispatch', 'callback', 'resume')
+
+
+class Histogram():
+    """Durations counted into power of two buckets, with their exact count, total and max"""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """
+        Count a duration
+
+        :param float seconds: the duration
+        """
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self):
+        """The mean duration in seconds, or 0 if nothing's been recorded"""
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, pct):
+        """
+        Estimate a percentile, as the upper bound of the bucket it falls in
+
+        :param float pct: the percentile, 0-100
+        :rtype: float
+        :returns: the duration in seconds, or 0 if nothing's been recorded
+        """
+        if not self.count:
+            return 0.0
+
+        rank = pct / 100 * self.count
+        seen = 0
+
+        for bound, count in zip(BUCKET_BOUNDS, self.counts):
+            seen += count
+
+            if seen >= rank:
+                return min(bound, self.max)
+
+        return self.max
+
+    def to_dict(self):
+        """
+        :rtype: dict
+        :returns: the counts of the buckets that aren't empty, keyed by their upper bound in
+        seconds ('inf' for the last), and a summary
+        """
+        bounds = [str(bound) for bound in BUCKET_BOUNDS] + ['inf']
+
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.mean,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'buckets': {bound: count for bound, count in zip(bounds, self.counts) if count}
+        }
+
+
+class HookStats():
+    """What one hook has cost the target"""
+    def __init__(self, kind, addr, callback):
+        """
+        :param str kind: the kind of event the hook is on, e.g. 'execute'
+        :param int|range addr: the address, or range of addresses, it's on
+        :param function callback: its callback
+        """
+        self.kind = kind
+        self.addr = addr
+        self.callback = callback
+        # Stops for an address the hook covers, and how many of them ran the callback
+        self.hits = 0
+        self.runs = 0
+        self.histograms = {stage: Histogram() for stage in STAGES}
+
+    @property
+    def overhead(self):
+        """The total seconds the target has spent stopped for the hook, over every stage"""
+        return sum(histogram.total for histogram in self.histograms.values())
+
+    def to_dict(self):
+        """
+        :rtype: dict
+        """
+        start, stop = span(self.addr)
+
+        return {
+            'kind': self.kind,
+            'addr': hex(start) if stop == start + 1 else f"{hex(start)}-{hex(stop)}",
+            'callback': getattr(self.callback, '__qualname__', repr(self.callback)),
+            'hits': self.hits,
+            'runs': self.runs,
+            'overhead': self.overhead,
+            **{stage: histogram.to_dict() for stage, histogram in self.histograms.items()}
+        }
+
+
+class StatsRecorder():
+    """Keeps the HookStats of every hook. The event thread records, any thread can report."""
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _get(self, hook):
+        stats = self._stats.get(hook)
+
+        if stats is None:
+            stats = self._stats[hook] = HookStats(*hook)
+
+        return stats
+
+    def hit(self, hook, ran):
+        """
+        Count a stop for a hook
+
+        :param tuple hook: the hook, (kind, addr, callback)
+        :param bool ran: whether its condition held, so its callback ran
+        """
+        with self._lock:
+            stats = self._get(hook)
+            stats.hits += 1
+            stats.runs += int(ran)
+
+    def record(self, hook, stage, seconds):
+        """
+        Record how long a stage of handling a stop took for a hook that's been hit. A hook
+        removed since is left out.
+
+        :param tuple hook: the hook
+        :param str stage: one of STAGES
+        :param float seconds: the duration
+        """
+        with self._lock:
+            stats = self._stats.get(hook)
+
+            if stats is not None:
+                stats.histograms[stage].record(seconds)
+
+    def forget(self, hook):
+        """
+        Drop a hook's stats, once it's been removed
+
+        :param tuple hook: the hook
+        """
+        with self._lock:
+            self._stats.pop(hook, None)
+
+    def reset(self):
+        """Drop every hook's stats"""
+        with self._lock:
+            self._stats.clear()
+
+    def report(self):
+        """
+        :rtype: StatsReport
+        :returns: a copy of the stats as they are now
+        """
+        with self._lock:
+            return StatsReport([stats.to_dict() for stats in self._stats.values()])
+
+
+class StatsReport(list):
+    """The stats of every hook, as dicts, most expensive first"""
+    def __init__(self, hooks):
+        super().__init__(sorted(hooks, key=lambda stats: stats['overhead'], reverse=True))
+
+    def to_json(self, indent=None):
+        """
+        :param int indent: the indent to pretty print with, or None for one line
+        :rtype: str
+        """
+        return json.dumps(list(self), indent=indent)
@@ -78,6 +78,41 @@ class Dwarf2JsonLoader:
 
         return s
 
+    def get_code_addresses(self):
+        """Get the address of every symbol in code, i.e. every function, leaving out data like
+        sys_call_table that mustn't have breakpoints written over it
+
+        A symbol with a type is code if its type is a function. One without, e.g. from
+        System.map, is code if it's between _stext and _etext. If those aren't there either,
+        there's no telling, and it's left out.
+
+        :rtype: dict
+        :returns: symbol name to address
+        """
+        symbols = self._json.get('symbols', {})
+        text_start = self.find_symbol_address('_stext')
+        text_end = self.find_symbol_address('_etext')
+        ret = {}
+
+        for name, attrs in symbols.items():
+            addr = attrs.get('address')
+
+            if addr is None:
+                continue
+
+            kind = (attrs.get('type') or {}).get('kind')
+
+            if kind is not None:
+                code = kind == 'function'
+            else:
+                code = text_start is not None and text_end is not None and \
+                    text_start <= addr < text_end
+
+            if code:
+                ret[name] = addr
+
+        return ret
+
     def get_defined_struct_names(self):
         """Get a list of all kernel struct names
         """
@@ -89,10 +89,14 @@ class AttributeGenerator():
         :returns: The getter function
         :rtype: function
         """
-        read_fn = self._get_read_fn(elem_size)
-        return lambda x: [read_fn(a) for a in range(x.base + offset,
-                                                    x.base + offset + (num_elems * elem_size),
-                                                    elem_size)]
+        # Read the whole array at once rather than one element at a time, then split it up
+        def read_list(x):
+            data = self.backend.read_bytes(x.base + offset, num_elems * elem_size)
+
+            return [int.from_bytes(data[i:i + elem_size], self.backend.endian)
+                    for i in range(0, len(data), elem_size)]
+
+        return read_list
 
     def gen_bitfield_prop(self, offset, field_size, bit_position, bit_length):
         """
@@ -175,7 +179,7 @@ class AttributeGenerator():
 
             for field in newstruct.dir():
                 if not field.startswith('_') and not field.endswith('_offset') \
-                   and field not in ('base', 'name'):
+                   and field not in ('base', 'name', 'field_sizes'):
                     setattr(member_struct, field, getattr(newstruct, field))
 
         return write_struct
@@ -297,6 +301,9 @@ def _gen_attributes(cls, backend, d2json, class_type_map):
     """
     attribute_generator = AttributeGenerator(backend)
     attr_list = []
+    # Size in bytes of each integer and array field, so that hook predicates can read a field
+    # without going through its property
+    cls.field_sizes = {}
 
     # For every field defined for this struct
     for field, attributes in d2json.get_struct_fields(cls.name).items():
@@ -320,6 +327,7 @@ def _gen_attributes(cls, backend, d2json, class_type_map):
             setattr(cls, field,
                     property(attribute_generator.gen_uint_prop(offset, size),
                              attribute_generator.gen_uint_setter(offset, size)))
+            cls.field_sizes[field] = size
         elif field_type in class_types:
             c = class_type_map[d2json.get_struct_name(attributes)]
             setattr(cls, field,
@@ -331,6 +339,7 @@ def _gen_attributes(cls, backend, d2json, class_type_map):
             setattr(cls, field,
                     property(attribute_generator.gen_list_prop(offset, elem_size, num_elems),
                              attribute_generator.gen_list_setter(offset, elem_size, num_elems)))
+            cls.field_sizes[field] = num_elems * elem_size
         elif field_type == 'bitfield':
             # XXX IN PROGRESS
             base_type, bit_position, bit_length = d2json.get_bitfield_info(attributes)
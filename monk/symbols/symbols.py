@@ -1,5 +1,7 @@
 """Expose user-facing symbols API
 """
+import fnmatch
+import re
 
 from monk.symbols.dwarf2json_loader import Dwarf2JsonLoader
 from monk.symbols.structs import Structs
@@ -16,6 +18,7 @@ class Symbols():
             self.addr_size = self._dwarf2json.get_addr_size()
         else:
             self.lookup = lambda x, y: None
+            self.match = lambda pattern: {}
             self.structs = None
             self.types = None
             self.endian = "little"
@@ -32,3 +35,20 @@ class Symbols():
         addr = self._dwarf2json.find_symbol_address(symbol)
 
         return addr
+
+    # pylint:disable=method-hidden
+    def match(self, pattern):
+        """
+        Find every function whose name matches a pattern, in one pass over the symbol table.
+        Data symbols are left out, see Dwarf2JsonLoader.get_code_addresses().
+
+        :param str|re.Pattern pattern: a glob, e.g. 'sys_*', or a compiled regex, which has to
+        match the whole name
+        :rtype: dict
+        :returns: symbol name to address, for each function that matched
+        """
+        if isinstance(pattern, str):
+            pattern = re.compile(fnmatch.translate(pattern))
+
+        return {name: addr for name, addr in self._dwarf2json.get_code_addresses().items()
+                if pattern.fullmatch(name)}
@@ -1,7 +1,8 @@
 """Core introspection framework
 """
 from monk import backends
-from monk.callback_manager import CallbackManager
+from monk.callback_manager import CallbackManager, HookGroup
+from monk.cpu import Cpu
 from monk.symbols import Symbols
 
 class Monk():
@@ -9,19 +10,23 @@ class Monk():
 
     Exposes all of the core target control, memory access, and breakpoint functionality.
     """
-    def __init__(self, host='localhost', port=1234, symbols=None, backend='rsp'):
+    def __init__(self, host='localhost', port=1234, symbols=None, backend='rsp',
+                 callback_timeout=None):
         """
         Creates a new Monk instance connected to the target specified by host and port.
 
         :param string host: the host of the target
         :param int port: the port the GDB stub is hosted on
         :param string symbols: the path to the symbols file generated by dwarf2json
-        :param class backend: the backend to use (rsp or gdb)
+        :param class backend: the backend to use (rsp, rsp-asyncio, rsp-nonstop or gdb)
+        :param float callback_timeout: the most seconds a callback can keep the target stopped
+        before it's abandoned, or None to wait forever
         """
         # Should prob do some error checking that backend is actually a class, and if not,
         # search the "backends" directory for a module matching the supplied value
         self._backend = backends.backend_map[backend](host, port)
-        self._callback_manager = CallbackManager(self._backend)
+        self._callback_manager = CallbackManager(self._backend,
+                                                 callback_timeout=callback_timeout)
         self.symbols = Symbols(symbols, self._backend)
         self.structs = self.symbols.structs
         self.types = self.symbols.types
@@ -82,14 +87,41 @@ class Monk():
         """
         return self._backend.read_uint64(addr)
 
-    def get_reg(self, regname):
+    def read_bytes(self, addr, size):
+        """Read a range of memory in one go
+
+        :param int addr: the address to read from
+        :param int size: the number of bytes to read
+        :rtype: bytes
+        :returns: the bytes read
+        """
+        return self._backend.read_bytes(addr, size)
+
+    def read_many(self, ranges):
+        """Read several ranges of memory in one go. Use this when you know up front
+        everything you need to read, e.g. a few fields of a struct; backends that can will
+        batch the reads together.
+
+            pid, comm = m.read_many([(task + pid_offset, 4), (task + comm_offset, 16)])
+
+        :param list ranges: (address, size) of each range to read
+        :rtype: list
+        :returns: the bytes read for each range, in the same order as ranges
+        """
+        return self._backend.read_many(ranges)
+
+    def get_reg(self, regname, cpu=None):
         """Read a register
 
         :param str regname: the name of the register to read
+        :param str cpu: the id of the vCPU to read it from, or None for the one that stopped
         :rtype: int
         :returns: the register value
         """
-        return self._backend.get_reg(regname)
+        if cpu is None:
+            return self._backend.get_reg(regname)
+
+        return self._backend.get_reg(regname, cpu)
 
     # Write
     def write_uint8(self, addr, val):
@@ -124,19 +156,55 @@ class Monk():
         """
         self._backend.write_uint64(addr, val)
 
-    def write_reg(self, regname, val):
+    def write_bytes(self, addr, data):
+        """Write a range of memory in one go
+
+        :param int addr: the address to write to
+        :param bytes data: the bytes to write
+        """
+        self._backend.write_bytes(addr, data)
+
+    def write_reg(self, regname, val, cpu=None):
         """Write to a register
         
         :param str regname: the name of the register to write to
         :param int val: the value to write
+        :param str cpu: the id of the vCPU to write it in, or None for the one that stopped
+        """
+        if cpu is None:
+            self._backend.write_reg(regname, val)
+        else:
+            self._backend.write_reg(regname, val, cpu)
+
+    # === vCPUs ===
+    @property
+    def cpus(self):
+        """The target's vCPUs. Registers are per vCPU, so on an SMP guest use these to read
+        the registers of a vCPU other than the one that stopped.
+
+        :rtype: list
+        :returns: a Cpu for each vCPU
+        """
+        return [Cpu(self._backend, cpu_id) for cpu_id in self._backend.cpus()]
+
+    @property
+    def current_cpu(self):
+        """The vCPU the target last stopped for, e.g. the one that hit a hook
+
+        :rtype: Cpu
+        :returns: the vCPU, or None if the backend doesn't say
         """
-        self._backend.write_reg(regname, val)
+        cpu_id = self._backend.current_cpu()
+
+        return None if cpu_id is None else Cpu(self._backend, cpu_id)
 
     # === Execution ===
     # Control
     def run(self):
-        """Run the target
+        """Run the target. Hooks disarmed for going over their budgets whose time is up are
+        re-armed first.
         """
+        self._callback_manager.rearm_due()
         self._backend.run()
 
     def stop(self):
@@ -149,46 +217,195 @@ class Monk():
         """
         self._backend.step()
 
+    def step_n(self, count):
+        """Step the target by a number of instructions. Hooks don't run for the instructions
+        stepped through, which keeps each step down to a single round trip to the stub.
+
+        :param int count: the number of instructions to step
+        :rtype: list
+        :returns: the pc after each step
+        """
+        return self._backend.step_n(count)
+
+    def step_until(self, until, max_steps=None):
+        """Step the target until a condition on the pc holds, e.g. to trace a process until
+        it enters the kernel:
+
+            pcs = target.step_until(lambda pc: pc >= 0xc0000000)
+
+        Hooks don't run for the instructions stepped through. An (start, end) range steps
+        through the range until the pc leaves it; stubs that support range stepping do that
+        without stopping, so only the pc the range is left at is returned.
+
+        :param function|tuple until: a function that takes the pc and returns True to stop,
+        or an (start, end) range of addresses, end exclusive, to step through
+        :param int max_steps: the most instructions to single step, or None for the backend's
+        default
+        :rtype: list
+        :returns: the pc after each stop
+        """
+        return self._backend.step_until(until, max_steps)
+
     def shutdown(self):
         """Shutdown the connection to the target
         """
         self._backend.shutdown()
+        self._callback_manager.close()
 
     # Hooks
     # This isn't really a user-facing API, but it can be used safely by a user if they
     # want to. callbacks.py defines the various callback classes, which have a nicer
     # user interface and can be subclassed to do complex tasks more cleanly.
-    def on_execute(self, addr, callback):
+    def on_execute(self, addr, callback, condition=None, deferred=False, capture=None,
+                   budget=None):
         """Add a callback that runs on execution of an address
 
-        :param int addr: the address that, when executed, will cause the callback to run
+        :param int|range addr: the address that, when executed, will cause the callback to run,
+        or a range of instruction addresses, e.g. range(start, end, 4) for a function with 4
+        byte instructions. Each one gets a breakpoint.
         :param function callback: the function to run when the address is executed
+        :param Expr condition: a condition from monk.conditions, e.g. Reg('r2') == 0x1234,
+        that has to hold for the callback to run
+        :param bool deferred: resume the target as soon as the hook is hit, and run the
+        callback later on a worker, passing it a monk.snapshot.Snapshot
+        :param Capture capture: the registers and memory a deferred callback's snapshot holds
+        :param Budget budget: how often the callback is allowed to run, see monk.budget.Budget.
+        Hits over its budget are skipped, with the breakpoint taken out where the stub allows.
         """
-        return self._callback_manager.on_execute(addr, callback)
+        return self._callback_manager.on_execute(addr, callback, condition, deferred, capture,
+                                                 budget)
+
+    def on_execute_pattern(self, pattern, callback, condition=None, deferred=False,
+                           capture=None, budget=None):
+        """Add a callback that runs on execution of any function whose name matches a pattern,
+        e.g. every syscall with 'sys_*'. Data symbols that match, like sys_call_table, aren't
+        hooked. The matches are found in one pass over the symbol table, and their breakpoints
+        are set in one pipelined batch, so hooking thousands of functions doesn't take
+        thousands of round trips.
+
+        :param str|re.Pattern pattern: a glob, or a compiled regex that has to match the whole
+        symbol name
+        :param function callback: the function to run when any of the symbols is executed
+        :param Expr condition: a condition from monk.conditions that has to hold for the
+        callback to run
+        :param bool deferred: resume the target as soon as the hook is hit, and run the
+        callback later on a worker, passing it a monk.snapshot.Snapshot
+        :param Capture capture: the registers and memory a deferred callback's snapshot holds
+        :param Budget budget: how often the callback is allowed to run, counted separately
+        for each symbol
+        :rtype: HookGroup
+        :returns: the hooks, which are removed together with its remove(). It's empty if no
+        function matched.
+        """
+        symbols = self.symbols.match(pattern)
+        # Aliases of the same function only need the one hook
+        addrs = sorted(set(symbols.values()))
+        hooks = self._callback_manager.on_execute_many(addrs, callback, condition, deferred,
+                                                       capture, budget)
+
+        return HookGroup(self._callback_manager, hooks, symbols)
 
-    def on_read(self, addr, callback):
+    def on_read(self, addr, callback, condition=None, deferred=False, capture=None,
+                budget=None):
         """Add a callback that runs on read of an address
 
-        :param int addr: the address that, when read, will cause the callback to run
+        :param int|range addr: the address that, when read, will cause the callback to run,
+        or a range of addresses, e.g. range(start, start + size) for a struct
         :param function callback: the function to run when the address is read
+        :param Expr condition: a condition from monk.conditions, e.g. Reg('r2') == 0x1234,
+        that has to hold for the callback to run
+        :param bool deferred: resume the target as soon as the hook is hit, and run the
+        callback later on a worker, passing it a monk.snapshot.Snapshot
+        :param Capture capture: the registers and memory a deferred callback's snapshot holds
+        :param Budget budget: how often the callback is allowed to run, see monk.budget.Budget.
+        Hits over its budget are skipped, with the breakpoint taken out where the stub allows.
         """
-        return self._callback_manager.on_read(addr, callback)
+        return self._callback_manager.on_read(addr, callback, condition, deferred, capture,
+                                              budget)
 
-    def on_write(self, addr, callback):
+    def on_write(self, addr, callback, condition=None, deferred=False, capture=None,
+                 budget=None):
         """Add a callback that runs on write of an address
 
-        :param int addr: the address that, when written, will cause the callback to run
+        :param int|range addr: the address that, when written, will cause the callback to run,
+        or a range of addresses, e.g. range(start, start + size) for a struct
         :param function callback: the function to run when the address is written
+        :param Expr condition: a condition from monk.conditions, e.g. Reg('r2') == 0x1234,
+        that has to hold for the callback to run
+        :param bool deferred: resume the target as soon as the hook is hit, and run the
+        callback later on a worker, passing it a monk.snapshot.Snapshot
+        :param Capture capture: the registers and memory a deferred callback's snapshot holds
+        :param Budget budget: how often the callback is allowed to run, see monk.budget.Budget.
+        Hits over its budget are skipped, with the breakpoint taken out where the stub allows.
         """
-        return self._callback_manager.on_write(addr, callback)
+        return self._callback_manager.on_write(addr, callback, condition, deferred, capture,
+                                               budget)
 
-    def on_access(self, addr, callback):
+    def on_access(self, addr, callback, condition=None, deferred=False, capture=None,
+                  budget=None):
         """Add a callback that runs on access of an address
 
-        :param int addr: the address that, when accessed, will cause the callback to run
+        :param int|range addr: the address that, when accessed, will cause the callback to run,
+        or a range of addresses, e.g. range(start, start + size) for a struct
         :param function callback: the function to run when the address is accessed
+        :param Expr condition: a condition from monk.conditions, e.g. Reg('r2') == 0x1234,
+        that has to hold for the callback to run
+        :param bool deferred: resume the target as soon as the hook is hit, and run the
+        callback later on a worker, passing it a monk.snapshot.Snapshot
+        :param Capture capture: the registers and memory a deferred callback's snapshot holds
+        :param Budget budget: how often the callback is allowed to run, see monk.budget.Budget.
+        Hits over its budget are skipped, with the breakpoint taken out where the stub allows.
+        """
+        return self._callback_manager.on_access(addr, callback, condition, deferred, capture,
+                                                budget)
+
+    # Tracepoints
+    # For hot code, where stopping the target on every hit is far too slow. The stub collects
+    # what each tracepoint asks for without stopping, and it's all downloaded in bulk later.
+    def add_tracepoint(self, addr, capture, condition=None, pass_count=0):
+        """Add a tracepoint. Tracepoints can only be added while the trace isn't running.
+
+        :param int addr: the address to collect at
+        :param Capture capture: the registers and memory to collect, see monk.snapshot.Capture.
+        Memory addresses can be constants, or a register plus or minus a constant.
+        :param Expr condition: a condition from monk.conditions that has to hold for anything
+        to be collected
+        :param int pass_count: stop the trace after this many hits, or 0 to never stop
+        :rtype: int
+        :returns: the tracepoint's number
+        """
+        return self._backend.set_tracepoint(addr, capture, condition, pass_count)
+
+    def clear_tracepoints(self):
+        """Delete every tracepoint and everything they've collected
+        """
+        self._backend.clear_tracepoints()
+
+    def start_trace(self):
+        """Start the tracepoints collecting. They collect while the target runs.
+        """
+        self._backend.start_trace()
+
+    def stop_trace(self):
+        """Stop the tracepoints collecting
+        """
+        self._backend.stop_trace()
+
+    def trace_status(self):
+        """Get the state of the trace, e.g. how many frames have been collected
+
+        :rtype: TraceStatus
+        """
+        return self._backend.trace_status()
+
+    def trace_frames(self):
+        """Iterate over what the tracepoints collected, downloading it a batch at a time. The
+        target has to be stopped.
+
+        :rtype: iterator
+        :returns: a TraceFrame for each hit, which reads like a monk.snapshot.Snapshot
         """
-        return self._callback_manager.on_access(addr, callback)
+        return self._backend.trace_frames()
 
     def remove_hook(self, callback):
         """Remove a callback
@@ -197,6 +414,21 @@ class Monk():
         """
         self._callback_manager.remove_callback(callback)
 
+    def hook_stats(self):
+        """Get what each hook has cost the target, to find the ones slowing it down: how often
+        it's been hit, and histograms of how long its stops took to dispatch, how long its
+        callback held the target, and how long re-arming and resuming took
+
+        :rtype: StatsReport
+        :returns: a dict per hook, most expensive first. to_json() exports it.
+        """
+        return self._callback_manager.hook_stats()
+
+    def reset_hook_stats(self):
+        """Start every hook's stats again from zero
+        """
+        self._callback_manager.reset_hook_stats()
+
     # === Symbols ===
     # Convenience functions to access the symbols object attributes more directly
     def lookup(self, symbol):
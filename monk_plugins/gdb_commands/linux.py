@@ -149,10 +149,14 @@ class TraceProcessExecution(gdb.Command):
 
 #        while cur_proc_name == proc_name:
 
-        # While we're still in userspace
-        while get_reg('pc') < 0xc0000000:
-            pc_list.append(get_reg('pc'))
-            s = gdb.execute("si", to_string=True)
+        # While we're still in userspace. The frame's pc comes from the registers GDB got
+        # along with the step's stop reply, so it doesn't cost another packet per instruction.
+        pc = gdb.selected_frame().pc()
+
+        while pc < 0xc0000000:
+            pc_list.append(pc)
+            gdb.execute("si", to_string=True)
+            pc = gdb.selected_frame().pc()
 
         print("Finished tracing, generating output...")
         #print(["0x%x" % x for x in pc_list])
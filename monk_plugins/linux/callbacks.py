@@ -1,5 +1,7 @@
 from monk import Callback
-from monk_plugins.linux.forensics import get_proc_name, get_user_regs, get_kernel_regs
+from monk_plugins.linux.forensics import get_user_regs, get_kernel_regs
+from monk_plugins.linux.predicates import next_proc_name_is, next_pid_in, \
+    SWITCH_TO_NEXT_THREAD_REG
 from monk_plugins.linux.uregs import UREGS_PC
 
 class OnExecute(Callback):
@@ -13,22 +15,22 @@ class OnExecute(Callback):
 
 
 class OnProcessScheduled(Callback):
-    def __init__(self, target, proc_name=None, callback=None):
+    def __init__(self, target, proc_name=None, callback=None, pids=None):
         super().__init__(target, callback)
         self._proc_name = proc_name
+        self._pids = pids
         self.install()
 
     def install(self):
-        self.add_hook("__switch_to", self._on_switch_to)
+        predicates = []
 
-    def _on_switch_to(self):
-        if not self._proc_name:
-            self.run()
-        else:
-            next_thread = self.target.get_reg('r2')
+        if self._proc_name:
+            predicates.append(next_proc_name_is(self.target, self._proc_name))
 
-            if get_proc_name(self.target, next_thread) == self._proc_name:
-                self.run()
+        if self._pids:
+            predicates.append(next_pid_in(self.target, self._pids))
+
+        self.add_hook("__switch_to", self.run, *predicates)
 
 
 class OnProcessExecute(Callback):
@@ -38,24 +40,23 @@ class OnProcessExecute(Callback):
         self.install()
 
     def _on_switch_to(self):
-        next_thread = self.target.get_reg('r2')
+        next_thread = self.target.get_reg(SWITCH_TO_NEXT_THREAD_REG)
+        t = self.target.structs.ThreadInfo(next_thread)
 
-        if get_proc_name(self.target, next_thread) == self._proc_name:
-            t = self.target.structs.ThreadInfo(next_thread)
-            
-            # addr_limit is the highest userspace address a process can access; if it's 0,
-            # then this is a kernel process. If not, then it's a userspace process.
-            if t.addr_limit > 0x0:
-                saved_pc = get_user_regs(self.target, sp=t.cpu_context.sp)[UREGS_PC]
-            else:
-                saved_regs = get_kernel_regs(self.target)
-                saved_pc = saved_regs.pc
+        # addr_limit is the highest userspace address a process can access; if it's 0,
+        # then this is a kernel process. If not, then it's a userspace process.
+        if t.addr_limit > 0x0:
+            saved_pc = get_user_regs(self.target, sp=t.cpu_context.sp)[UREGS_PC]
+        else:
+            saved_regs = get_kernel_regs(self.target)
+            saved_pc = saved_regs.pc
 
-            self._cb_proc_exec = self.add_hook(saved_pc, self._on_proc_exec)
+        self._cb_proc_exec = self.add_hook(saved_pc, self._on_proc_exec)
 
     def _on_proc_exec(self):
         self.remove_hook(self._cb_proc_exec)
         self.run()
 
     def install(self):
-        self._cb_switch_to = self.add_hook("__switch_to", self._on_switch_to)
+        self._cb_switch_to = self.add_hook("__switch_to", self._on_switch_to,
+                                           next_proc_name_is(self.target, self._proc_name))
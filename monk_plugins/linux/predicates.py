@@ -0,0 +1,35 @@
+from monk.predicates import field, field_in, bytes_equal
+
+# __switch_to(prev, prev_thread_info, next_thread_info) gets the next thread in r2 on ARM
+SWITCH_TO_NEXT_THREAD_REG = 'r2'
+
+
+def next_task(target):
+    """
+    The task_struct being switched to, at the start of __switch_to
+
+    :returns: The address of the next task_struct
+    :rtype: Expr
+    """
+    return field(target.structs.ThreadInfo, 'task', SWITCH_TO_NEXT_THREAD_REG)
+
+def next_proc_name_is(target, proc_name):
+    """
+    The process being switched to, at the start of __switch_to, has a name (task_struct comm)
+
+    :param str proc_name: The process name
+    :rtype: Expr
+    """
+    comm = next_task(target) + target.structs.TaskStruct.comm_offset
+
+    # Include the NUL terminator, so that longer names that start the same way don't match
+    return bytes_equal(comm, proc_name.encode('utf-8') + b'\0', target.symbols.endian)
+
+def next_pid_in(target, pids):
+    """
+    The process being switched to, at the start of __switch_to, has one of some PIDs
+
+    :param iterable pids: The PIDs
+    :rtype: Expr
+    """
+    return field_in(target.structs.TaskStruct, 'pid', pids, next_task(target))
@@ -1,75 +1,60 @@
-import os
-import time
-from time import sleep
-import logging
+"""Trace the instructions a user process executes
 
-import monk  # Import this first to initialize everything
-monk.init("%s%sconfig.json" % (os.path.expanduser(os.getcwd()), os.sep))
-import monk.memory.memreader as memreader
-import monk.forensics as forensics
-import monk.execution.control as control
-import monk.execution.hooks as hooks
-from monk.symbols.uregs.arm import *
-from monk.symbols.structs import *
-from monk.utils.helpers import as_string
-from monk.symbols.lookup import lookup
+Runs the target until the process executes, then steps it until it enters the kernel, writing
+out the pc of every instruction it executed. The steps are taken with Monk.step_until, which
+keeps the pcs in memory and gets each one from the step's stop packet, so tracing runs at the
+speed of the stub rather than a few round trips per instruction.
+"""
+import sys
+import threading
 
+from monk import Monk
+from monk_plugins.linux.callbacks import OnProcessExecute
 
-_shutdown_flag = False
+# Userspace ends where the kernel starts
+KERNEL_BASE = 0xc0000000
+# The most instructions to trace
+MAX_STEPS = 1000000
 
 
-proc_name = None
-def cb_save_procname():
-    global proc_name
-    next_thread = memreader.get_reg('r2')
-    proc_name = forensics.linux.get_proc_name(thread=next_thread)
-    print(f"cb_save_procname: {proc_name}, {hex(memreader.get_reg('pc'))}")
-
-signal = False
-def cb_on_exec():
-    global signal
-    print(f"on_exec: pc = {hex(memreader.get_reg('pc'))}, proc_name = {proc_name}")
-    control.stop()
-    signal = True
-
-# Turn this into a helper function somehow... wrap signal in a class w/ convenience methods?
-def wait_for_signal():
+def trace_process(target, proc_name, path='trace.txt', max_steps=MAX_STEPS):
     """
-    Blocks waiting until the global signal flag is set. This flag is set by the 
-    OnProcessExecute callback for the traced process.
-    """
-    global signal
+    Trace a process by name, until it enters the kernel. Synchronous function - will block
+    execution of the caller. Must be called by main thread (because it controls execution)
 
-    while not signal:
-        sleep(1)
+    :param Monk target: the target
+    :param string proc_name: the name of the process to trace
+    :param str path: the file to write the pcs to, one per line
+    :param int max_steps: the most instructions to trace
+    :rtype: list
+    :returns: the pcs the process executed
+    """
+    executing = threading.Event()
 
-    signal = False
+    def on_exec():
+        target.stop()
+        executing.set()
 
-def trace_process(proc_name):
-    """
-    Trace a process by name. Synchronous function - will block execution of the 
-    caller. Must be called by main thread (because it controls execution)
+    hook = OnProcessExecute(target, proc_name, callback=on_exec)
 
-    :param string proc_name: the name of the process to trace
-    """
-    h1 = hooks.OnProcessScheduled(callback=cb_save_procname)
-    h2 = hooks.OnProcessExecute(proc_name, callback=cb_on_exec)
+    target.run()
+    executing.wait()
+    hook.uninstall()
 
-    control.run()
-    # Do we actually need to "wait for signal" or can we just block waiting for the process
-    # name to change?
-    wait_for_signal()
+    pcs = [target.get_reg('pc')]
+    pcs += target.step_until(lambda pc: pc >= KERNEL_BASE, max_steps)
 
-    print("Finished waiting for signal")
+    # Stepping stops at the kernel's first instruction
+    if pcs[-1] >= KERNEL_BASE:
+        pcs.pop()
 
-    f = open('trace.txt', 'w+')
+    with open(path, 'w') as f:
+        f.write("".join(f"{hex(pc)}\n" for pc in pcs))
 
-    while proc_name == proc_name:
-        f.write(f"{hex(memreader.get_reg('pc'))}\n")
-        f.flush()  # In case we ctrl+c, contents will still be written out
-        control.step()
+    return pcs
 
-    control.shutdown()
 
 if __name__ == '__main__':
-    trace_process('sh')
+    target = Monk('localhost', 1234, symbols=sys.argv[1])
+    trace_process(target, 'sh')
+    target.shutdown()
@@ -0,0 +1,110 @@
+import unittest
+
+from monk.conditions import Reg, Mem, Not, In, All, Any
+from monk.backends.rsp_helpers import agent_expr
+from monk.backends.rsp_helpers.agent_expr import compile_condition, AgentExprError
+
+
+class MockStub():
+    """
+    The part of a gdbstub that checks breakpoint conditions: runs agent expression bytecode
+    against some registers and little endian memory. It's also a backend, so the same
+    conditions can be checked on the client for comparison.
+    """
+    endian = 'little'
+
+    def __init__(self, regs, mem):
+        self.regs = regs
+        self.mem = mem
+        self.reg_map = {name: i for i, name in enumerate(sorted(regs))}
+
+    def get_reg(self, name):
+        return self.regs[name]
+
+    def read_bytes(self, addr, size):
+        return bytes(self.mem.get(addr + i, 0) for i in range(size))
+
+    # pylint: disable=too-many-branches
+    def run(self, code):
+        regs_by_num = {num: self.regs[name] for name, num in self.reg_map.items()}
+        consts = {agent_expr.OP_CONST8: 1, agent_expr.OP_CONST16: 2, agent_expr.OP_CONST32: 4,
+                  agent_expr.OP_CONST64: 8}
+        refs = {agent_expr.OP_REF8: 1, agent_expr.OP_REF16: 2, agent_expr.OP_REF32: 4,
+                agent_expr.OP_REF64: 8}
+        stack = []
+        pc = 0
+
+        while True:
+            op = code[pc]
+            pc += 1
+
+            if op in consts:
+                stack.append(int.from_bytes(code[pc:pc + consts[op]], 'big'))
+                pc += consts[op]
+            elif op == agent_expr.OP_REG:
+                stack.append(regs_by_num[int.from_bytes(code[pc:pc + 2], 'big')])
+                pc += 2
+            elif op in refs:
+                stack.append(int.from_bytes(self.read_bytes(stack.pop(), refs[op]), 'little'))
+            elif op == agent_expr.OP_END:
+                return stack.pop()
+            elif op == agent_expr.OP_LOG_NOT:
+                stack.append(int(not stack.pop()))
+            elif op == agent_expr.OP_SWAP:
+                stack[-1], stack[-2] = stack[-2], stack[-1]
+            else:
+                b = stack.pop()
+                a = stack.pop()
+                stack.append({
+                    agent_expr.OP_ADD: lambda: (a + b) & (2 ** 64 - 1),
+                    agent_expr.OP_SUB: lambda: (a - b) & (2 ** 64 - 1),
+                    agent_expr.OP_BIT_AND: lambda: a & b,
+                    agent_expr.OP_BIT_OR: lambda: a | b,
+                    agent_expr.OP_EQUAL: lambda: int(a == b),
+                    agent_expr.OP_LESS_UNSIGNED: lambda: int(a < b),
+                }[op]())
+
+
+class TestAgentExpr(unittest.TestCase):
+    def setUp(self):
+        self.stub = MockStub({'r0': 0, 'r2': 0x1234, 'sp': 0x8000},
+                             {0x8008: 0x05, 0x8009: 0x01, 0x1234: 0xff})
+
+    def test_compile_simple(self):
+        self.assertEqual(compile_condition(Reg('r2') == 0x1234, {'r2': 2}),
+                         bytes([0x26, 0x00, 0x02, 0x23, 0x12, 0x34, 0x13, 0x27]))
+
+    def test_matches_client(self):
+        conditions = [
+            Reg('r2') == 0x1234,
+            Reg('r2') != 0x1234,
+            Reg('r0') < 1,
+            Reg('r0') > 1,
+            Reg('r2') <= 0x1234,
+            Reg('r2') >= 0x1235,
+            Mem(Reg('sp') + 8, 2) == 0x105,
+            Mem(Reg('sp') + 8, 1) == 5,
+            Mem(Reg('r2'), 1) == 0xff,
+            (Reg('r2') == 0x1234) & (Mem(Reg('sp') + 8, 4) != 0),
+            (Reg('r0') == 1) | (Reg('sp') - 0x8000 == 0),
+            Not(Reg('r0')),
+            Reg('r2') & 0xff00 == 0x1200,
+            Reg('sp') == 0x1_0000_8000,
+            In(Reg('r2'), {1, 0x1234}),
+            In(Mem(Reg('sp') + 8, 1), {1, 2}),
+            In(Reg('r0'), []),
+            All(Reg('r2') == 0x1234, Reg('sp')),
+            All(Reg('r2') == 0x1234, Reg('r0')),
+            All(),
+            Any(Reg('r0'), Reg('r2') == 1),
+            Any(Reg('r0'), Reg('sp')),
+        ]
+
+        for cond in conditions:
+            with self.subTest(cond=cond):
+                self.assertEqual(self.stub.run(compile_condition(cond, self.stub.reg_map)),
+                                 cond.evaluate(self.stub))
+
+    def test_unknown_register(self):
+        with self.assertRaises(AgentExprError):
+            compile_condition(Reg('nope') == 1, self.stub.reg_map)
@@ -0,0 +1,135 @@
+import unittest
+import asyncio
+import socket
+import threading
+from queue import Queue
+import time
+
+import monk.backends.rsp_helpers.async_gdbrsp as async_gdbrsp
+from monk.backends.rsp_helpers.gdbrsp import GdbRspError, _make_packet
+
+
+recvbuf = b''
+
+
+def _sock_listen(sock, _):
+    sock.listen()
+    conn, addr = sock.accept()
+    conn.recv(1)  # Wait for the other end to close
+    conn.close()
+
+def _sock_send(sock, args):
+    sock.listen()
+    conn, addr = sock.accept()
+
+    send_queue = args[0]
+
+    while not send_queue.empty():
+        conn.send(send_queue.get())
+        conn.recv(1)  # Get the '+' acknowledgement
+
+    time.sleep(1)  # Wait for the client to be done with the socket
+    conn.close()
+
+def _sock_recv(sock, _):
+    global recvbuf
+    sock.listen()
+    conn, addr = sock.accept()
+    recvbuf = conn.recv(1024)
+    conn.close()
+
+
+def _start_sock_thread(sock, sock_fn, *args):
+    sock_thread = threading.Thread(target=sock_fn, args=[sock, args])
+    sock_thread.start()
+    time.sleep(.1)  # Wait briefly for socket to start listening
+
+    return sock_thread
+
+def _make_test_socket(portnum=0):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('localhost', portnum))
+
+    return sock
+
+
+class TestAsyncGdbRsp(unittest.TestCase):
+    def test_connect_raises_if_cannot_connect(self):
+        async def connect():
+            await async_gdbrsp.AsyncGdbRsp.connect('localhost', 4444)
+
+        with self.assertRaises(GdbRspError) as cm:
+            asyncio.run(connect())
+
+        self.assertTrue('localhost' in str(cm.exception))
+        self.assertTrue('4444' in str(cm.exception))
+
+    def test_recv_and_recv_stop(self):
+        send_queue = Queue()
+        send_queue.put(b"$somedata#4e$otherdata#bc")
+        send_queue.put(_make_packet(b'T05thread:01;'))
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_send, send_queue)
+
+        async def session():
+            g = await async_gdbrsp.AsyncGdbRsp.connect('localhost', sock.getsockname()[1])
+            packets = [await g.recv(), await g.recv(), await g.recv_stop(), await g.recv(.1)]
+            await g.close()
+            return packets
+
+        self.assertEqual(asyncio.run(session()),
+                         [b'somedata', b'otherdata', b'T05thread:01;', None])
+        sock.close()
+
+    def test_send(self):
+        sock = _make_test_socket()
+        sock_thread = _start_sock_thread(sock, _sock_recv)
+
+        async def session():
+            g = await async_gdbrsp.AsyncGdbRsp.connect('localhost', sock.getsockname()[1])
+            await g.send(b'somedata')
+            await g.close()
+
+        asyncio.run(session())
+        sock_thread.join()
+        self.assertEqual(recvbuf, b'$somedata#4e')
+        sock.close()
+
+
+class TestLoopGdbRsp(unittest.TestCase):
+    def test_recv_and_stop_queue(self):
+        send_queue = Queue()
+        send_queue.put(b"$somedata#4e")
+        send_queue.put(_make_packet(b'S05'))
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_send, send_queue)
+
+        g = async_gdbrsp.LoopGdbRsp('localhost', sock.getsockname()[1])
+        self.assertEqual(g.recv(), b'somedata')
+        self.assertEqual(g.stop_queue.get(timeout=1), b'S05')
+        self.assertEqual(g.recv(timeout=.1), None)
+
+        g.close()
+        sock.close()
+
+    def test_connections_share_one_loop(self):
+        sock1 = _make_test_socket()
+        sock2 = _make_test_socket()
+        _start_sock_thread(sock1, _sock_listen)
+        _start_sock_thread(sock2, _sock_listen)
+
+        g1 = async_gdbrsp.LoopGdbRsp('localhost', sock1.getsockname()[1])
+        g2 = async_gdbrsp.LoopGdbRsp('localhost', sock2.getsockname()[1])
+        self.assertIs(g1._loop, g2._loop)
+
+        # Closing doesn't wait on any polling timeouts
+        start = time.monotonic()
+        g1.close()
+        g2.close()
+        self.assertLess(time.monotonic() - start, .5)
+
+        sock1.close()
+        sock2.close()
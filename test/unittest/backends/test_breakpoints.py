@@ -0,0 +1,40 @@
+import unittest
+
+from monk.backends.rsp_helpers.breakpoints import BreakpointTable, SlotAllocator, BP_SW, BP_HW, \
+    WP_WRITE
+
+
+class TestBreakpointTable(unittest.TestCase):
+    def test_insert_and_remove(self):
+        table = BreakpointTable()
+        self.assertFalse(table.is_inserted(BP_SW, 0x1000, 4))
+
+        table.insert(BP_SW, 0x1000, 4)
+        table.insert(WP_WRITE, 0x2000, 8)
+        self.assertTrue(table.is_inserted(BP_SW, 0x1000, 4))
+        self.assertFalse(table.is_inserted(BP_SW, 0x2000, 4))
+        self.assertEqual(table.inserted(BP_SW), [(BP_SW, 0x1000, 4)])
+        self.assertEqual(table.inserted(), [(BP_SW, 0x1000, 4), (WP_WRITE, 0x2000, 8)])
+
+        table.remove(BP_SW, 0x1000, 4)
+        # Removing something that isn't there is fine
+        table.remove(BP_SW, 0x1000, 4)
+        self.assertEqual(table.inserted(), [(WP_WRITE, 0x2000, 8)])
+
+
+class TestSlotAllocator(unittest.TestCase):
+    def test_allocate_and_release(self):
+        slots = SlotAllocator(2)
+
+        self.assertTrue(slots.allocate((BP_HW, 0x1000, 0)))
+        # Asking again for the same holder doesn't use up another slot
+        self.assertTrue(slots.allocate((BP_HW, 0x1000, 0)))
+        self.assertTrue(slots.allocate((WP_WRITE, 0x2000, 4)))
+        self.assertEqual(slots.free, 0)
+        self.assertFalse(slots.allocate((WP_WRITE, 0x3000, 4)))
+
+        slots.release((BP_HW, 0x1000, 0))
+        # Releasing something that doesn't hold a slot is fine
+        slots.release((BP_HW, 0x1000, 0))
+        self.assertEqual(slots.free, 1)
+        self.assertTrue(slots.allocate((WP_WRITE, 0x3000, 4)))
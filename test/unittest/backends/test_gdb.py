@@ -32,6 +32,22 @@ class TestMemreader(unittest.TestCase):
         gdb = Gdb()
         self.assertEqual(gdb.read_uint64(0x0), 0x12345678)
 
+    def test_read_bytes(self):
+        gdb_mock.selected_inferior.return_value.read_memory.return_value = memoryview(b'\x01\x02')
+        gdb = Gdb()
+        self.assertEqual(gdb.read_bytes(0x10, 2), b'\x01\x02')
+        gdb_mock.selected_inferior.return_value.read_memory.assert_called_with(0x10, 2)
+
+    def test_read_many(self):
+        gdb_mock.selected_inferior.return_value.read_memory.return_value = memoryview(b'\x01')
+        gdb = Gdb()
+        self.assertEqual(gdb.read_many([(0x10, 1), (0x20, 1)]), [b'\x01', b'\x01'])
+
+    def test_write_bytes(self):
+        gdb = Gdb()
+        gdb.write_bytes(0x10, b'\x01\x02')
+        gdb_mock.selected_inferior.return_value.write_memory.assert_called_with(0x10, b'\x01\x02')
+
     def test_sanitize_int(self):
         # TODO: Improve this test to actually cover the "negative hex" values that are problematic
         self.assertEqual(_sanitize_int(1, 32), 1)
@@ -32,6 +32,21 @@ def _sock_send(sock, args):
     time.sleep(1)  # Wait for gdbrsp to be done with the socket
     conn.close()
 
+def _sock_send_and_record(sock, args):
+    """ Like _sock_send, but records everything gdbrsp sends back (acks, naks) """
+    sock.listen()
+    conn, addr = sock.accept()
+
+    send_queue = args[0]
+    received = args[1]
+
+    while not send_queue.empty():
+        conn.send(send_queue.get())
+        received.append(conn.recv(1))
+
+    time.sleep(1)  # Wait for gdbrsp to be done with the socket
+    conn.close()
+
 def _sock_recv(sock, _):
     global recvbuf
     sock.listen()
@@ -56,19 +71,50 @@ def _make_test_socket(portnum=0):
 
 
 class TestGdbRsp(unittest.TestCase):
-    def test_get_first_packet_indices(self):
-        start, end = gdbrsp._get_first_packet_indices(b'$somedata#nn')
-        self.assertEqual(start, 1)
-        self.assertEqual(end, 9)
-
-        start, end = gdbrsp._get_first_packet_indices(b'#xx$somedata#nn')
-        self.assertEqual(start, 4)
-        self.assertEqual(end, 12)
-
-        start, end = gdbrsp._get_first_packet_indices(b'#xx$somedata#nn$#nn')
-        self.assertEqual(start, 4)
-        self.assertEqual(end, 12)
-
+    def test_packet_framer(self):
+        framer = gdbrsp.PacketFramer()
+        self.assertEqual(framer.feed(b'$somedata#4e'), [(b'somedata', True, False)])
+
+        # Junk and acks before the packet start are discarded
+        self.assertEqual(framer.feed(b'+#xx$somedata#4e'), [(b'somedata', True, False)])
+
+        # Every complete packet in a single read is returned, and a trailing partial packet
+        # is held on to until the rest of it arrives
+        self.assertEqual(framer.feed(b'$somedata#4e$otherdata#bc$last'),
+                         [(b'somedata', True, False), (b'otherdata', True, False)])
+        self.assertEqual(framer.feed(b'data#'), [])
+        self.assertEqual(framer.feed(b'4'), [])
+        self.assertEqual(framer.feed(b'e'), [(b'lastdata', True, False)])
+
+    def test_packet_framer_bad_checksum(self):
+        framer = gdbrsp.PacketFramer()
+        self.assertEqual(framer.feed(b'$somedata#nn$somedata#4e'),
+                         [(b'somedata', False, False), (b'somedata', True, False)])
+
+    def test_packet_framer_decodes_rle_and_escapes(self):
+        framer = gdbrsp.PacketFramer()
+        # '0* ' is '0' followed by three more '0's (ord(' ') - 29 = 3)
+        self.assertEqual(framer.feed(gdbrsp._make_packet(b'0* 1')), [(b'00001', True, False)])
+        # '}]' is an escaped '}' (0x5d ^ 0x20 = 0x7d), '}\x03' is an escaped '#'
+        self.assertEqual(framer.feed(gdbrsp._make_packet(b'a}]b}\x03c')),
+                         [(b'a}b#c', True, False)])
+        # Runs and escapes together, with plain data on either side
+        self.assertEqual(framer.feed(gdbrsp._make_packet(b'x0* }]y')),
+                         [(b'x0000}y', True, False)])
+
+    def test_packet_framer_notifications(self):
+        framer = gdbrsp.PacketFramer()
+        notification = b'%' + gdbrsp._make_packet(b'Stop:T05thread:p01.02;')[1:]
+
+        self.assertEqual(framer.feed(b'$OK#9a' + notification + b'$T05#b9'),
+                         [(b'OK', True, False), (b'Stop:T05thread:p01.02;', True, True),
+                          (b'T05', True, False)])
+
+    def test_queue_notification(self):
+        stops = []
+        gdbrsp._queue_notification(b'Stop:T05thread:p01.02;', True, stops.append)
+        gdbrsp._queue_notification(b'Other:1', True, stops.append)
+        self.assertEqual(stops, [b'T05thread:p01.02;'])
 
     def test_is_stop_packet(self):
         self.assertTrue(gdbrsp._is_stop_packet(b'S'))
@@ -79,11 +125,17 @@ class TestGdbRsp(unittest.TestCase):
         self.assertTrue(gdbrsp._is_stop_packet(b'N'))
         self.assertTrue(gdbrsp._is_stop_packet(b'O'))
         self.assertTrue(gdbrsp._is_stop_packet(b'F'))
+        self.assertTrue(gdbrsp._is_stop_packet(b'T05thread:p01.01;'))
+        self.assertTrue(gdbrsp._is_stop_packet(b'Fwrite,1,1234,6'))
 
         self.assertFalse(gdbrsp._is_stop_packet(b'b'))
         self.assertFalse(gdbrsp._is_stop_packet(b''))
         self.assertFalse(gdbrsp._is_stop_packet(None))
         self.assertFalse(gdbrsp._is_stop_packet(b'OK'))
+        # Replies to qTStatus and QTFrame
+        self.assertFalse(gdbrsp._is_stop_packet(b'T1;tnotrun:0'))
+        self.assertFalse(gdbrsp._is_stop_packet(b'F1aT2'))
+        self.assertFalse(gdbrsp._is_stop_packet(b'F-1'))
 
     def test_make_packet(self):
         self.assertEqual(gdbrsp._make_packet(b'somedata'), b'$somedata#4e')
@@ -151,7 +203,7 @@ class TestGdbRsp(unittest.TestCase):
         # of the socket buffer at once. This tests that gdbrsp recognizes each packet even
         # when they arrive together.
         send_queue = Queue()
-        packet = b"$somedata#11$otherdata#22$lastdata#33"
+        packet = b"$somedata#4e$otherdata#bc$lastdata#4e"
         data = [b"somedata", b"otherdata", b"lastdata"]
         send_queue.put(packet)
 
@@ -179,6 +231,22 @@ class TestGdbRsp(unittest.TestCase):
         g.close()
         sock.close()
 
+    def test_gdbrsp_recv_bad_checksum(self):
+        # Tests that gdbrsp drops packets with a bad checksum and asks for a retransmit
+        send_queue = Queue()
+        received = []
+        send_queue.put(b"$somedata#aa")
+
+        sock = _make_test_socket()
+        sock_thread = _start_sock_thread(sock, _sock_send_and_record, send_queue, received)
+        g = gdbrsp.GdbRsp('localhost', sock.getsockname()[1])
+        self.assertEqual(g.recv(timeout=1), None)
+        sock_thread.join()
+        self.assertEqual(received, [b'-'])
+
+        g.close()
+        sock.close()
+
     def test_gdbrsp_send(self):
         packet = b'$somedata#4e'
         data = b'somedata'
@@ -0,0 +1,113 @@
+import unittest
+import threading
+from queue import Queue, Empty
+
+from monk.backends.rsp_helpers.multiplexer import RspMultiplexer, RspPipeline
+
+
+class EchoRsp():
+    """ Stands in for GdbRsp. Replies to every packet with the packet itself, in order. """
+    def __init__(self):
+        self.sent = []
+        self.read_queue = Queue()
+        self.echo = True
+
+    def send(self, packet):
+        self.sent.append(packet)
+
+        if self.echo:
+            self.read_queue.put(packet)
+
+    def recv(self, timeout=None):
+        try:
+            return self.read_queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+class TestRspMultiplexer(unittest.TestCase):
+    def setUp(self):
+        self.rsp = EchoRsp()
+        self.mux = RspMultiplexer(self.rsp)
+
+    def test_transact(self):
+        self.assertEqual(self.mux.transact(b'm1000,4'), b'm1000,4')
+        self.assertEqual(self.mux.transact(b'm1000,4', decode=len), 7)
+
+    def test_send_does_not_expect_reply(self):
+        self.rsp.echo = False
+        self.mux.send(b'vCont;c')
+        self.rsp.echo = True
+        self.assertEqual(self.mux.transact(b'p0f'), b'p0f')
+
+    def test_replies_matched_by_order(self):
+        first = self.mux.request(b'first')
+        second = self.mux.request(b'second')
+
+        # Waiting on the second request reads (and hands out) the first reply too
+        self.assertEqual(second.result(), b'second')
+        self.assertTrue(first.done)
+        self.assertEqual(first.result(), b'first')
+
+    def test_concurrent_threads(self):
+        results = {}
+
+        def worker(n):
+            results[n] = [self.mux.transact(b'%d-%d' % (n, i)) for i in range(50)]
+
+        threads = [threading.Thread(target=worker, args=[n]) for n in range(8)]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        for n in range(8):
+            self.assertEqual(results[n], [b'%d-%d' % (n, i) for i in range(50)])
+
+    def test_timeout_keeps_late_reply_with_its_request(self):
+        self.rsp.echo = False
+        late = self.mux.request(b'late')
+        self.assertEqual(late.result(timeout=.1), None)
+
+        # The reply to the timed out request finally arrives, and must not be handed to the
+        # next request
+        self.rsp.read_queue.put(b'late')
+        self.rsp.echo = True
+        self.assertEqual(self.mux.transact(b'next'), b'next')
+        self.assertEqual(late.result(), b'late')
+
+
+class TestRspPipeline(unittest.TestCase):
+    def test_results_in_order(self):
+        mux = RspMultiplexer(EchoRsp())
+
+        with RspPipeline(mux, depth=4) as p:
+            for i in range(20):
+                p.request(b'%d' % i, decode=int)
+
+        self.assertEqual(p.results(), list(range(20)))
+
+    def test_depth_limits_requests_in_flight(self):
+        rsp = EchoRsp()
+        rsp.echo = False
+        mux = RspMultiplexer(rsp)
+        p = RspPipeline(mux, depth=2)
+
+        p.request(b'a')
+        p.request(b'b')
+
+        # A third request has to wait for the first reply before it goes out
+        t = threading.Thread(target=p.request, args=[b'c'])
+        t.start()
+        t.join(.2)
+        self.assertEqual(rsp.sent, [b'a', b'b'])
+
+        rsp.read_queue.put(b'a')
+        t.join(1)
+        self.assertEqual(rsp.sent, [b'a', b'b', b'c'])
+
+        rsp.read_queue.put(b'b')
+        rsp.read_queue.put(b'c')
+        self.assertEqual(p.results(), [b'a', b'b', b'c'])
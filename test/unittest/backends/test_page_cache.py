@@ -0,0 +1,74 @@
+import unittest
+
+from monk.backends.rsp_helpers.page_cache import PageCache, _runs
+
+
+class FakeMemory():
+    """ Memory where each byte holds the low byte of its address, counting the fetches """
+    def __init__(self):
+        self.fetches = []
+
+    def fetch(self, addr, size):
+        self.fetches.append((addr, size))
+        return bytes((addr + i) & 0xff for i in range(size))
+
+
+class TestPageCache(unittest.TestCase):
+    def setUp(self):
+        self.mem = FakeMemory()
+        self.cache = PageCache(max_pages=4, page_size=16)
+
+    def test_read_fetches_whole_pages_once(self):
+        self.assertEqual(self.cache.read(0x104, 4, self.mem.fetch), bytes([4, 5, 6, 7]))
+        self.assertEqual(self.cache.read(0x10c, 2, self.mem.fetch), bytes([12, 13]))
+        self.assertEqual(self.mem.fetches, [(0x100, 16)])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_read_across_pages(self):
+        self.cache.read(0x110, 1, self.mem.fetch)
+
+        # Only the pages that aren't cached are fetched, in consecutive runs
+        data = self.cache.read(0x10e, 0x24, self.mem.fetch)
+        self.assertEqual(data, bytes((0x10e + i) & 0xff for i in range(0x24)))
+        self.assertEqual(self.mem.fetches, [(0x110, 16), (0x100, 16), (0x120, 32)])
+
+    def test_lru_eviction(self):
+        for page in range(4):
+            self.cache.read(page * 16, 1, self.mem.fetch)
+
+        # Touch the first page so the second becomes least recently used
+        self.cache.read(0, 1, self.mem.fetch)
+        self.cache.read(0x40, 1, self.mem.fetch)
+        self.mem.fetches.clear()
+
+        self.cache.read(0, 1, self.mem.fetch)
+        self.assertEqual(self.mem.fetches, [])
+        self.cache.read(0x10, 1, self.mem.fetch)
+        self.assertEqual(self.mem.fetches, [(0x10, 16)])
+
+    def test_write_through(self):
+        self.cache.read(0x100, 1, self.mem.fetch)
+        self.cache.write(0x10e, b'\xaa\xbb\xcc\xdd')
+
+        self.assertEqual(self.cache.read(0x10c, 4, self.mem.fetch)[:4], b'\x0c\x0d\xaa\xbb')
+        # The second page wasn't cached, so the write doesn't create it
+        self.assertEqual(self.cache.read(0x110, 2, self.mem.fetch), b'\x10\x11')
+
+    def test_invalidate(self):
+        self.cache.read(0x100, 1, self.mem.fetch)
+        self.cache.invalidate()
+        self.cache.read(0x100, 1, self.mem.fetch)
+        self.assertEqual(self.mem.fetches, [(0x100, 16), (0x100, 16)])
+
+    def test_fetch_from_old_epoch_not_kept(self):
+        def fetch_then_resume(addr, size):
+            self.cache.invalidate()
+            return self.mem.fetch(addr, size)
+
+        self.assertEqual(self.cache.read(0x100, 1, fetch_then_resume), b'\x00')
+        self.cache.read(0x100, 1, self.mem.fetch)
+        self.assertEqual(len(self.mem.fetches), 2)
+
+    def test_runs(self):
+        self.assertEqual(_runs([0, 16, 32, 64, 80], 16), [(0, 48), (64, 32)])
+        self.assertEqual(_runs([], 16), [])
@@ -7,6 +7,7 @@ from queue import Queue
 import time
 import logging
 import signal
+import re
 
 gdb_mock = MagicMock()
 gdb_mock.execute.return_value = "0x0 0x12345678"
@@ -15,6 +16,9 @@ gdb_mock.selected_frame.read_register.return_value = 0x00000001
 sys.modules['gdb'] = gdb_mock
 
 import monk.backends.rsp_helpers.rsp_target as rsp_target
+from monk.backends.rsp_helpers.gdbrsp import _make_packet
+from monk.conditions import Reg
+from monk.snapshot import Capture, MonkSnapshotError
 
 recvbuf = ""
 
@@ -85,6 +89,44 @@ def _sock_read_and_send(sock, args):
     finally:
         conn.close()
 
+def _sock_read_and_send_no_ack(sock, args):
+    """
+    Like _sock_read_and_send, but for a stub that has agreed to no-ack mode: it doesn't wait
+    for acks, replies once per packet even when several arrive in one read, and records
+    everything it receives so tests can check that no acks were sent
+    """
+    global recvbuf
+    try:
+        sock.listen()
+        conn, addr = sock.accept()
+
+        send_queue = args[0]
+        received = args[1]
+
+        while not send_queue.empty():
+            recvbuf = conn.recv(1024)
+            received.append(recvbuf)
+
+            for packet in re.findall(rb'\$[^#]*#..', recvbuf):
+                # Continuing gets a stop packet eventually, not a reply, so only send something
+                # if a stop packet is next in line. In non-stop mode, continuing a single thread
+                # is replied to.
+                if packet.startswith(b'$vCont;c#') and \
+                   (send_queue.empty() or send_queue.queue[0][1:2] not in (b'T', b'S')):
+                    continue
+
+                if not send_queue.empty():
+                    conn.send(send_queue.get())
+
+        # Wait for the other end to be done with the socket before closing it
+        time.sleep(1)
+    finally:
+        conn.close()
+
+
+def _make_notification(data):
+    return b'%' + _make_packet(data)[1:]
+
 
 def _start_sock_thread(sock, sock_fn, *args):
     sock_thread = threading.Thread(target=sock_fn, args=[sock, args])
@@ -102,9 +144,6 @@ def _make_test_socket(portnum=0):
 
 
 class TestRspTarget(unittest.TestCase):
-    def test_decode_stop_reason(self):
-        self.assertEqual(rsp_target._decode_stop_reason(signal.SIGTRAP.value), rsp_target.StopReasons.swbreak)
-
     def test_get_register_info(self):
         self.maxDiff = None
         reg_layout, reg_map = rsp_target._get_register_info([
@@ -120,7 +159,227 @@ class TestRspTarget(unittest.TestCase):
         self.assertEqual(reg_map, expected_reg_map)
 
     def test_get_xml_file_names(self):
-        self.assertEqual(rsp_target._get_xml_file_names(target_xml[1:-3]), ['arm-core.xml', 'arm-vfp.xml', 'system-registers.xml'])
+        self.assertEqual(rsp_target._get_xml_file_names(target_xml[2:-3]), ['arm-core.xml', 'arm-vfp.xml', 'system-registers.xml'])
+
+    def test_parse_qsupported(self):
+        features = rsp_target._parse_qsupported(b'PacketSize=1000;qXfer:features:read+;'
+                                                b'QStartNoAckMode+;vContSupported-')
+        self.assertEqual(features, {'PacketSize': '1000', 'qXfer:features:read': True,
+                                    'QStartNoAckMode': True, 'vContSupported': False})
+        self.assertEqual(rsp_target._parse_qsupported(None), {})
+
+    def test_no_ack_mode(self):
+        send_queue = Queue()
+        received = []
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        send_queue.put(b"$PacketSize=1000;QStartNoAckMode+#07")  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(b'$12345678#a4')
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1], cache_pages=0)
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+        self.assertTrue(t._rsp.no_ack_mode)
+        self.assertEqual(t.read_memory(0x11111111, 4), 0x12345678)
+
+        # The OK reply to QStartNoAckMode is the last packet that gets acked
+        sent = b''.join(received)
+        self.assertEqual(re.sub(rb'\$[^#]*#..', b'', sent), b'+++')
+        self.assertTrue(sent.endswith(b'$m11111111,4#55'))
+
+    def test_split_g_packet(self):
+        reg_sizes = {'r0': 4, 'r1': 4, 'pc': 4, 'cpsr': 4}
+        reg_map = {'r0': 0, 'r1': 1, 'pc': 2, 'cpsr': 25}
+
+        # cpsr isn't contiguous with the rest, so it can't be found in the g packet
+        self.assertEqual(rsp_target._split_g_packet(b'00000001xxxxxxxx0000000300000004',
+                                                    reg_sizes, reg_map),
+                         {0: b'00000001', 2: b'00000003'})
+        self.assertEqual(rsp_target._split_g_packet(b'000000010000', reg_sizes, reg_map),
+                         {0: b'00000001'})
+
+    def test_merge_ranges(self):
+        self.assertEqual(rsp_target._merge_ranges([(0x10, 4), (0x0, 4), (0x4, 4), (0x12, 8)]),
+                         [(0x0, 8), (0x10, 10)])
+        self.assertEqual(rsp_target._merge_ranges([(0x0, 16), (0x4, 4)]), [(0x0, 16)])
+        self.assertEqual(rsp_target._merge_ranges([]), [])
+
+    def test_read_many(self):
+        send_queue = Queue()
+        received = []
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        send_queue.put(_make_packet(b"QStartNoAckMode+"))  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(_make_packet(b'0001020304050607'))
+        send_queue.put(_make_packet(b'aabb'))
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1], cache_pages=0)
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+
+        # The adjacent ranges are read with one packet, and results come back in request order
+        self.assertEqual(t.read_many([(0x2000, 2), (0x1004, 4), (0x1000, 4), (0x1002, 1)]),
+                         [b'\xaa\xbb', b'\x04\x05\x06\x07', b'\x00\x01\x02\x03', b'\x02'])
+        sent = b''.join(received)
+        self.assertTrue(sent.endswith(_make_packet(b'm00001000,8') +
+                                      _make_packet(b'm00002000,2')))
+
+    def test_capabilities(self):
+        caps = rsp_target.RspCapabilities.from_qsupported(
+            b'PacketSize=1000;qXfer:features:read+;swbreak+;hwbreak-;QStartNoAckMode+')
+        self.assertEqual(caps.packet_size, 0x1000)
+        self.assertTrue(caps.supports_xfer('features'))
+        self.assertFalse(caps.supports_xfer('features', 'write'))
+        self.assertTrue(caps.swbreak)
+        self.assertFalse(caps.hwbreak)
+        self.assertTrue(caps.no_ack)
+        self.assertEqual(caps.max_read_size, 2046)
+        self.assertEqual(caps.max_write_size(4), 2036)
+        self.assertEqual(caps.xfer_chunk_size, 0xffb)
+
+        # Without a PacketSize, fall back to GDB's default
+        caps = rsp_target.RspCapabilities.from_qsupported(None)
+        self.assertEqual(caps.packet_size, rsp_target.DEFAULT_PACKET_SIZE)
+        self.assertFalse(caps.no_ack)
+
+    def test_memory_cache(self):
+        send_queue = Queue()
+        received = []
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        send_queue.put(_make_packet(b"QStartNoAckMode+"))  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(_make_packet(bytes(range(16)).hex().encode('utf-8')))
+        send_queue.put(b"$OK#9a")  # Reply to M
+        send_queue.put(_make_packet(bytes(16).hex().encode('utf-8')))
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1], page_size=16)
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+        t.endian = 'little'
+
+        # The first read fetches the whole page; the rest come from the cache
+        self.assertEqual(t.read_memory(0x1004, 4), 0x07060504)
+        self.assertEqual(t.read_memory(0x1008, 2), 0x0908)
+        self.assertEqual(t.read_bytes(0x100c, 4), bytes([12, 13, 14, 15]))
+        sent = b''.join(received)
+        self.assertEqual(sent.count(b'$m'), 1)
+        self.assertTrue(sent.endswith(_make_packet(b'm00001000,10')))
+
+        # Writes go through to the target and update the cached page
+        t.write_memory(0x1008, 0xaabb, 2)
+        self.assertEqual(t.read_bytes(0x1008, 2), b'\xaa\xbb')
+        self.assertEqual(b''.join(received).count(b'$m'), 1)
+
+        # Resuming the target throws the cache away
+        t.cmd_continue()
+        t.target_is_stopped = True
+        self.assertEqual(t.read_memory(0x1004, 4), 0)
+        self.assertEqual(b''.join(received).count(b'$m'), 2)
+
+    def test_write_bytes(self):
+        send_queue = Queue()
+        received = []
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        # 0x22 byte packets hold 5 bytes of memory per write
+        send_queue.put(_make_packet(b"PacketSize=22;QStartNoAckMode+"))  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(b"$OK#9a")
+        send_queue.put(b"$OK#9a")
+        send_queue.put(_make_packet(b'E14'))
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+        t.write_bytes(0x1000, bytes(range(8)))
+
+        sent = b''.join(received)
+        self.assertTrue(sent.endswith(b''.join([_make_packet(b'M00001000,5:0001020304'),
+                                                _make_packet(b'M00001005,3:050607')])))
+
+        with self.assertRaises(rsp_target.RspTargetError):
+            t.write_bytes(0x2000, b'\x00')
+
+    def test_xfer_read_in_chunks(self):
+        send_queue = Queue()
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        send_queue.put(_make_packet(b"PacketSize=1000"))  # Reply to qSupported
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(_make_packet(b'mfirst '))
+        send_queue.put(_make_packet(b'lsecond'))
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send, send_queue)
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+
+        self.assertEqual(t._xfer_read(b'features', b'1.xml'), b'first second')
+        # The second request picks up where the first reply left off
+        self.assertEqual(recvbuf, _make_packet(b'qXfer:features:read:1.xml:6,ffb'))
+
+    def test_read_bytes(self):
+        send_queue = Queue()
+        received = []
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        # 0x14 byte packets hold 8 bytes of memory each
+        send_queue.put(_make_packet(b"PacketSize=14;QStartNoAckMode+"))  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(_make_packet(b'0001020304050607'))
+        send_queue.put(_make_packet(b'08090a0b0c0d0e0f'))
+        send_queue.put(_make_packet(b'10111213'))
+        send_queue.put(_make_packet(b'E14'))
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1], cache_pages=0)
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+        self.assertEqual(t.read_bytes(0x1000, 20), bytes(range(20)))
+
+        sent = b''.join(received)
+        self.assertTrue(sent.endswith(b''.join([_make_packet(b'm00001000,8'),
+                                                _make_packet(b'm00001008,8'),
+                                                _make_packet(b'm00001010,4')])))
+
+        with self.assertRaises(rsp_target.RspTargetError):
+            t.read_bytes(0x2000, 4)
 
     def test_rsp_target_init(self):
         send_queue = Queue()
@@ -142,12 +401,12 @@ class TestRspTarget(unittest.TestCase):
 
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
         send_queue.put(system_registers_xml)
-        send_queue.put(b'OK#xx')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -161,13 +420,13 @@ class TestRspTarget(unittest.TestCase):
     def test_read_register(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
         send_queue.put(system_registers_xml)
-        send_queue.put(b'$12345678#nn')
-        send_queue.put(b'$12345678#nn')
+        send_queue.put(b'$12345678#a4')  # Reply to g, which only has r0 in it
+        send_queue.put(b'$12345678#a4')  # Reply to p for cpsr
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -179,22 +438,31 @@ class TestRspTarget(unittest.TestCase):
 
         self.assertTrue('illegal reg' in str(cm.exception))
         self.assertEqual(t.read_register('r0'), 0x12345678)
+        time.sleep(.1)
+        self.assertEqual(recvbuf, b'$g#67')
+
+        # Served from the register cache
         t.endian = 'little'
         self.assertEqual(t.read_register('r0'), 0x78563412)
 
+        # Not in the g packet, so read on its own
+        self.assertEqual(t.read_register('cpsr'), 0x78563412)
+        time.sleep(.1)
+        self.assertEqual(recvbuf, _make_packet(b'p19'))
+
         t.close()
         sock.close()
 
     def test_write_register(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
         send_queue.put(system_registers_xml)
-        send_queue.put(b'$resp#nn')
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$resp#ba')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -224,18 +492,18 @@ class TestRspTarget(unittest.TestCase):
     def test_read_memory(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
         send_queue.put(system_registers_xml)
-        send_queue.put(b'$12345678#nn')
-        send_queue.put(b'$12345678#nn')
+        send_queue.put(b'$12345678#a4')
+        send_queue.put(b'$12345678#a4')
        
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
 
-        t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1], cache_pages=0)
         self.assertEqual(t.read_memory(0x11111111, 4), 0x12345678)
         t.endian = 'little'
         self.assertEqual(t.read_memory(0x11111111, 4), 0x78563412)
@@ -243,16 +511,39 @@ class TestRspTarget(unittest.TestCase):
         t.close()
         sock.close()
      
+    def test_read_memory_asyncio_transport(self):
+        send_queue = Queue()
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        send_queue.put(b"$anything#62")  # Reply to qSupported
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(b'$12345678#a4')
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send, send_queue)
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1],
+                                 transport=rsp_target.TRANSPORT_ASYNCIO, cache_pages=0)
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+        self.assertEqual(t.read_memory(0x11111111, 4), 0x12345678)
+
+    def test_unknown_transport(self):
+        with self.assertRaises(rsp_target.RspTargetError):
+            rsp_target.RspTarget('localhost', 4444, transport='carrier pigeon')
+
     def test_write_memory(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
         send_queue.put(system_registers_xml)
-        send_queue.put(b'$resp#nn')
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$resp#ba')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -275,7 +566,7 @@ class TestRspTarget(unittest.TestCase):
     def test_cmd_continue(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
@@ -283,7 +574,7 @@ class TestRspTarget(unittest.TestCase):
         # Normally the gdbstub doesn't send anything back in response to vCont unless the target
         # is already stopped, but we're sending something back just to keep _sock_read_and_send happy
         # (otherwise it would close before reading the vCont command)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -301,13 +592,13 @@ class TestRspTarget(unittest.TestCase):
     def test_cmd_stop(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
         send_queue.put(system_registers_xml)
-        send_queue.put(b'$OK#nn')
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -329,12 +620,12 @@ class TestRspTarget(unittest.TestCase):
     def test_cmd_stop_does_nothing_if_already_stopped(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
         send_queue.put(system_registers_xml)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -346,7 +637,7 @@ class TestRspTarget(unittest.TestCase):
         time.sleep(1)
         t.cmd_stop()
         time.sleep(1)
-        self.assertEqual(recvbuf, b'$qXfer:features:read:system-registers.xml:0x0,ffb#44')
+        self.assertEqual(recvbuf, _make_packet(b'qXfer:features:read:system-registers.xml:0,18b'))
         t.cmd_continue()  # Just sending something to close the test thread
 
         t.close()
@@ -355,12 +646,12 @@ class TestRspTarget(unittest.TestCase):
     def test_cannot_call_cmd_stop_from_another_thread(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
         send_queue.put(system_registers_xml)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -391,12 +682,12 @@ class TestRspTarget(unittest.TestCase):
     def test_cannot_call_cmd_step_from_another_thread(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
         send_queue.put(system_registers_xml)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -435,12 +726,12 @@ class TestRspTarget(unittest.TestCase):
 
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
         send_queue.put(system_registers_xml)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -452,12 +743,12 @@ class TestRspTarget(unittest.TestCase):
     def test_callbacks_can_call_cmd_stop(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
         send_queue.put(system_registers_xml)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -487,7 +778,7 @@ class TestRspTarget(unittest.TestCase):
     def test_set_sw_breakpoint(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
@@ -495,7 +786,7 @@ class TestRspTarget(unittest.TestCase):
         # Normally the gdbstub doesn't send anything back in response to vCont unless the target
         # is already stopped, but we're sending something back just to keep _sock_read_and_send happy
         # (otherwise it would close before reading the vCont command)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -512,7 +803,7 @@ class TestRspTarget(unittest.TestCase):
     def test_set_hw_breakpoint(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
@@ -520,7 +811,7 @@ class TestRspTarget(unittest.TestCase):
         # Normally the gdbstub doesn't send anything back in response to vCont unless the target
         # is already stopped, but we're sending something back just to keep _sock_read_and_send happy
         # (otherwise it would close before reading the vCont command)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -537,7 +828,7 @@ class TestRspTarget(unittest.TestCase):
     def test_set_write_watchpoint(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
@@ -545,7 +836,7 @@ class TestRspTarget(unittest.TestCase):
         # Normally the gdbstub doesn't send anything back in response to vCont unless the target
         # is already stopped, but we're sending something back just to keep _sock_read_and_send happy
         # (otherwise it would close before reading the vCont command)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -562,7 +853,7 @@ class TestRspTarget(unittest.TestCase):
     def test_set_read_watchpoint(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
@@ -570,7 +861,7 @@ class TestRspTarget(unittest.TestCase):
         # Normally the gdbstub doesn't send anything back in response to vCont unless the target
         # is already stopped, but we're sending something back just to keep _sock_read_and_send happy
         # (otherwise it would close before reading the vCont command)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -587,7 +878,7 @@ class TestRspTarget(unittest.TestCase):
     def test_set_access_watchpoint(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
@@ -595,7 +886,7 @@ class TestRspTarget(unittest.TestCase):
         # Normally the gdbstub doesn't send anything back in response to vCont unless the target
         # is already stopped, but we're sending something back just to keep _sock_read_and_send happy
         # (otherwise it would close before reading the vCont command)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -612,7 +903,7 @@ class TestRspTarget(unittest.TestCase):
     def test_remove_sw_breakpoint(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
@@ -620,18 +911,27 @@ class TestRspTarget(unittest.TestCase):
         # Normally the gdbstub doesn't send anything back in response to vCont unless the target
         # is already stopped, but we're sending something back just to keep _sock_read_and_send happy
         # (otherwise it would close before reading the vCont command)
-        send_queue.put(b'$OK#nn')
-        send_queue.put(b'$E#nn')  # Error response to trying to remove breakpoint
+        send_queue.put(b'$OK#9a')  # Reply to Z0
+        send_queue.put(b'$OK#9a')  # Reply to z0
+        send_queue.put(b'$OK#9a')  # Reply to Z0
+        send_queue.put(b'$E#45')  # Error response to trying to remove breakpoint
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
 
         t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
 
+        t.set_sw_breakpoint(0x12345678)
         t.remove_sw_breakpoint(0x12345678)
         time.sleep(1)
         self.assertEqual(recvbuf, b'$z0,12345678,4#da')
 
+        # Removing a breakpoint that isn't inserted doesn't send anything
+        t.remove_sw_breakpoint(0x12345678)
+        t.set_sw_breakpoint(0x12345678)
+        time.sleep(1)
+        self.assertEqual(recvbuf, b'$Z0,12345678,4#ba')
+
         with self.assertRaises(rsp_target.RspTargetError):
             t.remove_sw_breakpoint(0x12345678)
             time.sleep(1)
@@ -642,7 +942,7 @@ class TestRspTarget(unittest.TestCase):
     def test_remove_hw_breakpoint(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
@@ -650,13 +950,15 @@ class TestRspTarget(unittest.TestCase):
         # Normally the gdbstub doesn't send anything back in response to vCont unless the target
         # is already stopped, but we're sending something back just to keep _sock_read_and_send happy
         # (otherwise it would close before reading the vCont command)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')  # Reply to Z
+        send_queue.put(b'$OK#9a')  # Reply to z
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
 
         t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
 
+        t.set_hw_breakpoint(0x12345678)
         t.remove_hw_breakpoint(0x12345678)
         time.sleep(1)
         self.assertEqual(recvbuf, b'$z1,12345678,0#d7')
@@ -667,7 +969,7 @@ class TestRspTarget(unittest.TestCase):
     def test_remove_write_watchpoint(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
@@ -675,13 +977,15 @@ class TestRspTarget(unittest.TestCase):
         # Normally the gdbstub doesn't send anything back in response to vCont unless the target
         # is already stopped, but we're sending something back just to keep _sock_read_and_send happy
         # (otherwise it would close before reading the vCont command)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')  # Reply to Z
+        send_queue.put(b'$OK#9a')  # Reply to z
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
 
         t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
 
+        t.set_write_watchpoint(0x12345678, 4)
         t.remove_write_watchpoint(0x12345678, 4)
         time.sleep(1)
         self.assertEqual(recvbuf, b'$z2,12345678,4#dc')
@@ -692,7 +996,7 @@ class TestRspTarget(unittest.TestCase):
     def test_remove_read_watchpoint(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
@@ -700,13 +1004,15 @@ class TestRspTarget(unittest.TestCase):
         # Normally the gdbstub doesn't send anything back in response to vCont unless the target
         # is already stopped, but we're sending something back just to keep _sock_read_and_send happy
         # (otherwise it would close before reading the vCont command)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')  # Reply to Z
+        send_queue.put(b'$OK#9a')  # Reply to z
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
 
         t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
 
+        t.set_read_watchpoint(0x12345678, 4)
         t.remove_read_watchpoint(0x12345678, 4)
         time.sleep(1)
         self.assertEqual(recvbuf, b'$z3,12345678,4#dd')
@@ -717,7 +1023,7 @@ class TestRspTarget(unittest.TestCase):
     def test_remove_access_watchpoint(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
@@ -725,13 +1031,15 @@ class TestRspTarget(unittest.TestCase):
         # Normally the gdbstub doesn't send anything back in response to vCont unless the target
         # is already stopped, but we're sending something back just to keep _sock_read_and_send happy
         # (otherwise it would close before reading the vCont command)
-        send_queue.put(b'$OK#nn')
+        send_queue.put(b'$OK#9a')  # Reply to Z
+        send_queue.put(b'$OK#9a')  # Reply to z
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
 
         t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
 
+        t.set_access_watchpoint(0x12345678, 4)
         t.remove_access_watchpoint(0x12345678, 4)
         time.sleep(1)
         self.assertEqual(recvbuf, b'$z4,12345678,4#de')
@@ -742,7 +1050,7 @@ class TestRspTarget(unittest.TestCase):
     def test_close(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
@@ -797,14 +1105,14 @@ class TestRspTarget(unittest.TestCase):
     def test_request_xml_files(self):
         send_queue = Queue()
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(b"$anything#62")  # Reply to qSupported
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
         send_queue.put(system_registers_xml)
-        send_queue.put(b'$file 1 contents</feature>#nn')  # bogus reply for file request
-        send_queue.put(b'$file 2 contents</feature>\n#nn')  # bogus reply for file request
-        send_queue.put(b'$file 3 contents</feature>#nn')  # bogus reply for file request
+        send_queue.put(b'$file 1 contents</feature>#14')  # bogus reply for file request
+        send_queue.put(b'$file 2 contents</feature>\n#1f')  # bogus reply for file request
+        send_queue.put(b'$file 3 contents</feature>#16')  # bogus reply for file request
 
         sock = _make_test_socket()
         _start_sock_thread(sock, _sock_read_and_send, send_queue)
@@ -819,47 +1127,541 @@ class TestRspTarget(unittest.TestCase):
 
         self.assertEqual(xml_contents, [b'ile 1 contents</feature>', b'ile 2 contents</feature>\n', b'ile 3 contents</feature>'])
 
-    def test_get_stop_reason(self):
-        # Test doesn't work because once rsp_target is initialized, the event loop is listening for
-        # stop packets. Normally, _get_stop_reason executes *as* the event loop, so we arent't
-        # competing with it to pick up stop packets. But if you call _get_stop_reason directly,
-        # you are... and that function asks the target to give it a stop packet and directly reads
-        # it out of the queue. The event loop snarfs it up before we can catch it, and the test hangs.
-        self.skipTest("")
-        global debug_print_recv
-        global debug_print_send
-        debug_print_recv = True
-        debug_print_send = True
+    def test_parse_stop_packet(self):
+        stop = rsp_target._parse_stop_packet(b'T05swbreak:;0f:00801000;thread:p01.01;')
+        self.assertEqual(stop.signal_code, 5)
+        self.assertEqual(stop.reason, rsp_target.StopReasons.swbreak)
+        self.assertEqual(stop.thread, 'p01.01')
+        self.assertEqual(stop.registers, {15: b'00801000'})
+
+        stop = rsp_target._parse_stop_packet(b'T05watch:1234abcd;thread:p01.02;')
+        self.assertEqual(stop.reason, rsp_target.StopReasons.wwatch)
+        self.assertEqual(stop.watch_addr, 0x1234abcd)
+
+        stop = rsp_target._parse_stop_packet(b'T05awatch:10;')
+        self.assertEqual(stop.reason, rsp_target.StopReasons.awatch)
+        self.assertEqual(rsp_target._parse_stop_packet(b'T05rwatch:10;').reason,
+                         rsp_target.StopReasons.rwatch)
+        self.assertEqual(rsp_target._parse_stop_packet(b'T05hwbreak:;').reason,
+                         rsp_target.StopReasons.hwbreak)
+
+        # A bare SIGTRAP from a stub that doesn't report why is taken as a software breakpoint
+        self.assertEqual(rsp_target._parse_stop_packet(b'T05thread:p01.01;').reason,
+                         rsp_target.StopReasons.swbreak)
+        self.assertEqual(rsp_target._parse_stop_packet(b'S05').reason,
+                         rsp_target.StopReasons.swbreak)
+        self.assertEqual(rsp_target._parse_stop_packet(b'T02thread:p01.01;').reason, None)
+        self.assertEqual(rsp_target._parse_stop_packet(b'W00').signal_code, None)
+
+    def test_step_stop_handed_to_main_thread(self):
+        send_queue = Queue()
+        received = []
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        send_queue.put(_make_packet(b"QStartNoAckMode+"))  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(_make_packet(b'T05swbreak:;0f:00002000;thread:p01.01;'))  # Stop after step
 
-        logging.basicConfig(level=logging.DEBUG)
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
 
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+
+        hits = []
+        t.on_execute = hits.append
+
+        # The event thread passes the step's stop packet straight over rather than treating it
+        # as a breakpoint hit, so the step doesn't have to wait out its timeout
+        start = time.monotonic()
+        t.cmd_step()
+        self.assertLess(time.monotonic() - start, rsp_target.STEP_TIMEOUT)
+        time.sleep(.2)
+        self.assertEqual(hits, [0x2000])
+        self.assertTrue(t.target_is_stopped)
+
+    def test_stop_dispatched_from_stop_packet(self):
         send_queue = Queue()
+        received = []
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to qSupported
+        send_queue.put(_make_packet(b"QStartNoAckMode+"))  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
         send_queue.put(target_xml)
         send_queue.put(arm_core_xml)
         send_queue.put(arm_vfp_xml)
         send_queue.put(system_registers_xml)
+        send_queue.put(b"$OK#9a")  # Reply to Z0
+        send_queue.put(_make_packet(b'00' * 64))  # Reply to g, to check for a breakpoint at pc
+        send_queue.put(_make_packet(b'T05swbreak:;0f:00001000;thread:p01.01;'))  # Breakpoint hit
+        send_queue.put(b"$OK#9a")  # Reply to z0
+        send_queue.put(_make_packet(b'T05thread:p01.01;0f:00001004;'))  # Stop after stepping
+        send_queue.put(b"$OK#9a")  # Reply to Z0
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+
+        hits = []
+        resumes = []
+        t.on_execute = hits.append
+        t.on_resume = lambda dispatch, resume: resumes.append((dispatch, resume))
+        t.set_sw_breakpoint(0x1000)
+        t.cmd_continue()
+
+        for _ in range(100):
+            if hits and resumes and not t.target_is_stopped:
+                break
+
+            time.sleep(.02)
+
+        self.assertEqual(hits, [0x1000])
+        self.assertEqual(t.last_stop.thread, 'p01.01')
+
+        # Once it's resumed, it says how long dispatching the stop and resuming took
+        self.assertEqual(len(resumes), 1)
+        self.assertTrue(all(seconds >= 0 for seconds in resumes[0]))
+
+        # The pc came from the stop packet, so nothing was asked for after the breakpoint hit.
+        # Then only the breakpoint at the pc comes out to be stepped over; nothing else gets
+        # set again.
+        sent = b''.join(received)
+        after_continue = sent[sent.index(b'$vCont;c'):]
+        packets = re.findall(rb'\$([^#]*)#..', after_continue)
+        self.assertEqual(packets, [b'vCont;c', b'z0,00001000,4', b'vCont;s', b'Z0,00001000,4'])
+        # ...and the target is running again
+        self.assertFalse(t.target_is_stopped)
+
+    def test_watchpoint_dispatched_from_stop_packet(self):
+        send_queue = Queue()
+        received = []
         send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
-        send_queue.put(b"$anything#nn")  # Reply to close?
+        send_queue.put(_make_packet(b"QStartNoAckMode+"))  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(b"$OK#9a")  # Reply to Z2
+        send_queue.put(b"$OK#9a")  # Reply to Z4
+        # The stub reports the address written, which is inside the watched word
+        send_queue.put(_make_packet(b'T05watch:00002002;thread:p01.01;'))
 
         sock = _make_test_socket()
-        _start_sock_thread(sock, _sock_read_and_send, send_queue)
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
 
         t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+
+        writes = []
+        accesses = []
+        t.on_write = writes.append
+        t.on_access = accesses.append
+        t.set_write_watchpoint(0x2000, 4)
+        t.set_access_watchpoint(0x3000, 4)
+        t.cmd_continue()
 
-        stop_reason = t._get_stop_reason(b"T05thread:p01.01")
+        for _ in range(100):
+            if writes and not t.target_is_stopped:
+                break
 
-        t.close()
-        sock.close()
+            time.sleep(.02)
+
+        self.assertEqual(writes, [0x2000])
+        self.assertEqual(accesses, [])
+        self.assertEqual(t.last_stop.reason, rsp_target.StopReasons.wwatch)
+        self.assertFalse(t.target_is_stopped)
+
+    def test_watchpoint_hit(self):
+        send_queue = Queue()
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        send_queue.put(_make_packet(b"QStartNoAckMode+"))  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(b"$OK#9a")  # Reply to Z3
+        send_queue.put(b"$OK#9a")  # Reply to Z2
+        send_queue.put(b"$OK#9a")  # Reply to Z2
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, [])
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+
+        t.set_read_watchpoint(0x1000, 4)
+        # A lone watchpoint is the one that was hit, even if the stub didn't say where
+        self.assertEqual(t._watchpoint_hit(rsp_target.WP_READ, None), 0x1000)
+
+        t.set_write_watchpoint(0x2000, 8)
+        t.set_write_watchpoint(0x3000, 4)
+        self.assertEqual(t._watchpoint_hit(rsp_target.WP_WRITE, 0x2007), 0x2000)
+        self.assertEqual(t._watchpoint_hit(rsp_target.WP_WRITE, 0x3000), 0x3000)
+        self.assertEqual(t._watchpoint_hit(rsp_target.WP_WRITE, 0x4000), 0x4000)
+        self.assertIsNone(t._watchpoint_hit(rsp_target.WP_WRITE, None))
+
+    def test_conditional_breakpoint(self):
+        send_queue = Queue()
+        received = []
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        send_queue.put(_make_packet(b"QStartNoAckMode+;ConditionalBreakpoints+"))
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(b"$OK#9a")  # Reply to Z0 with one condition
+        send_queue.put(b"$OK#9a")  # Reply to Z0 with two conditions
+        send_queue.put(b"$OK#9a")  # Reply to Z0 with no conditions
+        send_queue.put(b"$OK#9a")  # Keeps the mock reading until the last Z0 arrives
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+
+        self.assertTrue(t.capabilities.conditional_breakpoints)
+        r2_is_5 = t.compile_condition(Reg('r2') == 5)
+        self.assertEqual(r2_is_5, bytes([0x26, 0x00, 0x02, 0x22, 0x05, 0x13, 0x27]))
+        r0_is_0 = t.compile_condition(Reg('r0') == 0)
+
+        t.set_sw_breakpoint(0x1000, [r2_is_5])
+        # Same conditions, nothing to send
+        t.set_sw_breakpoint(0x1000, [r2_is_5])
+        # New conditions replace the old ones
+        t.set_sw_breakpoint(0x1000, [r2_is_5, r0_is_0])
+        t.set_sw_breakpoint(0x1000)
+        time.sleep(.2)
+
+        sent = b''.join(received)
+        packets = re.findall(rb'\$([^#]*)#..', sent[sent.index(b'$Z'):])
+        self.assertEqual(packets, [b'Z0,00001000,4;X7,26000222051327',
+                                   b'Z0,00001000,4;X7,26000222051327X7,26000022001327',
+                                   b'Z0,00001000,4'])
+
+        with self.assertRaises(rsp_target.RspTargetError):
+            t.compile_condition(Reg('nope') == 0)
+
+    def test_debug_register_slots(self):
+        send_queue = Queue()
+        received = []
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        send_queue.put(_make_packet(b"QStartNoAckMode+"))  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(b"$OK#9a")  # Reply to Z1
+        send_queue.put(b"$OK#9a")  # Reply to Z0, after falling back to software
+        send_queue.put(b"$E0e#ab")  # Reply to Z2, the stub is out of debug registers
+        send_queue.put(b"$OK#9a")  # Reply to Z2
+        send_queue.put(b"$OK#9a")  # Reply to z1
+        send_queue.put(b"$OK#9a")  # Reply to z0
+        send_queue.put(b"$OK#9a")  # Keeps the mock reading until the z0 arrives
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1], hw_breakpoint_slots=1,
+                                 watchpoint_slots=1)
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+
+        t.set_hw_breakpoint(0x1000)
+
+        # There's only one debug register for breakpoints, so this doesn't even get sent...
+        with self.assertRaises(rsp_target.RspTargetError):
+            t.set_hw_breakpoint(0x2000)
+
+        # ...and an execution breakpoint falls back to software
+        t.set_exec_breakpoint(0x2000, hardware=True)
+
+        # The stub refusing a watchpoint gives its debug register back
+        with self.assertRaises(rsp_target.RspTargetError):
+            t.set_write_watchpoint(0x3000, 4)
+
+        t.set_write_watchpoint(0x3000, 4)
+
+        t.remove_exec_breakpoint(0x1000)
+        t.remove_exec_breakpoint(0x2000)
+        time.sleep(.2)
+
+        sent = b''.join(received)
+        packets = re.findall(rb'\$([^#]*)#..', sent[sent.index(b'$Z'):])
+        self.assertEqual(packets, [b'Z1,00001000,0', b'Z0,00002000,4', b'Z2,00003000,4',
+                                   b'Z2,00003000,4', b'z1,00001000,0', b'z0,00002000,4'])
+
+    def test_exec_breakpoint_batch(self):
+        send_queue = Queue()
+        received = []
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        send_queue.put(_make_packet(b"QStartNoAckMode+"))  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(b"$OK#9a")  # Reply to Z0 at 0x1000
+        send_queue.put(b"$E01#a6")  # Reply to Z0 at 0x2000
+        send_queue.put(b"$OK#9a")  # Reply to Z0 at 0x3000
+        send_queue.put(b"$OK#9a")  # Reply to z0 at 0x1000
+        send_queue.put(b"$OK#9a")  # Reply to z0 at 0x3000
+        send_queue.put(b"$OK#9a")  # Keeps the mock reading until the last z0 arrives
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+
+        # The one the stub refuses doesn't stop the others being set
+        with self.assertRaises(rsp_target.RspTargetError):
+            t.set_exec_breakpoints({0x1000: None, 0x2000: None, 0x3000: None})
+
+        # Only the ones that were set get removed, and ones already set aren't sent again
+        t.set_exec_breakpoints({0x1000: None})
+        t.remove_exec_breakpoints([0x1000, 0x2000, 0x3000])
+        time.sleep(.2)
+
+        sent = b''.join(received)
+        packets = re.findall(rb'\$([^#]*)#..', sent[sent.index(b'$Z'):])
+        self.assertEqual(packets, [b'Z0,00001000,4', b'Z0,00002000,4', b'Z0,00003000,4',
+                                   b'z0,00001000,4', b'z0,00003000,4'])
+
+    def test_tracepoints(self):
+        # r0 and r1 are collected, the rest of the registers aren't
+        frame_regs = b'%08x%08x' + b'x' * 8 * 14
+        send_queue = Queue()
+        received = []
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        send_queue.put(_make_packet(b"QStartNoAckMode+"))  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(b"$OK#9a")  # Reply to QTinit
+        send_queue.put(b"$OK#9a")  # Reply to QTDP for the tracepoint
+        send_queue.put(b"$OK#9a")  # Reply to QTDP for the registers
+        send_queue.put(b"$OK#9a")  # Reply to QTDP for the memory
+        send_queue.put(b"$OK#9a")  # Reply to QTStart
+        send_queue.put(_make_packet(b"T1;tnotrun:0;tframes:2;tcreated:2"))  # Reply to qTStatus
+        # Reading the registers of a batch of three frames, when there are only two
+        send_queue.put(_make_packet(b"F0T1"))
+        send_queue.put(_make_packet(frame_regs % (0x11, 0x8000)))
+        send_queue.put(_make_packet(b"F1T1"))
+        send_queue.put(_make_packet(frame_regs % (0x22, 0x9000)))
+        send_queue.put(_make_packet(b"F-1"))
+        send_queue.put(_make_packet(frame_regs % (0, 0)))
+        # Then their memory
+        send_queue.put(_make_packet(b"F0T1"))
+        send_queue.put(_make_packet(b"01020304"))
+        send_queue.put(_make_packet(b"F1T1"))
+        send_queue.put(b"$E01#a6")  # This one wasn't collected
+        send_queue.put(b"$OK#9a")  # Reply to QTFrame:-1
+        send_queue.put(b"$OK#9a")  # Keeps the mock reading until QTFrame:-1 arrives
 
-        logging.basicConfig(level=logging.INFO)
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
 
-        debug_print_recv = False
-        debug_print_send = False
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+
+        # The stub doesn't check conditions
+        with self.assertRaises(rsp_target.RspTargetError):
+            t.set_tracepoint(0x1000, Capture(), condition=b'\x27')
+
+        number = t.set_tracepoint(0x1000, Capture(registers=['r0'],
+                                                  memory=[(Reg('r1') + 4, 4)]))
+        self.assertEqual(number, 1)
+        t.trace_start()
+        status = t.trace_status()
+        self.assertTrue(status.running)
+        self.assertEqual(status.frames, 2)
+
+        frames = list(t.trace_frames(batch=3))
+        self.assertEqual([frame.number for frame in frames], [0, 1])
+        self.assertEqual(frames[0].addr, 0x1000)
+        self.assertEqual(frames[0].tracepoint, 1)
+        self.assertEqual(frames[0].get_reg('r0'), 0x11)
+        self.assertEqual(frames[1].get_reg('r1'), 0x9000)
+        self.assertEqual(frames[0].read_bytes(0x8004, 4), b'\x01\x02\x03\x04')
+
+        with self.assertRaises(MonkSnapshotError):
+            frames[1].read_bytes(0x9004, 4)
+
+        time.sleep(.2)
+        sent = b''.join(received)
+        packets = re.findall(rb'\$([^#]*)#..', sent[sent.index(b'$QTinit'):])
+        self.assertEqual(packets, [b'QTinit',
+                                   b'QTDP:1:00001000:E:0:0-',
+                                   b'QTDP:-1:00001000:R3-',
+                                   b'QTDP:-1:00001000:M1,4,4',
+                                   b'QTStart', b'qTStatus',
+                                   b'QTFrame:0', b'g', b'QTFrame:1', b'g', b'QTFrame:2', b'g',
+                                   b'QTFrame:0', b'm00008004,4', b'QTFrame:1', b'm00009004,4',
+                                   b'QTFrame:-1'])
+
+    def test_step_n_and_step_until(self):
+        send_queue = Queue()
+        received = []
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        send_queue.put(_make_packet(b"QStartNoAckMode+"))  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+
+        # Every step's stop packet has the pc in it
+        for pc in (0x1004, 0x1008, 0x100c, 0x1010, 0xc0001000):
+            send_queue.put(_make_packet(b"T05thread:p01.01;0f:%08x;" % pc))
+
+        send_queue.put(_make_packet(b"vCont;c;C;s;S;r"))  # Reply to vCont?
+        send_queue.put(_make_packet(b"T05thread:p01.01;0f:00003000;"))  # Reply to vCont;r
+        send_queue.put(b"$OK#9a")  # Keeps the mock reading until vCont;r arrives
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1])
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
 
-        self.assertEqual(stop_reason, rsp_target.StopReasons.swbreak)
+        self.assertEqual(t.cmd_step_n(2), [0x1004, 0x1008])
+        self.assertEqual(t.cmd_step_until(lambda pc: pc >= 0xc0000000),
+                         [0x100c, 0x1010, 0xc0001000])
 
+        # The stub steps through the range itself
+        self.assertEqual(t.cmd_step_until((0x2000, 0x3000)), [0x3000])
+        time.sleep(.2)
+
+        # Nothing but the steps themselves, the pcs came from the stop packets
+        sent = b''.join(received)
+        packets = re.findall(rb'\$([^#]*)#..', sent[sent.index(b'$vCont'):])
+        self.assertEqual(packets, [b'vCont;s'] * 5 + [b'vCont?', b'vCont;r2000,3000'])
+
+    def test_threads(self):
+        send_queue = Queue()
+        received = []
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        send_queue.put(_make_packet(b"QStartNoAckMode+"))  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+        send_queue.put(_make_packet(b"mp01.01,p01.02"))  # Reply to qfThreadInfo
+        send_queue.put(_make_packet(b"l"))  # Reply to qsThreadInfo
+        send_queue.put(b"$OK#9a")  # Reply to Hgp01.02
+        send_queue.put(_make_packet(b"12345678"))  # Reply to g, for the second vCPU
+        send_queue.put(b"$OK#9a")  # Reply to Hgp01.01
+        send_queue.put(_make_packet(b"87654321"))  # Reply to g, for the vCPU that stopped
+        send_queue.put(_make_packet(b"aabbccdd"))  # Reply to m
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1], cache_pages=0)
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+
+        self.assertEqual(t.stop_thread, 'p01.01')
+        self.assertEqual(t.threads(), ['p01.01', 'p01.02'])
+
+        # Each vCPU has its own registers, and its own cache of them
+        self.assertEqual(t.read_register('r0', 'p01.02'), 0x12345678)
+        self.assertEqual(t.read_register('r0'), 0x87654321)
+        self.assertEqual(t.read_register('r0', 'p01.02'), 0x12345678)
+
+        # Memory is read through the vCPU that stopped, which is already selected
+        self.assertEqual(t.read_memory(0x1000, 4), 0xaabbccdd)
+        time.sleep(.2)
+
+        sent = b''.join(received)
+        packets = re.findall(rb'\$([^#]*)#..', sent[sent.index(b'$qfThreadInfo'):])
+        self.assertEqual(packets, [b'qfThreadInfo', b'qsThreadInfo', b'Hgp01.02', b'g',
+                                   b'Hgp01.01', b'g', b'm00001000,4'])
+
+    def test_non_stop(self):
+        send_queue = Queue()
+        received = []
+        send_queue.put(b"$T05thread:p01.01;#06")  # Reply to ? query for stopped status
+        send_queue.put(_make_packet(b"QStartNoAckMode+"))  # Reply to qSupported
+        send_queue.put(b"$OK#9a")  # Reply to QStartNoAckMode
+        send_queue.put(b"$OK#9a")  # Reply to QNonStop:1
+        send_queue.put(_make_packet(b"mp01.01,p01.02"))  # Reply to qfThreadInfo
+        send_queue.put(_make_packet(b"l"))  # Reply to qsThreadInfo
+        send_queue.put(target_xml)
+        send_queue.put(arm_core_xml)
+        send_queue.put(arm_vfp_xml)
+        send_queue.put(system_registers_xml)
+
+        # Both vCPUs hit breakpoints as soon as they're continued. The stub reports the first
+        # with a notification, and the second in the reply to vStopped.
+        send_queue.put(_make_notification(b"Stop:T05swbreak:;0f:00001000;thread:p01.02;") +
+                       b"$OK#9a")  # Reply to vCont;c
+        send_queue.put(_make_packet(b"T05swbreak:;0f:00002000;thread:p01.01;"))  # vStopped
+        send_queue.put(b"$OK#9a")  # Reply to vStopped, that's all of them
+        send_queue.put(b"$OK#9a")  # Reply to vCont;c:p01.02
+        send_queue.put(b"$OK#9a")  # Reply to vCont;c:p01.01
+
+        send_queue.put(_make_packet(b"mp01.01,p01.02"))  # Reply to qfThreadInfo
+        send_queue.put(_make_packet(b"l"))  # Reply to qsThreadInfo
+        send_queue.put(b"$OK#9a" +
+                       _make_notification(b"Stop:T00thread:p01.01;"))  # Reply to vCont;t
+        send_queue.put(_make_packet(b"T00thread:p01.02;"))  # Reply to vStopped
+        send_queue.put(b"$OK#9a")  # Reply to vStopped
+
+        sock = _make_test_socket()
+        _start_sock_thread(sock, _sock_read_and_send_no_ack, send_queue, received)
+
+        t = rsp_target.RspTarget('localhost', sock.getsockname()[1], non_stop=True)
+        self.addCleanup(sock.close)
+        self.addCleanup(t.close)
+
+        hits = []
+        t.on_execute = lambda addr: hits.append((t.stop_thread, addr))
+
+        # Each hook only stops the vCPU that hit it, which is resumed on its own afterwards
+        t.cmd_continue()
+
+        # The event lock is held until each vCPU has been resumed
+        with t._event_cond:
+            self.assertTrue(t._event_cond.wait_for(lambda: len(hits) == 2, timeout=5))
+
+        self.assertEqual(hits, [('p01.02', 0x1000), ('p01.01', 0x2000)])
+        self.assertFalse(t.target_is_stopped)
+
+        # Stopping waits for every vCPU to report that it's stopped
+        t.cmd_stop()
+        self.assertTrue(t.target_is_stopped)
+        self.assertEqual(t._stopped_threads, {'p01.01', 'p01.02'})
+        time.sleep(.2)
+
+        sent = b''.join(received)
+        packets = re.findall(rb'\$([^#]*)#..', sent[sent.index(b'$vCont'):])
+        self.assertEqual(packets, [b'vCont;c', b'vStopped', b'vStopped', b'vCont;c:p01.02',
+                                   b'vCont;c:p01.01', b'qfThreadInfo', b'qsThreadInfo',
+                                   b'vCont;t', b'vStopped', b'vStopped'])
+
+        # Neither stop with no signal was an event
+        self.assertEqual(len(hits), 2)
 
 
 # GDB rsp packets
@@ -0,0 +1,71 @@
+import unittest
+
+from monk.backends.rsp_helpers.tracepoints import Tracepoint, TraceStatus, TraceFrame, \
+    TracepointError, parse_frame_reply, memory_address
+from monk.conditions import Reg, Mem
+from monk.snapshot import Capture
+
+reg_map = {'r0': 0, 'r2': 2, 'sp': 13, 'pc': 15}
+
+
+class TestTracepoints(unittest.TestCase):
+    def test_packets(self):
+        capture = Capture(registers=['r0', 'pc'],
+                          memory=[(Reg('r2') + 8, 16), (0x2000, 4), (Reg('sp') - 4, 4)])
+        tracepoint = Tracepoint(1, 0x1000, capture, condition=b'\x26\x00\x02\x27',
+                                pass_count=5)
+
+        # r2 and sp are collected too, so the ranges' addresses can be worked out later
+        self.assertEqual(tracepoint.packets(reg_map, 4),
+                         [b'QTDP:1:00001000:E:0:5:X4,26000227-',
+                          b'QTDP:-1:00001000:Ra005-',
+                          b'QTDP:-1:00001000:M2,8,10-',
+                          b'QTDP:-1:00001000:M-1,2000,4-',
+                          b'QTDP:-1:00001000:Md,fffffffffffffffc,4'])
+
+        # Nothing to collect is just the tracepoint
+        self.assertEqual(Tracepoint(2, 0x1000, Capture()).packets(reg_map, 4),
+                         [b'QTDP:2:00001000:E:0:0'])
+
+    def test_packets_bad_capture(self):
+        with self.assertRaises(TracepointError):
+            Tracepoint(1, 0x1000, Capture(registers=['nope'])).packets(reg_map, 4)
+
+        with self.assertRaises(TracepointError):
+            Tracepoint(1, 0x1000, Capture(memory=[(Mem(Reg('r2')), 4)])).packets(reg_map, 4)
+
+    def test_status(self):
+        status = TraceStatus.from_reply(b'T0;tpasscount:1;tframes:1f;tcreated:20;tfree:fff00;'
+                                        b'tsize:100000')
+        self.assertFalse(status.running)
+        self.assertEqual(status.frames, 0x1f)
+        self.assertEqual(status.created, 0x20)
+        self.assertEqual(status.buffer_size, 0x100000)
+        self.assertEqual(status.buffer_free, 0xfff00)
+        self.assertEqual(status.stop_reason, 'tpasscount')
+
+        status = TraceStatus.from_reply(b'T1;tnotrun:0')
+        self.assertTrue(status.running)
+        self.assertIsNone(status.frames)
+
+    def test_parse_frame_reply(self):
+        self.assertEqual(parse_frame_reply(b'F1aT2'), (0x1a, 2))
+        self.assertIsNone(parse_frame_reply(b'F-1'))
+        self.assertIsNone(parse_frame_reply(b'E01'))
+
+    def test_memory_address(self):
+        registers = {'r2': 0x8000}
+        self.assertEqual(memory_address(Reg('r2') + 8, registers), 0x8008)
+        self.assertEqual(memory_address(Reg('r2') - 8, registers), 0x7ff8)
+        self.assertEqual(memory_address(Reg('r2'), registers), 0x8000)
+
+    def test_frame(self):
+        frame = TraceFrame(3, 1, 0x1000, {'r0': 1}, [((0x2000, 2), b'\xaa\xbb')])
+        self.assertEqual(frame.number, 3)
+        self.assertEqual(frame.tracepoint, 1)
+        self.assertEqual(frame.kind, 'trace')
+        self.assertEqual(frame.get_reg('r0'), 1)
+        self.assertEqual(frame.read_bytes(0x2001, 1), b'\xbb')
+
+        with self.assertRaises(AttributeError):
+            frame.addr = 0
@@ -0,0 +1,39 @@
+import math
+import unittest
+
+from monk.budget import Budget, MonkBudgetError
+
+
+class TestBudget(unittest.TestCase):
+    def test_every(self):
+        tracker = Budget(every=3).tracker()
+        self.assertEqual([tracker.hit(0)[0] for _ in range(7)],
+                         [True, False, False, True, False, False, True])
+
+    def test_per_second(self):
+        tracker = Budget(per_second=2).tracker()
+        self.assertEqual(tracker.hit(10.0), (True, None))
+
+        # The second run uses up the second, so the hook comes out until it's over
+        self.assertEqual(tracker.hit(10.5), (True, 11.0))
+
+        # A hit that still turns up doesn't run
+        self.assertEqual(tracker.hit(10.9), (False, 11.0))
+
+        self.assertEqual(tracker.hit(11.2), (True, None))
+
+    def test_max_hits(self):
+        tracker = Budget(every=2, max_hits=3).tracker()
+        self.assertEqual(tracker.hit(0), (True, None))
+        self.assertEqual(tracker.hit(0), (False, None))
+        self.assertEqual(tracker.hit(0), (True, math.inf))
+
+        # Each tracker counts separately
+        self.assertEqual(tracker.budget.tracker().hit(0), (True, None))
+
+    def test_invalid(self):
+        with self.assertRaises(MonkBudgetError):
+            Budget(every=0)
+
+        with self.assertRaises(MonkBudgetError):
+            Budget(per_second=0)
@@ -0,0 +1,75 @@
+import threading
+import unittest
+
+from monk.callback_pool import CallbackPool
+
+
+class TestCallbackPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = CallbackPool(workers=1, timeout=.5)
+        self.addCleanup(self.pool.close)
+
+    def test_workers_reused(self):
+        threads = []
+
+        for _ in range(3):
+            self.assertTrue(self.pool.run(lambda: threads.append(threading.get_ident())))
+
+        # Every callback ran on the same worker, and never on the dispatching thread
+        self.assertEqual(len(set(threads)), 1)
+        self.assertNotEqual(threads[0], threading.get_ident())
+
+    def test_exception_does_not_kill_worker(self):
+        def bad_callback():
+            raise ValueError("oops")
+
+        with self.assertLogs('monk.callback_pool', level='ERROR'):
+            self.assertTrue(self.pool.run(bad_callback))
+
+        ran = []
+        self.assertTrue(self.pool.run(lambda: ran.append(True)))
+        self.assertEqual(ran, [True])
+
+    def test_timeout(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        hung_worker = self.pool._workers[0]
+
+        with self.assertLogs('monk.callback_pool', level='WARNING'):
+            self.assertFalse(self.pool.run(release.wait))
+
+        self.assertEqual(self.pool.timeouts, 1)
+
+        # A replacement worker runs the next callback while the hung one is still going
+        ran = []
+        self.assertTrue(self.pool.run(lambda: ran.append(True)))
+        self.assertEqual(ran, [True])
+
+        # Once the hung callback returns, its worker leaves the pool
+        release.set()
+        hung_worker.join(1)
+        self.assertFalse(hung_worker.is_alive())
+        self.assertEqual(len(self.pool._workers), 1)
+
+    def test_submit(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        done = threading.Event()
+        self.pool.max_pending = 2
+        results = []
+
+        # Submitting doesn't wait, even though the worker is busy
+        self.assertTrue(self.pool.submit(release.wait))
+        self.assertTrue(self.pool.submit(results.append, 1))
+
+        # Too many are queued up, so this one's dropped
+        self.assertFalse(self.pool.submit(results.append, 2))
+        self.assertEqual(self.pool.dropped, 1)
+
+        release.set()
+        self.assertTrue(self.pool.run(done.set))
+        self.assertTrue(done.is_set())
+        self.assertEqual(results, [1])
+        self.assertTrue(self.pool.submit(results.append, 3))
+        self.assertTrue(self.pool.run(lambda: None))
+        self.assertEqual(results, [1, 3])
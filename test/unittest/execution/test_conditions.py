@@ -0,0 +1,32 @@
+import unittest
+from unittest.mock import MagicMock
+
+from monk.conditions import Reg, Mem, Not, MonkConditionError
+
+
+class TestConditions(unittest.TestCase):
+    def setUp(self):
+        self.backend = MagicMock()
+        self.backend.endian = 'big'
+        self.backend.get_reg.side_effect = {'r0': 0, 'r2': 0x1234}.get
+        self.backend.read_bytes.return_value = b'\x00\x00\x00\x07'
+
+    def test_evaluate(self):
+        self.assertEqual((Reg('r2') == 0x1234).evaluate(self.backend), 1)
+        self.assertEqual((Reg('r2') > 0x1234).evaluate(self.backend), 0)
+        self.assertEqual(Not(Reg('r0')).evaluate(self.backend), 1)
+
+        cond = (Mem(Reg('r2') + 4) == 7) & (Reg('r0') != 0)
+        self.assertEqual(cond.evaluate(self.backend), 0)
+        self.backend.read_bytes.assert_called_with(0x1238, 4)
+
+    def test_no_bools(self):
+        with self.assertRaises(MonkConditionError):
+            if Reg('r0') == 0:
+                pass
+
+        with self.assertRaises(MonkConditionError):
+            Reg('r0') == -1
+
+        with self.assertRaises(MonkConditionError):
+            Mem(0x1000, 3)
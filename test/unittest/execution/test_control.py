@@ -1,7 +1,15 @@
+import re
+import threading
 import unittest
 from unittest.mock import MagicMock
 
+from monk.budget import Budget
+from monk.conditions import Reg
+from monk.snapshot import Capture
 from monk.callback_manager import CallbackManager, MonkControlError, EVENT_READ, EVENT_WRITE, EVENT_ACCESS, EVENT_EXECUTE
+from monk.symbols import Symbols
+from monk.symbols.dwarf2json_loader import Dwarf2JsonLoader
+from monk.target import Monk
 
 
 # TODO: Split this file according to the classes it tests, currently it tests both
@@ -154,6 +162,19 @@ class TestControl(unittest.TestCase):
         self.assertEqual(self.callback_manager._on_read_callbacks[1], [cb2])
         self.test_backend.set_read_breakpoint.assert_called_with(1)
 
+    def test_on_write_breakpoint_fails(self):
+        cb = MagicMock()
+        self.test_backend.set_write_breakpoint.side_effect = RuntimeError("no debug registers")
+
+        with self.assertRaises(RuntimeError):
+            self.callback_manager.on_write(0x1000, cb)
+
+        # The callback isn't left registered, so the next one tries to set the breakpoint again
+        self.assertEqual(self.callback_manager._on_write_callbacks[0x1000], [])
+        self.test_backend.set_write_breakpoint.side_effect = None
+        self.callback_manager.on_write(0x1000, cb)
+        self.assertEqual(self.test_backend.set_write_breakpoint.call_count, 2)
+
     def test_on_write(self):
         cb1 = MagicMock()
         cb2 = MagicMock()
@@ -382,9 +403,286 @@ class TestControl(unittest.TestCase):
 
     def test_callback_handler(self):
         test_callback = MagicMock()
-        self.callback_manager._set_breakpoint(EVENT_EXECUTE, 0x0)
+        self.callback_manager.on_execute(0x0, test_callback)
+        self.test_backend.set_exec_breakpoint.reset_mock()
         self.callback_manager._callback_handler([test_callback])
         test_callback.assert_called()
-        # This is supposed to test that breakpoints are re-set on target stop, but atm it's not
-        # an effective test...
-        self.test_backend.set_exec_breakpoint.assert_called_with(0x0)
+        # Breakpoints stay inserted in the backend across stops, so nothing gets re-armed
+        self.test_backend.set_exec_breakpoint.assert_not_called()
+
+    def test_conditions(self):
+        cond = MagicMock()
+        check = cond.compile.return_value
+        check.return_value = 0
+        cb1 = MagicMock()
+        cb2 = MagicMock()
+
+        hook1 = self.callback_manager.on_execute(0x1000, cb1, cond)
+        # Every hook at the address has a condition, so the target can check them
+        self.test_backend.set_exec_breakpoint.assert_called_with(0x1000, [cond])
+
+        # A hook without a condition means the target always has to stop
+        hook2 = self.callback_manager.on_execute(0x1000, cb2)
+        self.test_backend.set_exec_breakpoint.assert_called_with(0x1000)
+
+        # Only the callbacks whose conditions hold run
+        self.callback_manager._on_execute_dispatcher(0x1000)
+        cb1.assert_not_called()
+        cb2.assert_called_once()
+        check.assert_called_with(self.test_backend)
+        # It was compiled once, when the hook was added
+        cond.compile.assert_called_once()
+
+        check.return_value = 1
+        self.callback_manager._on_execute_dispatcher(0x1000)
+        cb1.assert_called_once()
+
+        # Removing the unconditional hook lets the target check the condition again
+        self.callback_manager.remove_callback(hook2)
+        self.test_backend.set_exec_breakpoint.assert_called_with(0x1000, [cond])
+
+        self.callback_manager.remove_callback(hook1)
+        self.test_backend.del_exec_breakpoint.assert_called_with(0x1000)
+        self.assertEqual(self.callback_manager._conditions, {})
+        self.assertEqual(self.callback_manager._checks, {})
+
+    def test_mixed_conditions(self):
+        first = Reg('r0') == 1
+        second = Reg('r1') == 2
+        self.callback_manager.on_execute(0x1000, MagicMock(), first)
+        unconditional = self.callback_manager.on_execute(0x1000, MagicMock())
+
+        # Real conditions compare into new Exprs, so finding the unconditional hook mustn't
+        # compare them with None
+        self.callback_manager.on_execute(0x1000, MagicMock(), second)
+        self.test_backend.set_exec_breakpoint.assert_called_with(0x1000)
+
+        self.callback_manager.remove_callback(unconditional)
+        self.test_backend.set_exec_breakpoint.assert_called_with(0x1000, [first, second])
+
+    def test_deferred(self):
+        done = threading.Event()
+        snapshots = []
+
+        def record(snapshot):
+            snapshots.append(snapshot)
+            done.set()
+
+        self.test_backend.get_reg.return_value = 0x1234
+        capture = Capture(registers=['r2'])
+        hook = self.callback_manager.on_execute(0x1000, record, deferred=True, capture=capture)
+
+        # The dispatcher returns without waiting for the deferred callback
+        self.callback_manager._on_execute_dispatcher(0x1000)
+        self.assertTrue(done.wait(1))
+        self.assertEqual(snapshots[0].addr, 0x1000)
+        self.assertEqual(snapshots[0].get_reg('r2'), 0x1234)
+
+        self.callback_manager.remove_callback(hook)
+        self.assertEqual(self.callback_manager._captures, {})
+
+        # Only deferred callbacks capture snapshots
+        with self.assertRaises(MonkControlError):
+            self.callback_manager.on_execute(0x1000, record, capture=capture)
+
+    def test_range_hooks(self):
+        struct_cb = MagicMock()
+        func_cb = MagicMock()
+        insn_cb = MagicMock()
+
+        # A range is watched with a single watchpoint covering it
+        struct_hook = self.callback_manager.on_write(range(0x1000, 0x1010), struct_cb)
+        self.assertEqual(struct_hook, (EVENT_WRITE, range(0x1000, 0x1010), struct_cb))
+        self.test_backend.set_write_breakpoint.assert_called_with(0x1000, 0x10)
+
+        self.callback_manager._on_write_dispatcher(0x1000)
+        struct_cb.assert_called_once()
+
+        self.callback_manager.remove_callback(struct_hook)
+        self.test_backend.del_write_breakpoint.assert_called_with(0x1000, 0x10)
+
+        # Executing a range needs a breakpoint on every instruction in it
+        func_hook = self.callback_manager.on_execute(range(0x2000, 0x200c, 4), func_cb)
+        self.assertEqual([c.args for c in self.test_backend.set_exec_breakpoint.call_args_list],
+                         [(0x2000,), (0x2004,), (0x2008,)])
+        self.callback_manager.on_execute(0x2004, insn_cb)
+
+        # Every hook covering the address runs
+        self.callback_manager._on_execute_dispatcher(0x2004)
+        func_cb.assert_called_once()
+        insn_cb.assert_called_once()
+
+        self.callback_manager._on_execute_dispatcher(0x2008)
+        self.assertEqual(func_cb.call_count, 2)
+        insn_cb.assert_called_once()
+
+        # The breakpoint the other hook still needs stays in
+        self.callback_manager.remove_callback(func_hook)
+        self.assertEqual([c.args for c in self.test_backend.del_exec_breakpoint.call_args_list],
+                         [(0x2000,), (0x2008,)])
+
+        with self.assertRaises(MonkControlError):
+            self.callback_manager.on_read(range(0x1000, 0x1000), struct_cb)
+
+    def test_on_execute_pattern(self):
+        symbols = Symbols(None, self.test_backend)
+        symbols._dwarf2json = Dwarf2JsonLoader.__new__(Dwarf2JsonLoader)
+        function = {'kind': 'function'}
+        symbols._dwarf2json._json = {'symbols': {
+            'sys_read': {'address': 0x1000, 'type': function},
+            'sys_write': {'address': 0x2000, 'type': function},
+            '__se_sys_write': {'address': 0x2000, 'type': function},
+            'do_fork': {'address': 0x3000, 'type': function},
+            # Data that matches isn't hooked
+            'sys_call_table': {'address': 0x8000, 'type': {'kind': 'array'}}}}
+        del symbols.match
+
+        target = Monk.__new__(Monk)
+        target._callback_manager = self.callback_manager
+        target.symbols = symbols
+        cb = MagicMock()
+        self.callback_manager.on_execute(0x2000, MagicMock())
+        self.test_backend.reset_mock()
+
+        # Every match is hooked, aliases once, and the breakpoints go to the backend together
+        group = target.on_execute_pattern('*sys_*', cb)
+        self.assertNotIn('sys_call_table', group.symbols)
+        self.assertEqual(group.symbols, {'sys_read': 0x1000, 'sys_write': 0x2000,
+                                         '__se_sys_write': 0x2000})
+        self.assertEqual(len(group), 2)
+        self.test_backend.set_exec_breakpoints.assert_called_once_with({0x1000: None,
+                                                                        0x2000: None})
+        self.test_backend.set_exec_breakpoint.assert_not_called()
+
+        self.callback_manager._on_execute_dispatcher(0x2000)
+        cb.assert_called_once()
+
+        # Removing the group leaves in the breakpoint another hook still needs
+        group.remove()
+        self.test_backend.del_exec_breakpoints.assert_called_once_with([0x1000])
+        self.test_backend.set_exec_breakpoints.assert_called_with({0x2000: None})
+        self.assertEqual(self.callback_manager._on_execute_callbacks.at(0x1000), [])
+        self.assertEqual(len(group), 0)
+
+        # A regex has to match the whole name
+        self.assertEqual(len(target.on_execute_pattern(re.compile(r'sys_\w+'), cb)), 2)
+        self.assertEqual(len(target.on_execute_pattern('nothing*', cb)), 0)
+
+    def test_on_execute_many_fails(self):
+        cb = MagicMock()
+        self.test_backend.set_exec_breakpoints.side_effect = Exception("out of memory")
+
+        # If any breakpoint can't be set, none of the hooks are left behind
+        with self.assertRaises(Exception):
+            self.callback_manager.on_execute_many([0x1000, range(0x2000, 0x2008, 4)], cb)
+
+        self.assertEqual(len(self.callback_manager._on_execute_callbacks), 0)
+        self.test_backend.del_exec_breakpoints.assert_called_once_with([0x1000, 0x2000, 0x2004])
+
+        # Removing hooks that aren't registered still removes the rest
+        self.test_backend.set_exec_breakpoints.side_effect = None
+        hooks = self.callback_manager.on_execute_many([0x1000], cb)
+
+        with self.assertRaises(MonkControlError):
+            self.callback_manager.remove_callbacks(hooks + [(EVENT_EXECUTE, 0x3000, cb)])
+
+        self.assertEqual(len(self.callback_manager._on_execute_callbacks), 0)
+
+    def test_hook_stats(self):
+        cb = MagicMock()
+        never = MagicMock()
+        hook = self.callback_manager.on_execute(0x1000, cb)
+        self.callback_manager.on_execute(0x1000, never, condition=Reg('r0') == 1)
+        self.test_backend.get_reg.return_value = 0
+
+        # The backend reports the stop's timings once the target's resumed
+        self.callback_manager._on_execute_dispatcher(0x1000)
+        self.callback_manager._on_resume_dispatcher(0.5, 0.25)
+        self.callback_manager._on_execute_dispatcher(0x1000)
+        self.callback_manager._on_resume_dispatcher(0.5, 0.25)
+
+        report = self.callback_manager.hook_stats()
+        self.assertEqual(len(report), 2)
+        stats = next(s for s in report if s['runs'])
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['callback']['count'], 2)
+        self.assertEqual(stats['dispatch']['total'], 1.0)
+        self.assertEqual(stats['resume']['total'], 0.5)
+
+        # Hooks whose conditions didn't hold are still counted
+        skipped = next(s for s in report if not s['runs'])
+        self.assertEqual(skipped['hits'], 2)
+        self.assertEqual(skipped['callback']['count'], 0)
+
+        self.callback_manager.remove_callback(hook)
+        self.assertEqual(len(self.callback_manager.hook_stats()), 1)
+
+        self.callback_manager.reset_hook_stats()
+        self.assertEqual(self.callback_manager.hook_stats(), [])
+
+    def test_budget(self):
+        cb = MagicMock()
+        checked = MagicMock(return_value=True)
+        condition = MagicMock()
+        condition.compile.return_value = checked
+        self.test_backend.can_set_breakpoints_while_running.return_value = False
+
+        sampled = self.callback_manager.on_execute(0x1000, cb, condition=condition,
+                                                   budget=Budget(every=2))
+        self.callback_manager.on_write(0x2000, cb, budget=Budget(max_hits=1))
+
+        # Skipped hits don't even get their conditions checked
+        for _ in range(4):
+            self.callback_manager._on_execute_dispatcher(0x1000)
+
+        self.assertEqual(cb.call_count, 2)
+        self.assertEqual(checked.call_count, 2)
+
+        # A used up hook's breakpoint comes out for good
+        self.callback_manager._on_write_dispatcher(0x2000)
+        self.callback_manager._on_write_dispatcher(0x2000)
+        self.assertEqual(cb.call_count, 3)
+        self.test_backend.del_write_breakpoint.assert_called_once_with(0x2000)
+
+        # In non-stop mode, a hook over its rate comes out until the second's up, then goes
+        # back in
+        self.callback_manager.remove_callback(sampled)
+        self.test_backend.reset_mock()
+        self.test_backend.can_set_breakpoints_while_running.return_value = True
+        hook = self.callback_manager.on_execute(0x3000, cb, budget=Budget(per_second=1))
+        self.callback_manager._on_execute_dispatcher(0x3000)
+        self.test_backend.del_exec_breakpoints.assert_called_once_with([0x3000])
+        self.assertEqual(self.callback_manager._on_execute_callbacks.at(0x3000), [])
+
+        self.callback_manager.rearm_due()
+        self.test_backend.set_exec_breakpoints.assert_not_called()
+
+        self.callback_manager._disarmed[hook] -= 1
+        self.callback_manager.rearm_due()
+        self.test_backend.set_exec_breakpoints.assert_called_once_with({0x3000: None})
+
+        # Removing a disarmed hook works like removing any other
+        self.callback_manager._on_execute_dispatcher(0x3000)
+        self.callback_manager.remove_callback(hook)
+        self.assertNotIn(hook, self.callback_manager._disarmed)
+        self.assertNotIn(hook, self.callback_manager._budgets)
+
+    def test_budget_all_stop(self):
+        cb = MagicMock()
+        self.test_backend.can_set_breakpoints_while_running.return_value = False
+        hook = self.callback_manager.on_execute(0x1000, cb, budget=Budget(per_second=1))
+        self.test_backend.reset_mock()
+
+        # Nothing could put the breakpoint back while the target's running, so it stays in,
+        # and the hits are skipped until the second's up
+        for _ in range(3):
+            self.callback_manager._on_execute_dispatcher(0x1000)
+
+        self.assertEqual(cb.call_count, 1)
+        self.test_backend.del_exec_breakpoints.assert_not_called()
+        self.assertNotIn(hook, self.callback_manager._disarmed)
+        self.assertEqual(self.callback_manager.hook_stats()[0]['hits'], 3)
+
+        self.callback_manager._budgets[hook]._window_start -= 1
+        self.callback_manager._on_execute_dispatcher(0x1000)
+        self.assertEqual(cb.call_count, 2)
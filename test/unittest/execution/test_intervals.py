@@ -0,0 +1,105 @@
+import unittest
+
+from monk.intervals import IntervalIndex, PENDING_LIMIT, span
+
+
+class TestIntervalIndex(unittest.TestCase):
+    def test_at(self):
+        index = IntervalIndex()
+        index.add(range(0x1000, 0x1100), 'struct')
+        index.add(0x1010, 'field')
+        index.add(range(0x1010, 0x1020, 4), 'function')
+        index.add(0x2000, 'other')
+
+        self.assertEqual(index.at(0x1000), [(range(0x1000, 0x1100), 'struct')])
+        self.assertEqual(index.at(0x1010), [(range(0x1000, 0x1100), 'struct'), (0x1010, 'field'),
+                                            (range(0x1010, 0x1020, 4), 'function')])
+        # Ranges with a step only cover the addresses they step through
+        self.assertEqual(index.at(0x1012), [(range(0x1000, 0x1100), 'struct')])
+        self.assertEqual(index.at(0x1014), [(range(0x1000, 0x1100), 'struct'),
+                                            (range(0x1010, 0x1020, 4), 'function')])
+        self.assertEqual(index.at(0x10ff), [(range(0x1000, 0x1100), 'struct')])
+        self.assertEqual(index.at(0x1100), [])
+        self.assertEqual(index.at(0xfff), [])
+        self.assertEqual(index.at(0x2000), [(0x2000, 'other')])
+
+    def test_add_and_remove(self):
+        index = IntervalIndex()
+        index.add(0x1000, 'a')
+        index.add(0x1000, 'b')
+        self.assertEqual(index[0x1000], ['a', 'b'])
+        self.assertEqual(index[0x2000], [])
+
+        index.remove(0x1000, 'a')
+        self.assertEqual(index.at(0x1000), [(0x1000, 'b')])
+
+        index.remove(0x1000, 'b')
+        self.assertEqual(index.at(0x1000), [])
+        self.assertEqual(len(index), 0)
+
+        with self.assertRaises(ValueError):
+            index.remove(0x1000, 'b')
+
+        with self.assertRaises(ValueError):
+            index.add(range(0x1000, 0x1000), 'empty')
+
+    def test_many(self):
+        index = IntervalIndex()
+
+        for addr in range(0, 0x10000, 4):
+            index.add(addr, addr)
+
+        index.add(range(0x100, 0x200), 'range')
+        self.assertEqual(index.at(0x104), [(0x104, 0x104), (range(0x100, 0x200), 'range')])
+        self.assertEqual(index.at(0x105), [(range(0x100, 0x200), 'range')])
+        self.assertEqual(index.at(0xfffc), [(0xfffc, 0xfffc)])
+
+    def test_span(self):
+        self.assertEqual(span(0x1000), (0x1000, 0x1001))
+        self.assertEqual(span(range(0x1000, 0x1010, 4)), (0x1000, 0x1010))
+
+    def test_rebuilds(self):
+        index = IntervalIndex()
+        rebuilds = []
+        rebuild = index._rebuild
+        index._rebuild = lambda: rebuilds.append(1) or rebuild()
+
+        # Hooks on single addresses never need the segments worked out, however often
+        # they're looked up in between
+        for addr in range(0, 0x4000, 4):
+            index.add(addr, addr)
+            self.assertEqual(index.at(addr), [(addr, addr)])
+
+        self.assertEqual(rebuilds, [])
+
+        # Ranges are worked in a batch at a time
+        for addr in range(0x10000, 0x20000, 0x10):
+            index.add(range(addr, addr + 0x10), addr)
+            self.assertEqual(index.at(addr + 8), [(range(addr, addr + 0x10), addr)])
+
+        self.assertLessEqual(len(rebuilds), 0x1000 // PENDING_LIMIT)
+
+        # Removing ranges doesn't need them worked out again
+        count = len(rebuilds)
+
+        for addr in range(0x10000, 0x20000, 0x10):
+            index.remove(range(addr, addr + 0x10), addr)
+            self.assertEqual(index.at(addr + 8), [])
+
+        self.assertEqual(len(rebuilds), count)
+
+    def test_readded_range(self):
+        index = IntervalIndex()
+        key = range(0x1000, 0x1010)
+
+        for i in range(PENDING_LIMIT + 2):
+            index.add(range(i * 0x10, i * 0x10 + 8), i)
+
+        index.add(key, 'a')
+        index.at(0)
+        index.remove(key, 'a')
+        index.add(0x1004, 'point')
+        index.add(key, 'b')
+
+        # It's only found once, and ordered by when it was added again
+        self.assertEqual(index.at(0x1004), [(0x1004, 'point'), (key, 'b')])
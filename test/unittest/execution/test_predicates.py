@@ -0,0 +1,65 @@
+import unittest
+
+from monk.conditions import MonkConditionError
+from monk.predicates import reg_equals, reg_in, field, field_equals, field_in, bytes_equal
+
+
+class FakeTaskStruct():
+    name = 'task_struct'
+    pid_offset = 8
+    comm_offset = 12
+    field_sizes = {'pid': 4, 'comm': 16}
+
+
+class FakeBackend():
+    """ Big endian memory holding a task_struct at 0x1000, with r2 pointing at it """
+    endian = 'big'
+
+    def __init__(self):
+        self.mem = bytearray(0x2000)
+        self.mem[0x1008:0x100c] = (42).to_bytes(4, 'big')
+        self.mem[0x100c:0x1015] = b'kthreadd\0'
+        self.reads = []
+
+    def get_reg(self, name):
+        return {'r0': 7, 'r2': 0x1000}[name]
+
+    def read_bytes(self, addr, size):
+        self.reads.append((addr, size))
+        return bytes(self.mem[addr:addr + size])
+
+
+class TestPredicates(unittest.TestCase):
+    def setUp(self):
+        self.backend = FakeBackend()
+
+    def test_registers(self):
+        self.assertTrue(reg_equals('r0', 7).evaluate(self.backend))
+        self.assertFalse(reg_equals('r0', 8).evaluate(self.backend))
+        self.assertTrue(reg_in('r0', {1, 7}).evaluate(self.backend))
+        self.assertFalse(reg_in('r0', []).evaluate(self.backend))
+
+    def test_fields(self):
+        self.assertEqual(field(FakeTaskStruct, 'pid', 'r2').evaluate(self.backend), 42)
+        self.assertEqual(self.backend.reads, [(0x1008, 4)])
+        self.assertTrue(field_equals(FakeTaskStruct, 'pid', 42, 0x1000).evaluate(self.backend))
+        self.assertTrue(field_in(FakeTaskStruct, 'pid', {1, 42}, 'r2').evaluate(self.backend))
+        self.assertFalse(field_in(FakeTaskStruct, 'pid', {1}, 'r2').evaluate(self.backend))
+
+        with self.assertRaises(MonkConditionError):
+            field(FakeTaskStruct, 'tasks', 'r2')
+
+    def test_bytes_equal(self):
+        comm = 0x1000 + FakeTaskStruct.comm_offset
+        self.assertTrue(bytes_equal(comm, b'kthreadd\0', 'big').evaluate(self.backend))
+        # Compared eight bytes at a time, then the NUL on its own
+        self.assertEqual(self.backend.reads, [(0x100c, 8), (0x1014, 1)])
+
+        self.assertFalse(bytes_equal(comm, b'kthread\0', 'big').evaluate(self.backend))
+        self.assertFalse(bytes_equal(comm, b'kthreadd2\0', 'big').evaluate(self.backend))
+
+    def test_compiled_once(self):
+        check = field_equals(FakeTaskStruct, 'pid', 42, 'r2').compile()
+
+        for _ in range(3):
+            self.assertEqual(check(self.backend), 1)
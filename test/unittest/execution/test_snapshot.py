@@ -0,0 +1,51 @@
+import unittest
+from unittest.mock import MagicMock
+
+from monk.conditions import Reg
+from monk.snapshot import Capture, Snapshot, MonkSnapshotError
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.backend = MagicMock()
+        self.backend.get_reg.side_effect = {'pc': 0x1000, 'r2': 0x8000}.get
+        self.backend.read_many.return_value = [b'\x01\x02\x03\x04', b'\xaa\xbb']
+        self.backend.current_cpu.return_value = 'p01.02'
+
+    def test_take(self):
+        capture = Capture(registers=['pc', 'r2'], memory=[(Reg('r2') + 4, 4), (0x2000, 2)])
+        snapshot = capture.take(self.backend, 'execute', 0x1000)
+
+        # The memory is read in one batch, at addresses worked out at the hit
+        self.backend.read_many.assert_called_once_with([(0x8004, 4), (0x2000, 2)])
+
+        self.assertEqual(snapshot.kind, 'execute')
+        self.assertEqual(snapshot.addr, 0x1000)
+        self.assertEqual(snapshot.cpu, 'p01.02')
+        self.assertEqual(snapshot.get_reg('r2'), 0x8000)
+        self.assertEqual(dict(snapshot.registers), {'pc': 0x1000, 'r2': 0x8000})
+        self.assertEqual(snapshot.read_bytes(0x8005, 2), b'\x02\x03')
+        self.assertEqual(snapshot.read_bytes(0x2000, 2), b'\xaa\xbb')
+
+        with self.assertRaises(MonkSnapshotError):
+            snapshot.get_reg('r0')
+
+        with self.assertRaises(MonkSnapshotError):
+            snapshot.read_bytes(0x8006, 4)
+
+    def test_no_memory(self):
+        snapshot = Capture(registers=['pc']).take(self.backend, 'execute', 0x1000)
+        self.backend.read_many.assert_not_called()
+        self.assertEqual(dict(snapshot.memory), {})
+
+    def test_immutable(self):
+        snapshot = Snapshot('execute', 0x1000, {'pc': 0x1000}, [((0x2000, 2), b'\xaa\xbb')])
+
+        with self.assertRaises(AttributeError):
+            snapshot.addr = 0
+
+        with self.assertRaises(TypeError):
+            snapshot.registers['pc'] = 0
+
+        with self.assertRaises(TypeError):
+            snapshot.memory[0x2000] = b''
@@ -0,0 +1,56 @@
+import json
+import unittest
+
+from monk.stats import Histogram, StatsRecorder, BUCKET_BOUNDS
+
+
+class TestStats(unittest.TestCase):
+    def test_histogram(self):
+        h = Histogram()
+        self.assertEqual(h.percentile(50), 0.0)
+        self.assertEqual(h.mean, 0.0)
+
+        for seconds in (1e-6, 3e-6, 3e-6, 100.0):
+            h.record(seconds)
+
+        self.assertEqual(h.count, 4)
+        self.assertEqual(h.max, 100.0)
+        self.assertEqual(h.counts[0], 1)
+        self.assertEqual(h.counts[2], 2)
+        self.assertEqual(h.counts[-1], 1)
+        self.assertEqual(len(h.counts), len(BUCKET_BOUNDS) + 1)
+
+        # Percentiles are the upper bound of the bucket they fall in
+        self.assertEqual(h.percentile(50), 4e-6)
+        self.assertEqual(h.percentile(100), 100.0)
+        self.assertEqual(h.to_dict()['buckets'], {str(1e-6): 1, str(4e-6): 2, 'inf': 1})
+
+    def test_recorder(self):
+        r = StatsRecorder()
+        cheap = ('execute', 0x1000, print)
+        costly = ('write', range(0x2000, 0x2010), len)
+
+        r.hit(cheap, True)
+        r.hit(cheap, False)
+        r.record(cheap, 'callback', 1e-5)
+        r.hit(costly, True)
+        r.record(costly, 'resume', 1.0)
+
+        # Stages of hooks that were never hit, or have been forgotten, aren't recorded
+        r.record(('read', 0x3000, print), 'dispatch', 1.0)
+
+        report = r.report()
+        self.assertEqual([stats['addr'] for stats in report], ['0x2000-0x2010', '0x1000'])
+        self.assertEqual(report[1]['hits'], 2)
+        self.assertEqual(report[1]['runs'], 1)
+        self.assertEqual(report[1]['callback']['count'], 1)
+        self.assertEqual(report[1]['callback']['total'], 1e-5)
+        self.assertEqual(report[0]['callback']['count'], 0)
+        self.assertEqual(json.loads(report.to_json()), list(report))
+
+        r.forget(costly)
+        r.record(costly, 'resume', 1.0)
+        self.assertEqual(len(r.report()), 1)
+
+        r.reset()
+        self.assertEqual(r.report(), [])
@@ -10,6 +10,8 @@ test_backend.read_uint16.return_value = 16
 test_backend.read_uint32.return_value = 32
 test_backend.read_uint64.return_value = 64
 test_backend.get_reg.return_value = "reg"
+test_backend.read_bytes.return_value = b'bytes'
+test_backend.read_many.return_value = [b'a', b'bc']
 
 monk.backends.backend_map = {'test_backend': MagicMock()}
 
@@ -32,5 +34,31 @@ class TestMemreader(unittest.TestCase):
         self.assertEqual(m.read_uint64(4), 64)
         test_backend.read_uint64.assert_called_with(4)
 
+        self.assertEqual(m.read_bytes(5, 5), b'bytes')
+        test_backend.read_bytes.assert_called_with(5, 5)
+
+        self.assertEqual(m.read_many([(6, 1), (7, 2)]), [b'a', b'bc'])
+        test_backend.read_many.assert_called_with([(6, 1), (7, 2)])
+
         self.assertEqual(m.get_reg('reg1'), 'reg')
         test_backend.get_reg.assert_called_with('reg1')
+
+    def test_cpus(self):
+        m = Monk('host', 'port', backend='test_backend')
+        m._backend = MagicMock()
+        m._backend.cpus.return_value = ['p01.01', 'p01.02']
+        m._backend.current_cpu.return_value = 'p01.02'
+        m._backend.get_reg.return_value = 0x1000
+
+        cpus = m.cpus
+        self.assertEqual([cpu.id for cpu in cpus], ['p01.01', 'p01.02'])
+        self.assertEqual(m.current_cpu, cpus[1])
+
+        self.assertEqual(cpus[0].get_reg('pc'), 0x1000)
+        m._backend.get_reg.assert_called_with('pc', 'p01.01')
+
+        cpus[1].write_reg('r0', 5)
+        m._backend.write_reg.assert_called_with('r0', 5, 'p01.02')
+
+        m._backend.current_cpu.return_value = None
+        self.assertIsNone(m.current_cpu)
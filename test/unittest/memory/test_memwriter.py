@@ -31,5 +31,8 @@ class TestMemwriter(unittest.TestCase):
         m.write_uint64(4, 4)
         test_backend.write_uint64.assert_called_with(4, 4)
 
+        m.write_bytes(5, b'bytes')
+        test_backend.write_bytes.assert_called_with(5, b'bytes')
+
         m.write_reg('reg1', 5)
         test_backend.write_reg.assert_called_with('reg1', 5)
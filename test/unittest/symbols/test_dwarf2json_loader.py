@@ -262,5 +262,61 @@ class TestDwarf2jsonLoader(unittest.TestCase):
 
         self.assertEqual(str(cm.exception), "Tried to get type name for kind 'struct', which is not 'pointer' or 'base'")
 
+    @patch("builtins.open", new_callable=mock_open, read_data="""
+            {
+                "base_types":{},
+                "symbols":{
+                    "sys_read":{
+                        "address":4096,
+                        "type":{"kind":"function"}
+                    },
+                    "sys_call_table":{
+                        "address":8192,
+                        "type":{"kind":"array"}
+                    },
+                    "sys_write":{
+                        "address":4352
+                    },
+                    "sys_tz":{
+                        "address":12288
+                    },
+                    "_stext":{
+                        "address":4096
+                    },
+                    "_etext":{
+                        "address":8192
+                    },
+                    "undefined_sym":{
+                        "address":null,
+                        "type":{"kind":"function"}
+                    }
+                }
+            }"""
+            )
+    def test_get_code_addresses(self, mock_file):
+        d = Dwarf2JsonLoader("test/file")
+        # Data is left out whether it's known by its type or by being outside the kernel text
+        self.assertEqual(d.get_code_addresses(), {"sys_read": 4096, "sys_write": 4352,
+                                                  "_stext": 4096})
+
+    @patch("builtins.open", new_callable=mock_open, read_data="""
+            {
+                "base_types":{},
+                "symbols":{
+                    "sys_read":{
+                        "address":4096,
+                        "type":{"kind":"function"}
+                    },
+                    "sys_write":{
+                        "address":4352
+                    }
+                }
+            }"""
+            )
+    def test_get_code_addresses_without_text(self, mock_file):
+        d = Dwarf2JsonLoader("test/file")
+        # Without the kernel text's bounds, a symbol without a type can't be told apart from data
+        self.assertEqual(d.get_code_addresses(), {"sys_read": 4096})
+
 if __name__ == '__main__':
     unittest.main()
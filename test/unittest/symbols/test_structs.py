@@ -68,6 +68,7 @@ class TestStructs(unittest.TestCase):
         self.assertTrue(t.f1)
         backend_mock.read_uint32.assert_called_with(0)
         self.assertEqual(t.f1_offset, 0)
+        self.assertEqual(TestClass.field_sizes, {"f1": 4})
 
         # write pointer at offset 0
         t.f1 = 0x12345678
@@ -219,12 +220,13 @@ class TestStructs(unittest.TestCase):
         self.assertEqual(t.name, "test_class")
 
         # array of 3 char elements at offset 5
-        backend_mock.read_uint8.side_effect = [1, 2, 3]
+        backend_mock.endian = 'little'
+        backend_mock.read_bytes.return_value = b'\x01\x02\x03'
         arr = t.f6
         self.assertEqual(arr[0], 1)
         self.assertEqual(arr[1], 2)
         self.assertEqual(arr[2], 3)
-        backend_mock.read_uint8.assert_has_calls([call(5), call(6), call(7)])
+        backend_mock.read_bytes.assert_called_once_with(5, 3)
         self.assertEqual(t.f6_offset, 5)
 
     def test_name_to_camel(self):